@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Time the sources and every step of csventrifuge on synthetic datasets.
+
+For each number of rows, address and DICACOLO shaped datasets are made by
+``synthetic.py`` and put in a download cache, so the real sources parse
+them without any network access. Each source is then parsed on its own,
+and run through ``csventrifuge.py`` with books of each size; runs happen
+in a fresh process, whose ``--metrics-json`` report gives the time and
+peak memory of every step.
+
+Results are compared with the baseline; cases taking more time or memory
+than the baseline by more than the threshold are reported, and the exit
+status is 1.
+
+    python benchmarks/bench_pipeline.py --rows 100000 1000000 --books 100 10000
+    python benchmarks/bench_pipeline.py --save-baseline
+    python benchmarks/bench_pipeline.py --rows 1000000 --books 1000 --categorical
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict
+
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import csventrifuge  # noqa: E402
+from benchmarks import synthetic  # noqa: E402
+from sources import _http  # noqa: E402
+
+REPO = Path(__file__).parent.parent
+BASELINE = Path(__file__).parent / "baseline.json"
+# Source, the file of the synthetic dataset it downloads, and its class
+SOURCES = {
+    "luxembourg_addresses": ("addresses.csv", "LuxembourgAddresses"),
+    "luxembourg-caclr-dicacolo": ("caclr.zip", "CaclrDicacolo"),
+}
+# Steps faster than this in the baseline are too noisy to be compared
+MIN_STEP_S = 0.05
+PARSE = """
+import json, sys
+import csventrifuge, metrics
+recorder = metrics.start()
+source = csventrifuge.load_module(sys.argv[1], "sources")
+with metrics.step("parse") as step:
+    step.rows_out = len(source.get())
+print(json.dumps(recorder.report()))
+"""
+
+
+def seed_cache(cache: Path, data: Path) -> None:
+    """Put the synthetic datasets in the download cache, as if the sources had fetched them."""
+    os.environ["CSVENTRIFUGE_CACHE"] = str(cache)
+    for source_name, (filename, cls) in SOURCES.items():
+        module = csventrifuge.load_module(source_name, "sources")
+        url = getattr(module, cls).url
+        body, meta = _http.cache_paths(url)
+        body.parent.mkdir(parents=True, exist_ok=True)
+        body.unlink(missing_ok=True)
+        body.symlink_to((data / filename).resolve())
+        meta.write_text(json.dumps({"url": url, "etag": "bench", "last_modified": None}))
+
+
+def environment(cache: Path) -> Dict[str, str]:
+    env = dict(os.environ, CSVENTRIFUGE_CACHE=str(cache))
+    env[_http.OFFLINE] = "1"
+    env["PYTHONPATH"] = os.pathsep.join([str(REPO), env.get("PYTHONPATH", "")])
+    return env
+
+
+def summarize(report: Dict[str, Any]) -> Dict[str, Any]:
+    """Reduce a metrics report to the numbers compared with the baseline."""
+    steps = report["steps"]
+    return {
+        "wall_s": sum(step["wall_s"] for step in steps),
+        "cpu_s": sum(step["cpu_s"] for step in steps),
+        "peak_rss_bytes": report["peak_rss_bytes"],
+        "rows_out": steps[-1]["rows_out"] if steps else None,
+        "steps": {step["name"]: step["wall_s"] for step in steps},
+    }
+
+
+def parse(source_name: str, cache: Path) -> Dict[str, Any]:
+    """Time ``get()`` of a source in a fresh process."""
+    result = subprocess.run(
+        [sys.executable, "-c", PARSE, source_name],
+        cwd=REPO,
+        env=environment(cache),
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return summarize(json.loads(result.stdout.splitlines()[-1]))
+
+
+def run(source_name: str, cache: Path, books: Path, *flags: str) -> Dict[str, Any]:
+    """Run csventrifuge on a source in a fresh process, with the books under ``books``."""
+    report = books / "metrics.json"
+    subprocess.run(
+        [
+            sys.executable,
+            str(REPO / "csventrifuge.py"),
+            source_name,
+            str(books / "out.csv"),
+            "--metrics-json",
+            str(report),
+            *flags,
+        ],
+        cwd=books,
+        env=environment(cache),
+        check=True,
+        capture_output=True,
+    )
+    return summarize(json.loads(report.read_text()))
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]], threshold: float
+) -> list[str]:
+    """Return a line for every measure of ``results`` exceeding the baseline by ``threshold``."""
+    regressions = []
+    for case, result in results.items():
+        base = baseline.get(case)
+        if base is None:
+            continue
+        measures = [("wall_s", result["wall_s"], base["wall_s"])]
+        measures.append(("peak_rss_bytes", result["peak_rss_bytes"], base["peak_rss_bytes"]))
+        measures += [
+            (f"steps.{name}", result["steps"].get(name, 0.0), seconds)
+            for name, seconds in base["steps"].items()
+            if seconds >= MIN_STEP_S
+        ]
+        for name, value, reference in measures:
+            if reference and value > reference * (1 + threshold):
+                regressions.append(f"{case} {name}: {value:.4g} vs {reference:.4g} in the baseline")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--books", type=int, nargs="+", default=[100, 1_000, 10_000, 100_000])
+    parser.add_argument("--sources", nargs="+", default=list(SOURCES), choices=list(SOURCES))
+    parser.add_argument(
+        "--categorical", action="store_true", help="Also time every run with --categorical"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Replace the baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Slowdown ratio reported as a regression"
+    )
+    parser.add_argument("--output", type=Path, help="Also write the results to this file")
+    parser.add_argument("--work", type=Path, help="Keep the datasets in this directory")
+    args = parser.parse_args()
+
+    work = args.work or Path(tempfile.mkdtemp(prefix="csventrifuge-bench-"))
+    results: Dict[str, Dict[str, Any]] = {}
+    print(f"{'case':<58} {'seconds':>8} {'MiB':>7}")
+    for rows in args.rows:
+        data = work / f"rows-{rows}"
+        if not (data / "caclr.zip").exists():
+            data.mkdir(parents=True, exist_ok=True)
+            synthetic.addresses(rows, args.seed).write_csv(data / "addresses.csv", separator=";")
+            synthetic.write_dicacolo(data / "caclr.zip", rows, args.seed)
+        cache = data / "cache"
+        seed_cache(cache, data)
+        cases = [(f"parse/{name}/rows={rows}", parse, (name, cache)) for name in args.sources]
+        for size in args.books:
+            books = data / f"books-{size}"
+            if not books.exists():
+                synthetic.address_books(books, size, args.seed)
+                synthetic.dicacolo_books(books, size)
+            cases += [
+                (f"run/{name}/rows={rows}/books={size}", run, (name, cache, books))
+                for name in args.sources
+            ]
+            if args.categorical:
+                cases += [
+                    (
+                        f"run-categorical/{name}/rows={rows}/books={size}",
+                        run,
+                        (name, cache, books, "--categorical"),
+                    )
+                    for name in args.sources
+                ]
+        for case, measure, measure_args in cases:
+            results[case] = measure(*measure_args)
+            print(
+                f"{case:<58} {results[case]['wall_s']:>8.3f} "
+                f"{results[case]['peak_rss_bytes'] / (1 << 20):>7.0f}"
+            )
+
+    report = {
+        "polars": pl.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cases": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=1))
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(report, indent=1))
+        return
+    if not args.baseline.exists():
+        print(f"No baseline in {args.baseline}; run with --save-baseline to store one")
+        return
+    baseline = json.loads(args.baseline.read_text())
+    regressions = compare(results, baseline["cases"], args.threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Time rule application against the size of the rulebook.
+
+Every run rewrites the same frame with a rulebook of growing size; as
+rules are applied with a hash join, the time should stay nearly flat.
+
+    python benchmarks/bench_rules.py --rows 1000000 --sizes 100 1000 10000 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from engine import OPTIMIZATIONS, Book, compile_books  # noqa: E402
+
+
+def frame(rows: int, distinct: int) -> pl.LazyFrame:
+    """Return ``rows`` street names drawn from ``distinct`` values."""
+    return pl.LazyFrame(
+        {"rue": (pl.int_range(rows, eager=True) % distinct).cast(pl.String)}
+    ).select(pl.format("Rue {}", "rue").alias("rue"))
+
+
+def rulebook(size: int) -> Book:
+    """Return ``size`` rules, half of them matching values of ``frame``."""
+    old = (pl.int_range(size, eager=True) * 2).cast(pl.String)
+    return Book(
+        pl.DataFrame({"old": old}).select(
+            pl.format("Rue {}", "old").alias("old"), pl.format("Rue {} (new)", "old").alias("new")
+        )
+    )
+
+
+def run(lf: pl.LazyFrame, size: int) -> float:
+    book = rulebook(size)
+    start = time.perf_counter()
+    plan = compile_books(["rue"], {}, {"rue": book}, {}, set())
+    usage = plan.usage(lf).collect(optimizations=OPTIMIZATIONS)
+    book.add_counts(usage.select(pl.col("__count_0").explode().struct.unnest()).drop_nulls())
+    plan.apply(lf).collect(optimizations=OPTIMIZATIONS)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--distinct", type=int, default=50_000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    lf = frame(args.rows, args.distinct).collect().lazy()
+    print(f"{'rules':>8} {'seconds':>8}")
+    for size in args.sizes:
+        best = min(run(lf, size) for _ in range(args.repeat))
+        print(f"{size:>8} {best:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
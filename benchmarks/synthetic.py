@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Generate address and DICACOLO shaped datasets, and books to go with them.
+
+The values are drawn from the fixtures in ``tests/data``: the streets,
+localities, communes and postcodes of ``luxembourg-streets.csv`` and the
+rows of the DICACOLO file in ``caclr.zip``. Draws are made by hashing
+the row number with a seed, so the same seed and Polars version give the
+same data.
+
+    python benchmarks/synthetic.py --rows 1000000 --books 10000 --out /tmp/bench
+"""
+
+import argparse
+import os
+import sys
+import zipfile
+from pathlib import Path
+
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sources import _caclr  # noqa: E402
+
+DATA_DIR = Path(__file__).parent.parent / "tests" / "data"
+DICACOLO = "TR.DICACOLO.RUCP"
+# Lines of the DICACOLO file generated at once
+CHUNK_ROWS = 1 << 20
+
+
+def streets() -> pl.DataFrame:
+    """Return the street, locality, commune and postcode combinations of the fixtures."""
+    return pl.read_csv(DATA_DIR / "luxembourg-streets.csv", infer_schema_length=0)
+
+
+def dicacolo_seed() -> pl.DataFrame:
+    """Return the rows of the DICACOLO file of the fixtures."""
+    with zipfile.ZipFile(DATA_DIR / "caclr.zip") as archive:
+        return _caclr.read_fixed_width(archive.read(DICACOLO), _caclr.LAYOUTS[DICACOLO])
+
+
+def draw(rows: int, seed: int, modulo: int) -> pl.Series:
+    """Return ``rows`` numbers below ``modulo``, drawn by hashing the row number."""
+    return (pl.int_range(rows, eager=True).hash(seed) % modulo).cast(pl.Int64)
+
+
+def geoportail_ids(index: pl.Series, seed: int) -> pl.Series:
+    """Return the ``id_geoportail`` of the addresses at ``index``."""
+    return pl.select(
+        pl.concat_str(
+            (index.hash(seed + 4) % 1000).cast(pl.String).str.zfill(3),
+            pl.lit("X"),
+            index.cast(pl.String).str.zfill(11),
+        )
+    ).to_series()
+
+
+def addresses(rows: int, seed: int = 0) -> pl.DataFrame:
+    """Return ``rows`` addresses, as text, in the layout of the address dataset."""
+    seed_rows = streets()
+    picked = seed_rows[draw(rows, seed, len(seed_rows))]
+    fraction = draw(rows, seed + 1, 1_000_000) / 1_000_000
+    index = pl.int_range(rows, eager=True)
+    return picked.select(
+        "rue",
+        (draw(rows, seed + 2, 120) + 1).cast(pl.String).alias("numero"),
+        "localite",
+        "code_postal",
+        draw(rows, seed + 3, 10_000).cast(pl.String).alias("id_caclr_rue"),
+        (index + 100_000).cast(pl.String).alias("id_caclr_bat"),
+        (49.45 + fraction * 0.65).round(6).cast(pl.String).alias("lat_wgs84"),
+        (5.73 + fraction.reverse() * 0.8).round(6).cast(pl.String).alias("lon_wgs84"),
+        (48_000 + fraction * 60_000).round(2).cast(pl.String).alias("coord_est_luref"),
+        (57_000 + fraction.reverse() * 82_000).round(2).cast(pl.String).alias("coord_nord_luref"),
+        geoportail_ids(index, seed).alias("id_geoportail"),
+        "commune",
+    )
+
+
+def dicacolo_lines(rows: int, seed: int = 0) -> pl.Series:
+    """Return ``rows`` lines of a fixed-width DICACOLO file."""
+    seed_rows = dicacolo_seed()
+    picked = seed_rows[draw(rows, seed, len(seed_rows))]
+    return picked.select(
+        pl.concat_str(
+            [pl.col(field.name).str.pad_end(field.length) for field in _caclr.LAYOUTS[DICACOLO]]
+        )
+    ).to_series()
+
+
+def write_dicacolo(path: Path, rows: int, seed: int = 0) -> None:
+    """Write ``rows`` lines of DICACOLO to a zip archive, as the CACLR publishes it."""
+    lines = dicacolo_lines(rows, seed)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(DICACOLO, "w", force_zip64=True) as f:
+            for start in range(0, rows, CHUNK_ROWS):
+                chunk = lines.slice(start, CHUNK_ROWS).str.join("\r\n").item() + "\r\n"
+                f.write(chunk.encode(_caclr.ENCODING))
+
+
+def book(old: pl.Series, new: pl.Series, size: int, miss: str) -> pl.DataFrame:
+    """
+    Return ``size`` entries: the ``old`` values first, padded with values
+    matching nothing.
+    """
+    hits = pl.DataFrame({"old": old, "new": new}).unique("old", maintain_order=True).head(size)
+    misses = pl.int_range(size - len(hits), eager=True).cast(pl.String)
+    return pl.concat(
+        [
+            hits,
+            pl.DataFrame({"old": misses, "new": misses}).select(
+                pl.concat_str(pl.lit(miss), "old").alias("old"), "new"
+            ),
+        ]
+    )
+
+
+def write_book(frame: pl.DataFrame, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    frame.write_csv(path, separator="\t", include_header=False, quote_style="never")
+
+
+def address_books(
+    directory: Path, size: int, seed: int = 0, source: str = "luxembourg_addresses"
+) -> None:
+    """
+    Write rules, filters and enhancements of ``size`` entries each for the
+    addresses of ``seed``: half of the rules and enhancements and a fifth
+    of the filters match.
+    """
+    names = streets().get_column("rue").unique(maintain_order=True).head(size // 2)
+    rules = book(names, names + " (bench)", size, "Rue absente ")
+    write_book(rules, directory / "rules" / source / "rue.csv")
+    ids = geoportail_ids(pl.int_range(0, size, 5, eager=True), seed)
+    filters = book(ids, ids, size, "999Y")
+    write_book(filters, directory / "filters" / source / "id_geoportail.csv")
+    localities = streets().get_column("localite")
+    known = pl.int_range(min(size // 2, 10_000), eager=True)
+    enhancements = book(
+        known.cast(pl.String), localities[known % len(localities)], size, "absent-"
+    )
+    write_book(enhancements, directory / "enhance" / source / "id_caclr_rue" / "localite.csv")
+
+
+def dicacolo_books(
+    directory: Path, size: int, source: str = "luxembourg-caclr-dicacolo"
+) -> None:
+    """Write rules and filters of ``size`` entries each for DICACOLO."""
+    names = dicacolo_seed().get_column("rue").unique(maintain_order=True)
+    rules = book(names.head(size // 2), names.head(size // 2) + " (bench)", size, "Rue absente ")
+    write_book(rules, directory / "rules" / source / "rue.csv")
+    filtered = names.tail(min(size // 5, len(names) // 10))
+    filters = book(filtered, filtered, size, "Rue filtrée ")
+    write_book(filters, directory / "filters" / source / "rue.csv")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--books", type=int, default=1_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=Path, required=True)
+    args = parser.parse_args()
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    addresses(args.rows, args.seed).write_csv(args.out / "addresses.csv", separator=";")
+    write_dicacolo(args.out / "caclr.zip", args.rows, args.seed)
+    address_books(args.out, args.books, args.seed)
+    dicacolo_books(args.out, args.books)
+
+
+if __name__ == "__main__":
+    main()
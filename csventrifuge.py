@@ -1,88 +1,35 @@
 #!/usr/bin/env -S uv pip install --system --strict --require-virtualenv --quiet
 # [project]
 # dependencies = [
-#     "polars>=0.20",
+#     "polars>=1.44.2",
 #     "httpx==0.27.0",
 # ]
 # requires-python = ">=3.12"
 # [tool.uv]
-# cutoff = "2025-06-07"
+# cutoff = "2026-10-18"
 
-# TODO use a generator instead of loading everything in ram
+# DONE use a generator instead of loading everything in ram - sources are
+#  scanned into a single lazy plan that is streamed into the output
 # DONE deal with rules that apply only in one city, e.g. Rue Churchill
-#  which becomes Bd Churchill in Esch only - use an enhancement
+#  which becomes Bd Churchill in Esch only - use a conditional rule,
+#  rules/<source>/rue@localite+rue.csv
 
 # Import necessary libraries
+# Only what the command line needs is imported here; engine, which does the
+# processing, imports Polars and is loaded once the arguments are checked.
 import argparse
 import importlib
 import logging
 import os
-import re
-from dataclasses import dataclass
-from typing import Dict, Iterable, Tuple, TextIO
+import sys
+from typing import Iterable, Tuple
 from pathlib import Path
-from types import ModuleType
-import polars as pl
+# form_module and load_module are kept importable from here
+from registry import form_module, load_module, module_names, module_path  # noqa: F401
 
-
-# Typed wrappers
-@dataclass
-class Entry:
-    """Mapping or filter entry that tracks how often it is used."""
-
-    value: str
-    count: int = 0
-
-
-Rulebook = Dict[str, Dict[str, Entry]]
-EnhanceBook = Dict[str, Dict[str, Dict[str, Entry]]]
-FilterBook = Dict[str, Dict[str, Entry]]
 # Set up logging
 logging.basicConfig(level=logging.WARNING)
-log = logging.getLogger(__name__)
-
-
-def load_module(wanted_module: str, origin: str) -> ModuleType:
-    """
-    Load the specified module from the given origin directory.
-
-    Args:
-        wanted_module (str): The desired module to load.
-        origin (str): The directory in which to search for the module.
-    Returns:
-        The loaded module.
-    Raises:
-        ImportError: If the desired module is not found in the origin directory.
-    """
-    # Compile regular expression to search for .py files
-    pysearchre = re.compile(".py$", re.IGNORECASE)
-    # Filter module files using compiled regular expression
-    modulefiles = filter(
-        pysearchre.search, os.listdir(os.path.join(os.path.dirname(__file__), origin))
-    )
-    # Create a list of modules by mapping form_module to modulefiles
-    modules = map(form_module, modulefiles)
-    # Import parent module/namespace
-    importlib.import_module(origin)
-    # Iterate through modules and find the desired module
-    for module in modules:
-        if module == "." + wanted_module:
-            log.debug("Loading module %s", module)
-            return importlib.import_module(module, package="sources")
-    # If the desired module is not found, raise an ImportError
-    raise ImportError(f'module not found "{wanted_module}" ({origin})')
-
-
-def form_module(fp: str) -> str:
-    """
-    Form a module name from a filepath.
-
-    Args:
-        fp (str): The filepath from which to form a module name.
-    Returns:
-        The formed module name.
-    """
-    return "." + os.path.splitext(fp)[0]
+log = logging.getLogger("csventrifuge")
 
 
 def is_valid_source(arg_parser: argparse.ArgumentParser, arg: str) -> str:
@@ -95,231 +42,207 @@ def is_valid_source(arg_parser: argparse.ArgumentParser, arg: str) -> str:
     Returns:
         The argument if the input source definition file exists.
     """
-    # Check if the input source definition file exists
-    if not os.path.exists(f"sources/{arg}.py"):
+    # Check if the input source definition file exists, without importing it
+    if not module_path(arg, "sources").is_file():
         arg_parser.error(f"The input source definition sources/{arg}.py does not exist")
     # If the argument is a valid source definition file, return the argument
     return arg
 
 
 # Define function to check if output file is valid
-def is_valid_output(arg_parser: argparse.ArgumentParser, arg: str) -> TextIO:
+def is_valid_output(arg_parser: argparse.ArgumentParser, arg: str) -> Path:
     """
-    Check if the output file can be written to.
+    Check if the output file can be written to, without creating it.
 
     Args:
         arg_parser: The argparse parser object.
         arg (str): The output file.
     Returns:
-        The output file if it can be written to.
+        The path of the output file if it can be written to.
     """
-    # Try opening the output file for writing, encoding it in utf-8 and using a newline
-    try:
-        output = open(arg, "w", encoding="utf-8", newline="")
-    # If an OSError occurs, raise an error stating that the output file cannot be written to
-    except OSError:
+    path = Path(arg)
+    # An existing file must be writable, a new one needs a writable directory
+    target = path if path.exists() else path.parent
+    if path.is_dir() or not os.access(target, os.W_OK):
         arg_parser.error(f"Unable to write to file {arg}")
-    # If no error occurs, return the output file
-    else:
-        return output
-
-
-# Set up argument parser to parse input source and output file
-parser = argparse.ArgumentParser(
-    description="Rewrite [source] csv, and output to [output]"
-)
-parser.add_argument(
-    "source",
-    metavar="source",
-    type=lambda x: is_valid_source(parser, x),
-    help="Input source definition",
-)
-parser.add_argument(
-    "output",
-    metavar="output",
-    default="csventrifuge-out.csv",
-    type=lambda x: is_valid_output(parser, x),
-    help="Output file",
-    nargs="?",
-)
+    # If no error occurs, return the path of the output file
+    return path
 
 
-def load_rules(source: str, keys: Iterable[str]) -> Rulebook:
-    """Load rule CSV files for the given source."""
-    book: Rulebook = {}
-    for key in keys:
-        path = Path("rules") / source / f"{key}.csv"
-        if not path.exists():
-            continue
-        book[key] = {}
-        df = pl.read_csv(
-            path,
-            separator="\t",
-            has_header=False,
-            new_columns=["old", "new"],
-            comment_prefix="#",
-            schema={"old": pl.String, "new": pl.String},
-            encoding="utf8",
-        )
-        for old, new in df.iter_rows():
-            book[key][old] = Entry(new)
-    return book
-
+def read_batch(items: Iterable[str]) -> list[Tuple[str, list[str]]]:
+    """
+    Return the (source, outputs) pairs of the batch arguments.
 
-def load_enhancements(source: str, keys: list[str]) -> Tuple[EnhanceBook, set[str]]:
-    """Load enhancement CSV files for the given source."""
-    book: Dict[str, Dict[str, Dict[str, Entry]]] = {}
-    enhanced: set[str] = set()
-    for key in list(keys):
-        enhancepath = Path("enhance") / source / key
-        if not enhancepath.is_dir():
+    Each argument is either a ``source=output,output`` pair or the path of
+    a manifest listing one source and its outputs per line.
+    """
+    pairs = []
+    for item in items:
+        if "=" in item:
+            source_name, outputs = item.split("=", 1)
+            pairs.append((source_name, outputs.split(",")))
             continue
-        book[key] = {}
-        for filename in os.listdir(enhancepath):
-            filepath = enhancepath / filename
-            target = filepath.stem
-            if target not in keys:
-                keys.append(target)
-            enhanced.add(target)
-            book[key][target] = {}
-            df = pl.read_csv(
-                filepath,
-                separator="\t",
-                has_header=False,
-                new_columns=["old", "new"],
-                comment_prefix="#",
-                schema={"old": pl.String, "new": pl.String},
-                encoding="utf8",
-            )
-            for old, new in df.iter_rows():
-                book[key][target][old] = Entry(new)
-        log.debug("Enhance book for %s: %s", key, ", ".join(book[key].keys()))
-    return book, enhanced
+        with open(item, "r", encoding="utf-8") as manifest:
+            for line in manifest:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    source_name, *outputs = line.split()
+                    pairs.append((source_name, outputs))
+    return pairs
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """Set up argument parser to parse input source and output file."""
+    parser = argparse.ArgumentParser(
+        description="Rewrite [source] csv, and output to [output]; the extension of each output "
+        "picks its format: .parquet, .arrow, .ndjson or .csv"
+    )
+    parser.add_argument(
+        "source",
+        metavar="source",
+        type=lambda x: is_valid_source(parser, x),
+        help="Input source definition",
+        nargs="?",
+    )
+    parser.add_argument(
+        "output",
+        metavar="output",
+        default=["csventrifuge-out.csv"],
+        help="Output files",
+        nargs="*",
+    )
+    parser.add_argument(
+        "--list-sources",
+        action="store_true",
+        help="List the available sources and exit",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Use cached downloads only, never the network",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="SOURCE=OUTPUT[,OUTPUT]|MANIFEST",
+        nargs="+",
+        help="Run several sources in one process; "
+        "a manifest lists one source and its outputs per line",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process the rows that changed since the previous incremental run",
+    )
+    parser.add_argument(
+        "--reuse",
+        action="store_true",
+        help="Reuse the cached input and only recompute the columns whose books changed",
+    )
+    parser.add_argument(
+        "--categorical",
+        action="store_true",
+        help="Dictionary-encode the columns a source declares as categorical, "
+        "applying the books once per distinct value",
+    )
+    parser.add_argument(
+        "--stage-dir",
+        type=Path,
+        default=None,
+        help="Run the output stages of the sources, writing to this directory",
+    )
+    parser.add_argument(
+        "--compression",
+        default="zstd",
+        help="Compression of Parquet outputs",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=None,
+        help="Number of rows per row group of Parquet outputs",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        type=Path,
+        default=None,
+        help="Write the wall time, CPU time, peak memory and rows of every step to this file",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time of every step, and add the query plans to --metrics-json",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of sources run at the same time in batch mode",
+    )
+    return parser
 
 
-def load_filters(source: str, keys: Iterable[str]) -> FilterBook:
-    """Load filter CSV files for the given source."""
-    book: FilterBook = {}
-    for key in keys:
-        path = Path("filters") / source / f"{key}.csv"
-        if not path.exists():
-            continue
-        book[key] = {}
-        df = pl.read_csv(
-            path,
-            separator="\t",
-            has_header=False,
-            new_columns=["value", "why"],
-            comment_prefix="#",
-            schema={"value": pl.String, "why": pl.String},
-            encoding="utf8",
-        )
-        for value, _ in df.iter_rows():
-            book[key][value] = Entry(value)
-        log.debug("Filter book for %s is %i entries big.", key, len(book[key]))
-    return book
+def __getattr__(name: str):
+    # The processing functions are looked up in engine on first use, so
+    # importing this module stays as cheap as running --help.
+    if name.startswith("__"):
+        raise AttributeError(name)
+    return getattr(importlib.import_module("engine"), name)
 
 
 def main() -> None:
     """Entry point executed by the CLI."""
+    parser = build_parser()
     args = parser.parse_args()
-    source = load_module(args.source, "sources")
-    get_data = getattr(source, "get", None)
-    if get_data is None:
-        raise ImportError(f'function not found "get" ({args.source})')
-
-    # All current sources expose a ``get`` function that returns a Polars
-    # DataFrame directly.
-    df = get_data()
-    keys = list(df.columns)
-    log.debug("Keys are %s", ", ".join(keys))
-
-    rulebook = load_rules(args.source, keys)
-    enhancebook, enhanced = load_enhancements(args.source, keys)
-    filterbook = load_filters(args.source, keys)
-
-    filtered = 0
-    len_data = df.height
-    for key, filters in filterbook.items():
-        values = list(filters.keys())
-        vc = df.filter(pl.col(key).is_in(values)).get_column(key).value_counts()
-        for row in vc.rows():
-            filters[row[0]].count = row[1]
-            filtered += row[1]
-        df = df.filter(~pl.col(key).is_in(values))
-
-    substitutions = 0
-    for key, mapping in rulebook.items():
-        if not mapping:
-            continue
-        replace_map = {k: v.value for k, v in mapping.items()}
-        vc = (
-            df.filter(pl.col(key).is_in(list(replace_map.keys())))
-            .get_column(key)
-            .value_counts()
-        )
-        for row in vc.rows():
-            mapping[row[0]].count = row[1]
-            substitutions += row[1]
-        df = df.with_columns(pl.col(key).replace(replace_map).alias(key))
-
-    for key, targets in enhancebook.items():
-        for target, mapping in targets.items():
-            replace_map = {k: v.value for k, v in mapping.items()}
-            vc = (
-                df.filter(pl.col(key).is_in(list(replace_map.keys())))
-                .get_column(key)
-                .value_counts()
-            )
-            for row in vc.rows():
-                mapping[row[0]].count = row[1]
-            df = df.with_columns(
-                pl.when(pl.col(key).is_in(list(replace_map.keys())))
-                .then(pl.col(key).replace(replace_map))
-                .otherwise(pl.col(target))
-                .alias(target)
-            )
-
-    for col in enhanced:
-        for row in df.filter(pl.col(col).is_null()).rows(named=True):
-            log.error("No enhancement found for %s in row %s", col, row)
-
-    df.write_csv(args.output)
-    args.output.close()
-
-    log.info(
-        "%d values out of %d dropped, %.2f%%", filtered, len_data, filtered / len_data
-    )
-    log.info(
-        "%d values out of %d replaced, %.2f%%",
-        substitutions,
-        df.height,
-        substitutions / df.height,
-    )
-
-    for key, mapping in rulebook.items():
-        for rule, entry in mapping.items():
-            if entry.count == 0:
-                log.info('Did not use [%s] rule "%s" -> "%s"', key, rule, entry.value)
-            else:
-                log.debug("Used [%s] rule %s %d times", key, rule, entry.count)
-
-    for key, targets in enhancebook.items():
-        for enhancement, mapping in targets.items():
-            for tkey, entry in mapping.items():
-                if entry.count == 0:
-                    log.info(
-                        'Did not use enhancement [%s] "%s" -> [%s] "%s"',
-                        key,
-                        tkey,
-                        enhancement,
-                        entry.value,
-                    )
-
-    for key, filters in filterbook.items():
-        for value, entry in filters.items():
-            if entry.count == 0:
-                log.info("Did not use filter [%s] %s", key, value)
+    if args.list_sources:
+        print("\n".join(module_names("sources")))
+        return
+    if args.offline:
+        os.environ["CSVENTRIFUGE_OFFLINE"] = "1"
+    if args.incremental and args.reuse:
+        parser.error("--incremental and --reuse cannot be combined")
+    if args.categorical and args.reuse:
+        parser.error("--categorical and --reuse cannot be combined")
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.batch:
+        pairs = read_batch(args.batch)
+        if not pairs:
+            parser.error("--batch lists no source")
+        for source_name, outputs in pairs:
+            is_valid_source(parser, source_name)
+            for output in outputs:
+                is_valid_output(parser, output)
+    elif args.source is None:
+        parser.error("the following arguments are required: source")
+    else:
+        outputs = [is_valid_output(parser, output) for output in args.output]
+
+    import engine
+    import metrics
+
+    options = {
+        "incremental": args.incremental,
+        "reuse": args.reuse,
+        "categorical": args.categorical,
+        "writer": engine.Writer(args.compression, args.row_group_size),
+        "stage_dir": args.stage_dir,
+    }
+    if args.profile or args.metrics_json:
+        metrics.start(profile=args.profile)
+    try:
+        if args.batch:
+            if not engine.run_batch(pairs, args.jobs, **options):
+                raise SystemExit(1)
+        else:
+            engine.run(args.source, outputs, **options)
+    finally:
+        recorder = metrics.stop()
+        if recorder is not None:
+            if args.profile:
+                for line in recorder.summary():
+                    print(line, file=sys.stderr)
+            if args.metrics_json:
+                recorder.write(args.metrics_json)
 
 
 if __name__ == "__main__":
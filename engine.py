@@ -0,0 +1,1777 @@
+"""
+Filter, rewrite and enhance the data of a source, and write it out.
+
+This is the processing side of csventrifuge.py, which only imports it
+once the command line is validated, as it needs Polars.
+"""
+
+import asyncio
+import contextvars
+import graphlib
+import hashlib
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterable, Callable, Dict, Iterable, Iterator, Mapping, Tuple, Union
+from pathlib import Path
+from types import ModuleType
+import polars as pl
+import polars.selectors as cs
+from polars.io.plugins import register_io_source
+import metrics
+from registry import load_module
+from sources import cache_dir
+
+
+# Typed wrappers
+@dataclass
+class Entry:
+    """Mapping or filter entry that tracks how often it is used."""
+
+    value: str
+    count: int = 0
+
+# Merging consecutive with_columns reorders chained enhancements
+OPTIMIZATIONS = pl.QueryOptFlags(cluster_with_columns=False)
+# Logged under the name of the command, whichever module logs
+log = logging.getLogger("csventrifuge")
+
+
+class Book(Mapping[str, Entry]):
+    """
+    Rule, enhancement or filter file held as columns.
+
+    ``frame`` holds one ``old`` -> ``new`` row per entry and ``counts`` how
+    often each row was used, so no Python object is kept per entry. Looking
+    up a value returns a detached ``Entry``.
+    """
+
+    __slots__ = ("frame", "counts")
+
+    def __init__(self, frame: pl.DataFrame):
+        self.frame = frame
+        self.counts = pl.zeros(frame.height, dtype=pl.UInt64, eager=True)
+
+    @classmethod
+    def from_pairs(cls, pairs: Iterable[Tuple[str, str]]) -> "Book":
+        """Build a book from ``(old, new)`` pairs."""
+        return cls(pl.DataFrame(list(pairs), schema=BOOK_SCHEMA, orient="row"))
+
+    def __len__(self) -> int:
+        return self.frame.height
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.frame.get_column("old"))
+
+    def __getitem__(self, old: str) -> Entry:
+        i = self.frame.get_column("old").index_of(old)
+        if i is None:
+            raise KeyError(old)
+        return Entry(self.frame.get_column("new")[i], self.counts[i])
+
+    def add_counts(self, usage: pl.DataFrame) -> None:
+        """Add the ``count`` of each ``value`` of a value_counts frame."""
+        self.counts += self.frame.get_column("old").replace_strict(
+            usage.get_column("value"), usage.get_column("count"), default=0, return_dtype=pl.UInt64
+        )
+
+    def total(self) -> int:
+        """Return how often the entries of this book were used."""
+        return self.counts.sum()
+
+    def rows(self, used: bool) -> Iterator[Tuple[str, str, int]]:
+        """Iterate over the ``(old, new, count)`` of the used or unused entries."""
+        used_rows = self.counts > 0 if used else self.counts == 0
+        return self.frame.select("old", "new", count=self.counts).filter(used_rows).iter_rows()
+
+
+def fold(values: pl.Series) -> pl.Series:
+    """Lower-case ``values`` and strip their accents."""
+    return values.str.normalize("NFD").str.replace_all(r"\p{Mn}", "").str.to_lowercase()
+
+
+def range_bounds(pattern: str) -> Tuple[Union[float, None], Union[float, None]]:
+    """
+    Return the bounds of the range ``low..high``, either of which may be
+    left out.
+
+    Raises:
+        ValueError: If ``pattern`` is not a range.
+    """
+    low, separator, high = pattern.partition("..")
+    if not separator:
+        raise ValueError(f'not a range "{pattern}"')
+    return float(low) if low else None, float(high) if high else None
+
+
+def matches(kind: str, pattern: Union[str, None], values: pl.Series) -> pl.Series:
+    """Return which ``values`` the pattern entry of ``kind`` matches; nulls only match ``null``."""
+    if kind == "null":
+        return values.is_null()
+    if kind == "literal":
+        hit = values.str.contains(pattern, literal=True)
+    elif kind == "prefix":
+        hit = values.str.starts_with(pattern)
+    elif kind == "suffix":
+        hit = values.str.ends_with(pattern)
+    elif kind == "regex":
+        hit = values.str.contains(pattern)
+    elif kind == "fold":
+        hit = fold(values) == fold(pl.Series([pattern]))[0]
+    else:
+        low, high = range_bounds(pattern)
+        numbers = values.cast(pl.Float64, strict=False)
+        hit = pl.repeat(True, len(values), eager=True)
+        if low is not None:
+            hit = hit & (numbers >= low)
+        if high is not None:
+            hit = hit & (numbers <= high)
+    return hit.fill_null(False)
+
+
+class PatternBook(Book):
+    """
+    Pattern rule file, whose entries rewrite part of the values of a column.
+
+    ``frame`` also holds the ``kind`` of each entry: ``literal`` replaces
+    the ``old`` text wherever it occurs, ``prefix`` and ``suffix`` at the
+    start or end of a value, ``regex`` replaces every match of a regular
+    expression (``$1`` standing for its first group in ``new``), and
+    ``fold`` replaces whole values equal to ``old`` once both are lower-cased
+    and stripped of accents.
+
+    Entries apply in the order of the file, each to the result of those
+    before it. Consecutive literal entries are searched for at once, the
+    first one listed winning where they overlap, and consecutive fold
+    entries share one lookup. An entry is used by each value it changes.
+    """
+
+    __slots__ = ("steps",)
+
+    def __init__(self, frame: pl.DataFrame):
+        super().__init__(frame)
+        self.steps: list[Tuple[str, list[int]]] = []
+        kinds = frame.get_column("kind").to_list()
+        for kind, group in itertools.groupby(range(len(kinds)), key=kinds.__getitem__):
+            rows = list(group)
+            if kind in ("literal", "fold"):
+                self.steps.append((kind, rows))
+            else:
+                self.steps.extend((kind, [row]) for row in rows)
+
+    def step(self, kind: str, rows: list[int], values: pl.Series) -> pl.Series:
+        """Apply the entries ``rows``, all of ``kind``, to ``values``."""
+        old = self.frame.get_column("old").gather(rows)
+        new = self.frame.get_column("new").gather(rows)
+        if kind == "literal":
+            return values.str.replace_many(old.to_list(), new.to_list(), leftmost=True)
+        if kind == "fold":
+            # Entries folding alike: the first one wins
+            lookup = pl.DataFrame({"key": fold(old), "new": new}).unique(
+                "key", keep="first", maintain_order=True
+            )
+            return fold(values).replace_strict(
+                lookup.get_column("key"), lookup.get_column("new"), default=values
+            )
+        old, new = old[0], new[0]
+        if kind == "prefix":
+            rewritten = new + values.str.slice(len(old))
+            return pl.select(
+                pl.when(values.str.starts_with(old)).then(rewritten).otherwise(values)
+            ).to_series()
+        if kind == "suffix":
+            rewritten = values.str.head(-len(old)) + new
+            return pl.select(
+                pl.when(values.str.ends_with(old)).then(rewritten).otherwise(values)
+            ).to_series()
+        return values.str.replace_all(old, new)
+
+    def rewrite(self, values: pl.Series) -> pl.Series:
+        """Return ``values`` rewritten by the entries, which see each distinct value once."""
+        distinct = values.unique(maintain_order=True)
+        rewritten = distinct
+        for kind, rows in self.steps:
+            rewritten = self.step(kind, rows, rewritten)
+        return values.replace_strict(distinct, rewritten, return_dtype=pl.String)
+
+    def add_counts(self, usage: pl.DataFrame) -> None:
+        """Add the ``count`` of each ``value`` to the entries that changed it."""
+        values, counts = usage.get_column("value"), usage.get_column("count")
+        hits = [0] * len(self)
+        for kind, rows in self.steps:
+            rewritten = self.step(kind, rows, values)
+            changed = rewritten.ne_missing(values)
+            for row in rows:
+                hit = changed
+                if kind in ("literal", "fold"):
+                    hit = hit & matches(kind, self.frame.get_column("old")[row], values)
+                hits[row] += counts.filter(hit).sum()
+            values = rewritten
+        self.counts += pl.Series(hits, dtype=pl.UInt64)
+
+
+class PatternFilter(Book):
+    """
+    Pattern filter file, whose entries drop the rows of the values they match.
+
+    ``frame`` also holds the ``kind`` of each entry: those of ``PatternBook``,
+    which match the values ``PatternBook`` would rewrite, ``null``, which
+    matches missing values, and ``range``, which matches the numbers between
+    the bounds of ``low..high``. A dropped row is counted for the first
+    entry matching it.
+    """
+
+    __slots__ = ()
+
+    def entries(self) -> Iterator[Tuple[str, Union[str, None]]]:
+        """Iterate over the ``(kind, old)`` of the entries, in order."""
+        return self.frame.select("kind", "old").iter_rows()
+
+    def matches(self, values: pl.Series) -> pl.Series:
+        """Return which ``values`` an entry matches, testing each distinct value once."""
+        distinct = values.unique(maintain_order=True)
+        hit = pl.repeat(False, len(distinct), eager=True)
+        for kind, old in self.entries():
+            hit = hit | matches(kind, old, distinct)
+        return values.replace_strict(distinct, hit, return_dtype=pl.Boolean)
+
+    def add_counts(self, usage: pl.DataFrame) -> None:
+        """Add the ``count`` of each ``value`` to the first entry matching it."""
+        values, counts = usage.get_column("value"), usage.get_column("count")
+        left = pl.repeat(True, len(values), eager=True)
+        hits = []
+        for kind, old in self.entries():
+            hit = left & matches(kind, old, values)
+            hits.append(counts.filter(hit).sum())
+            left = left & ~hit
+        self.counts += pl.Series(hits, dtype=pl.UInt64)
+
+
+Rulebook = Dict[str, Book]
+EnhanceBook = Dict[str, Dict[str, Book]]
+FilterBook = Dict[str, Book]
+BOOK_SCHEMA = {"old": pl.String, "new": pl.String}
+# Bump when the compiled form of the books changes
+BOOK_FORMAT = 1
+# Joins the values a conditional rule looks up into its ``old`` value
+KEY_SEPARATOR = "\t"
+# Ends the name of pattern rule files, rue.pattern.csv
+PATTERN_SUFFIX = ".pattern"
+PATTERN_KINDS = ("literal", "prefix", "suffix", "regex", "fold")
+FILTER_KINDS = (*PATTERN_KINDS, "null", "range")
+
+
+def rule_columns(name: str) -> Tuple[str, list[str]]:
+    """
+    Return the column a rule file rewrites and the columns it looks up.
+
+    ``rue`` and the pattern rules ``rue.pattern`` rewrite the street from
+    itself; the conditional rule ``rue@localite+rue`` rewrites it from the
+    locality and the street.
+    """
+    target, _, on = name.removesuffix(PATTERN_SUFFIX).partition("@")
+    return target, on.split("+") if on else [target]
+
+
+def filter_columns(name: str) -> list[str]:
+    """Return the columns a filter file looks up: ``localite+rue`` looks up two."""
+    return name.removesuffix(PATTERN_SUFFIX).split("+")
+
+
+def read_book(path: Path, kind: str) -> pl.DataFrame:
+    """
+    Parse a rule, enhancement or filter file into ``old`` and ``new`` columns.
+
+    The values a conditional rule looks up are held in ``old`` joined by
+    ``KEY_SEPARATOR``, as are those of filters on several columns; pattern
+    rules and filters also get the ``kind`` of each entry.
+    """
+    if kind == "rules" and path.stem.endswith(PATTERN_SUFFIX):
+        # Entries are applied in order, so none is dropped, and an empty
+        # replacement removes the pattern
+        df = pl.read_csv(
+            path,
+            separator="\t",
+            has_header=False,
+            new_columns=["kind", "old", "new"],
+            comment_prefix="#",
+            schema={"kind": pl.String, **BOOK_SCHEMA},
+            encoding="utf8",
+        ).select("old", pl.col("new").fill_null(""), "kind")
+        unknown = df.filter(~pl.col("kind").is_in(PATTERN_KINDS)).get_column("kind")
+        if len(unknown):
+            raise ValueError(f'{path}: unknown pattern kind "{unknown[0]}"')
+        return df
+    if kind == "filters" and path.stem.endswith(PATTERN_SUFFIX):
+        # Lines of null entries have no pattern, so they are split here
+        # rather than cut to the width of the first line
+        lines = path.read_text(encoding="utf-8").splitlines()
+        entries = [line.split("\t") + [""] for line in lines if line and not line.startswith("#")]
+        df = pl.DataFrame(
+            [(fields[0], fields[1] or None) for fields in entries],
+            schema={"kind": pl.String, "old": pl.String},
+            orient="row",
+        ).select("old", new="old", kind="kind")
+        for kind, old in df.select("kind", "old").iter_rows():
+            if kind not in FILTER_KINDS:
+                raise ValueError(f'{path}: unknown pattern kind "{kind}"')
+            if kind == "range":
+                try:
+                    range_bounds(old or "")
+                except ValueError:
+                    raise ValueError(f'{path}: range "{old}" is not "low..high"') from None
+        return df
+    if kind == "filters":
+        # The "why" column is optional, so only the columns of the values are read.
+        on = filter_columns(path.stem)
+        df = pl.read_csv(
+            path,
+            separator="\t",
+            has_header=False,
+            comment_prefix="#",
+            infer_schema_length=0,
+            truncate_ragged_lines=True,
+            encoding="utf8",
+        )
+        old = pl.concat_str(df.columns[: len(on)], separator=KEY_SEPARATOR)
+        df = df.select(old.alias("old"), old.alias("new"))
+    else:
+        on = rule_columns(path.stem)[1] if kind == "rules" else ["old"]
+        names = [f"__key_{i}" for i in range(len(on))]
+        df = pl.read_csv(
+            path,
+            separator="\t",
+            has_header=False,
+            comment_prefix="#",
+            schema=dict.fromkeys([*names, "new"], pl.String),
+            encoding="utf8",
+        ).select(pl.concat_str(names, separator=KEY_SEPARATOR).alias("old"), "new")
+    # When a value is listed twice, the last entry wins
+    return df.unique(subset="old", keep="last", maintain_order=True)
+
+
+# Books already loaded by this process, so sources sharing a rule file
+# (directly, through a symlink or as a copy) parse it once in batch mode.
+# Keyed on the name and content, as the name tells how to parse the file;
+# the content hash of a file is kept while its size and mtime stay the same.
+_loaded_books: Dict[Tuple[str, str, str], pl.DataFrame] = {}
+_book_digests: Dict[Tuple[str, str, int, int], str] = {}
+_loaded_books_lock = threading.Lock()
+
+
+def load_book(path: Path, kind: str) -> Book:
+    """
+    Load a rule, enhancement or filter file through the compiled book cache.
+
+    The compiled form is stored as Arrow IPC, keyed by the path of the file.
+    It is reused while the file keeps the same mtime and size, or the same
+    content hash.
+    """
+    stat = path.stat()
+    seen = (kind, str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    with _loaded_books_lock:
+        if seen not in _book_digests:
+            info = book_cache(path, kind)[2]
+            if info.get("mtime_ns") == stat.st_mtime_ns and info.get("size") == stat.st_size:
+                digest = info["sha256"]
+            else:
+                digest = hashlib.sha256(path.read_bytes()).hexdigest()
+            loaded = (kind, path.name, digest)
+            if loaded not in _loaded_books:
+                _loaded_books[loaded] = compiled_book(path, kind, stat, digest)
+            _book_digests[seen] = digest
+        return Book(_loaded_books[kind, path.name, _book_digests[seen]])
+
+
+def book_cache(path: Path, kind: str) -> Tuple[Path, Path, Dict[str, object]]:
+    """Return the compiled form and metadata paths of a book file, and the metadata if current."""
+    key = hashlib.sha256(f"{kind}:{path.resolve()}".encode()).hexdigest()[:32]
+    cached = cache_dir() / "books" / key
+    compiled, meta = cached.with_suffix(".arrow"), cached.with_suffix(".json")
+    info = {}
+    if compiled.exists() and meta.exists():
+        info = json.loads(meta.read_text(encoding="utf-8"))
+    if info.get("format") != BOOK_FORMAT:
+        info = {}
+    return compiled, meta, info
+
+
+def compiled_book(path: Path, kind: str, stat: os.stat_result, digest: str) -> pl.DataFrame:
+    """Return the compiled form of a book file hashing to ``digest``, from the cache if current."""
+    compiled, meta, info = book_cache(path, kind)
+    if info.get("mtime_ns") == stat.st_mtime_ns and info.get("size") == stat.st_size:
+        return pl.read_ipc(compiled)
+
+    if info.get("sha256") == digest:
+        frame = pl.read_ipc(compiled)
+    else:
+        log.debug("Compiling %s", path)
+        frame = read_book(path, kind)
+        compiled.parent.mkdir(parents=True, exist_ok=True)
+        partial = compiled.with_suffix(f".{os.getpid()}.tmp")
+        frame.write_ipc(partial)
+        partial.replace(compiled)
+    meta.write_text(
+        json.dumps(
+            {
+                "format": BOOK_FORMAT,
+                "path": str(path),
+                "mtime_ns": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "sha256": digest,
+            }
+        ),
+        encoding="utf-8",
+    )
+    return frame
+
+
+def load_rules(source: str, keys: Iterable[str]) -> Rulebook:
+    """
+    Load rule CSV files for the given source: ``<key>.csv`` and the pattern
+    rules ``<key>.pattern.csv`` for each key, then the conditional rules
+    named ``<key>@<key>+<key>.csv``.
+    """
+    keys = list(keys)
+    book: Rulebook = {}
+    for key in keys:
+        path = Path("rules") / source / f"{key}.csv"
+        if not path.exists():
+            continue
+        book[key] = load_book(path, "rules")
+    for key in keys:
+        path = Path("rules") / source / f"{key}{PATTERN_SUFFIX}.csv"
+        if path.exists():
+            book[path.stem] = PatternBook(load_book(path, "rules").frame)
+    for path in sorted((Path("rules") / source).glob("*@*.csv")):
+        target, on = rule_columns(path.stem)
+        unknown = [col for col in (target, *on) if col not in keys]
+        if unknown:
+            log.warning("Skipping %s: no column %s", path, ", ".join(unknown))
+            continue
+        book[path.stem] = load_book(path, "rules")
+        log.debug("Rule book for %s is %i entries big.", path.stem, len(book[path.stem]))
+    return book
+
+
+def load_enhancements(source: str, keys: list[str]) -> Tuple[EnhanceBook, set[str]]:
+    """
+    Load enhancement CSV files for the given source, in the order of
+    ``enhancement_levels``.
+    """
+    book: EnhanceBook = {}
+    enhanced: set[str] = set()
+    # Targets are appended to keys, so enhancements keyed on them are found too
+    for key in keys:
+        enhancepath = Path("enhance") / source / key
+        if not enhancepath.is_dir():
+            continue
+        book[key] = {}
+        for filename in sorted(os.listdir(enhancepath)):
+            filepath = enhancepath / filename
+            target = filepath.stem
+            if target not in keys:
+                keys.append(target)
+            enhanced.add(target)
+            book[key][target] = load_book(filepath, "enhance")
+        log.debug("Enhance book for %s: %s", key, ", ".join(book[key].keys()))
+    levels = enhancement_levels(book)
+    log.debug("Enhancement levels: %s", " | ".join(", ".join(level) for level in levels))
+    return {key: book[key] for level in levels for key in level}, enhanced
+
+
+def enhancement_levels(enhancebook: EnhanceBook) -> list[list[str]]:
+    """
+    Group the keys of the enhancements into levels, each only looking up
+    columns that the levels before it are done writing.
+
+    An enhancement keyed on a column that other enhancements write runs
+    after all of them, so chains see the corrected values. Keys of a level
+    are sorted, which is the order they are applied in.
+
+    Raises:
+        ValueError: If the enhancements form a cycle.
+    """
+    graph: Dict[str, set[str]] = {key: set() for key in enhancebook}
+    for key, targets in enhancebook.items():
+        for target in targets:
+            graph.setdefault(target, set())
+            # Rewriting the key itself only reads the value from before
+            if target != key:
+                graph[target].add(key)
+    sorter = graphlib.TopologicalSorter(graph)
+    try:
+        sorter.prepare()
+    except graphlib.CycleError as error:
+        raise ValueError(f"enhancements form a cycle: {' -> '.join(error.args[1])}") from None
+    levels = []
+    while sorter.is_active():
+        ready = sorted(sorter.get_ready())
+        sorter.done(*ready)
+        level = [key for key in ready if key in enhancebook]
+        if level:
+            levels.append(level)
+    return levels
+
+
+def load_filters(source: str, keys: Iterable[str]) -> FilterBook:
+    """
+    Load filter CSV files for the given source: ``<key>.csv`` and the
+    pattern filters ``<key>.pattern.csv`` for each key, then the filters on
+    several columns named ``<key>+<key>.csv``.
+    """
+    keys = list(keys)
+    book: FilterBook = {}
+    for key in keys:
+        path = Path("filters") / source / f"{key}.csv"
+        if path.exists():
+            book[key] = load_book(path, "filters")
+            log.debug("Filter book for %s is %i entries big.", key, len(book[key]))
+        path = Path("filters") / source / f"{key}{PATTERN_SUFFIX}.csv"
+        if path.exists():
+            book[path.stem] = PatternFilter(load_book(path, "filters").frame)
+    for path in sorted((Path("filters") / source).glob("*+*.csv")):
+        unknown = [col for col in filter_columns(path.stem) if col not in keys]
+        if path.stem.endswith(PATTERN_SUFFIX):
+            log.warning("Skipping %s: pattern filters look up a single column", path)
+            continue
+        if unknown:
+            log.warning("Skipping %s: no column %s", path, ", ".join(unknown))
+            continue
+        book[path.stem] = load_book(path, "filters")
+        log.debug("Filter book for %s is %i entries big.", path.stem, len(book[path.stem]))
+    return book
+
+
+def load_books(
+    source: str, keys: list[str]
+) -> Tuple[Rulebook, EnhanceBook, set[str], FilterBook]:
+    """Load the rules, enhancements and filters of a source, measuring each."""
+    with metrics.step("load_rules") as step:
+        rulebook = load_rules(source, keys)
+        step.rows_out = sum(len(book) for book in rulebook.values())
+    with metrics.step("load_enhancements") as step:
+        enhancebook, enhanced = load_enhancements(source, keys)
+        step.rows_out = sum(
+            len(book) for targets in enhancebook.values() for book in targets.values()
+        )
+    with metrics.step("load_filters") as step:
+        filterbook = load_filters(source, keys)
+        step.rows_out = sum(len(book) for book in filterbook.values())
+    return rulebook, enhancebook, enhanced, filterbook
+
+
+def book_metrics(
+    filterbook: FilterBook, rulebook: Rulebook, enhancebook: EnhanceBook
+) -> list[Dict[str, Union[str, int]]]:
+    """Return the size and usage of every book, for the metrics report."""
+    books = [("filters", key, "", book) for key, book in filterbook.items()]
+    books += [("rules", key, "", book) for key, book in rulebook.items()]
+    books += [
+        ("enhance", key, target, book)
+        for key, targets in enhancebook.items()
+        for target, book in targets.items()
+    ]
+    return [
+        {"kind": kind, "key": key, "target": target, "entries": len(book), "hits": book.total()}
+        for kind, key, target, book in books
+    ]
+
+
+def scan_source(source: ModuleType, name: str) -> pl.LazyFrame:
+    """
+    Return the data of a source module as a lazy frame.
+
+    Sources that can be read lazily expose a ``scan`` function returning a
+    ``polars.LazyFrame``; the others expose ``get`` returning a DataFrame.
+    The frames of sources only exposing ``batches`` are gathered here.
+    """
+    scan_data = getattr(source, "scan", None)
+    if scan_data is not None:
+        return scan_data()
+    get_data = getattr(source, "get", None)
+    if get_data is not None:
+        return get_data().lazy()
+    if getattr(source, "batches", None) is not None:
+        return pl.concat(list(read_batches(source.batches()))).lazy()
+    raise ImportError(f'function not found "get" ({name})')
+
+
+def encode(
+    lf: pl.LazyFrame, columns: Iterable[str], rulebook: Rulebook, enhancebook: EnhanceBook
+) -> Tuple[pl.DataFrame, Dict[str, pl.Series]]:
+    """
+    Collect ``lf`` with ``columns`` dictionary-encoded as ``polars.Enum``.
+
+    The dictionary of a column holds its distinct values and those the
+    rules and enhancements write into it, pattern rules rewriting the
+    distinct values, sorted so the encoded column
+    sorts as the strings did. Returns the frame and the dictionaries.
+    """
+    columns = list(columns)
+    distinct = lf.select(pl.col(col).unique().implode() for col in columns).collect(
+        optimizations=OPTIMIZATIONS
+    )
+    written: Dict[str, list[pl.Series]] = {col: [] for col in columns}
+    for name, book in rulebook.items():
+        target = rule_columns(name)[0]
+        if isinstance(book, PatternBook) and target in written:
+            written[target].append(book.rewrite(distinct.get_column(target).explode()))
+        elif target in written:
+            written[target].append(book.frame.get_column("new"))
+    for targets in enhancebook.values():
+        for target, book in targets.items():
+            if target in written:
+                written[target].append(book.frame.get_column("new"))
+    dictionaries = {
+        col: pl.concat([distinct.get_column(col).explode(), *written[col]])
+        .drop_nulls()
+        .unique()
+        .sort()
+        for col in columns
+    }
+    # Scanned again rather than collected first, so the strings are never
+    # all held in memory
+    frame = lf.with_columns(
+        pl.col(col).cast(pl.Enum(values)) for col, values in dictionaries.items()
+    ).collect(optimizations=OPTIMIZATIONS)
+    return frame, dictionaries
+
+
+def decode(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Turn the encoded columns of ``lf`` back into strings."""
+    return lf.with_columns(cs.enum().cast(pl.String))
+
+
+@dataclass
+class Writer:
+    """
+    Writes the output of a source to files in the format named by their
+    extension: Parquet, Arrow IPC, NDJSON or CSV for anything else.
+
+    All the files are written from the same pass over the data.
+    """
+
+    compression: str = "zstd"
+    row_group_size: Union[int, None] = None
+
+    def sink(self, lf: pl.LazyFrame, path: Path) -> pl.LazyFrame:
+        """Return the lazy sink writing ``lf`` to ``path``."""
+        suffix = path.suffix.lower()
+        if suffix == ".parquet":
+            return lf.sink_parquet(
+                path, compression=self.compression, row_group_size=self.row_group_size, lazy=True
+            )
+        if suffix in (".arrow", ".ipc", ".feather"):
+            # Left uncompressed, so readers can map it without copying
+            return lf.sink_ipc(path, compression="uncompressed", lazy=True)
+        if suffix in (".ndjson", ".jsonl"):
+            return lf.sink_ndjson(path, lazy=True)
+        return lf.sink_csv(path, check_extension=False, lazy=True)
+
+    def write(self, data: Union[pl.LazyFrame, pl.DataFrame], paths: Iterable[Path]) -> None:
+        """Write the rows of ``data`` to every path."""
+        lf = data.lazy()
+        pl.collect_all(
+            [self.sink(lf, Path(path)) for path in paths], optimizations=OPTIMIZATIONS
+        )
+
+
+def load_stages(source: str) -> list[Callable[[pl.LazyFrame, Path], None]]:
+    """Return the output stages of a source, from ``stages/<source>.py``."""
+    if not (Path(__file__).parent / "stages" / f"{source}.py").exists():
+        return []
+    return list(load_module(source, "stages").STAGES)
+
+
+def publish(
+    data: Union[pl.LazyFrame, pl.DataFrame],
+    outputs: Iterable[Union[str, Path]],
+    writer: Writer,
+    stages: list[Callable[[pl.LazyFrame, Path], None]],
+    directory: Union[Path, None],
+) -> None:
+    """
+    Write the outputs and run the output stages on the same data.
+
+    With stages, the data is collected once and shared by the writer and
+    the stages, which all run at the same time.
+    """
+    if not stages:
+        writer.write(data, outputs)
+        return
+    frame = data.lazy().collect(optimizations=OPTIMIZATIONS)
+    directory = directory or Path(".")
+    directory.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=len(stages) + 1) as pool:
+        futures = [pool.submit(writer.write, frame, outputs)]
+        futures += [pool.submit(stage, decode(frame.lazy()), directory) for stage in stages]
+        for future in futures:
+            future.result()
+
+
+# Frames a stage of the pipeline may get ahead of the next one by
+QUEUE_SIZE = 4
+
+
+class Closed(Exception):
+    """Raised in the producer of a pipe whose consumer stopped reading."""
+
+
+class Pipe:
+    """
+    Bounded queue of frames handed from one thread to another.
+
+    ``put`` blocks while the queue is full, so a producer never gets more
+    than ``size`` frames ahead of its consumer. The producer ends the pipe
+    with ``end``, passing on the error that stopped it if any; a consumer
+    giving up calls ``close``, which makes the next ``put`` raise
+    ``Closed`` instead of blocking for ever.
+    """
+
+    _END = object()
+
+    def __init__(self, size: int = QUEUE_SIZE):
+        self.queue: queue.Queue = queue.Queue(size)
+        self.closed = threading.Event()
+
+    def put(self, item: object) -> None:
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise Closed
+
+    def end(self, error: Union[BaseException, None] = None) -> None:
+        try:
+            self.put(self._END if error is None else error)
+        except Closed:
+            pass
+
+    def close(self) -> None:
+        self.closed.set()
+
+    def __iter__(self) -> Iterator[pl.DataFrame]:
+        while True:
+            item = self.queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+
+def feed(batches: Union[Iterable[pl.DataFrame], AsyncIterable[pl.DataFrame]], pipe: Pipe) -> None:
+    """Put the frames of an iterator, or of an asynchronous one, into ``pipe``."""
+    try:
+        if isinstance(batches, AsyncIterable):
+
+            async def drain() -> None:
+                async for frame in batches:
+                    # Waiting for room off the event loop lets the source keep going
+                    await asyncio.to_thread(pipe.put, frame)
+
+            asyncio.run(drain())
+        else:
+            for frame in batches:
+                pipe.put(frame)
+    except Closed:
+        return
+    except BaseException as error:
+        pipe.end(error)
+        return
+    pipe.end()
+
+
+def read_batches(
+    batches: Union[Iterable[pl.DataFrame], AsyncIterable[pl.DataFrame]],
+) -> Iterator[pl.DataFrame]:
+    """Yield the frames of ``batches``, which a thread reads ahead of the caller."""
+    pipe = Pipe()
+    # The source keeps recording its steps under the current source
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(feed, batches, pipe), daemon=True).start()
+    try:
+        yield from pipe
+    finally:
+        pipe.close()
+
+
+def pipe_source(pipe: Pipe, schema: pl.Schema) -> pl.LazyFrame:
+    """Return a lazy frame of the frames of ``pipe``, which can be collected once."""
+
+    def frames(
+        with_columns: Union[list[str], None],
+        predicate: Union[pl.Expr, None],
+        n_rows: Union[int, None],
+        batch_size: Union[int, None],
+    ) -> Iterator[pl.DataFrame]:
+        try:
+            for frame in pipe:
+                if with_columns is not None:
+                    frame = frame.select(with_columns)
+                if predicate is not None:
+                    frame = frame.filter(predicate)
+                yield frame
+        finally:
+            pipe.close()
+
+    return register_io_source(frames, schema=schema)
+
+
+@dataclass
+class Plan:
+    """
+    Filter, rule and enhancement books compiled into hash joins and one set
+    of expressions.
+
+    Every book is joined on the values it looks up, the leading columns of
+    its frame, which adds its ``old`` and ``new`` columns to the rows it
+    matches; ``columns`` then picks the rewritten values from those columns.
+    """
+
+    keep: pl.Expr
+    joins: list[Tuple[list[pl.Expr], pl.LazyFrame]]
+    columns: Dict[str, pl.Expr]
+    helpers: list[str]
+    aggregations: list[pl.Expr]
+    counters: list[Tuple[str, Book]]
+    filter_counters: list[str]
+    rule_counters: list[str]
+    missing: Dict[str, str]
+
+    def join(self, lf: pl.LazyFrame) -> pl.LazyFrame:
+        """Join the books onto the rows of ``lf``."""
+        for left_on, book in self.joins:
+            lf = lf.join(
+                book,
+                left_on=left_on,
+                right_on=book.collect_schema().names()[: len(left_on)],
+                how="left",
+                validate="m:1",
+                coalesce=False,
+                maintain_order="left",
+            )
+        return lf
+
+    def apply(self, lf: pl.LazyFrame) -> pl.LazyFrame:
+        """Return the filtered and rewritten rows of ``lf``."""
+        return self.join(lf.filter(self.keep)).with_columns(**self.columns).drop(self.helpers)
+
+    def usage(self, lf: pl.LazyFrame) -> pl.LazyFrame:
+        """Return the one-row frame of usage counters of ``lf``."""
+        return self.join(lf).select(self.aggregations)
+
+
+def compile_books(
+    keys: Iterable[str],
+    filterbook: FilterBook,
+    rulebook: Rulebook,
+    enhancebook: EnhanceBook,
+    enhanced: Iterable[str],
+    lookups: Mapping[Tuple[str, str], str] = {},
+    dictionaries: Mapping[str, pl.Series] = {},
+) -> Plan:
+    """
+    Compile the books into a filter predicate, one left join per rule or
+    enhancement book, and one expression per rewritten column.
+
+    Each stage reads the expressions of the stages before it instead of a
+    materialised column, so the whole chain runs in one ``with_columns``.
+    The usage of every entry is read from the join columns by aggregations
+    that are evaluated together in a single pass over the data. The value
+    an enhancement looks up is kept in the column ``lookups`` names for
+    its ``(key, target)``, if any.
+
+    Books on a column encoded by ``encode`` are applied to the values of
+    its dictionary rather than joined: each row only looks up the result
+    of its code. Conditional rules, looking up several columns, are joined
+    on all of them at once, and filters on several columns look them up
+    together.
+    """
+    keep = pl.lit(True)
+    joins: list[Tuple[list[pl.Expr], pl.LazyFrame]] = []
+    columns: Dict[str, pl.Expr] = {}
+    helpers: list[str] = []
+    aggregations = [pl.len().alias("__rows")]
+    counters: list[Tuple[str, Book]] = []
+
+    def current(col: str) -> pl.Expr:
+        return columns.get(col, pl.col(col))
+
+    def count(expr: pl.Expr, hit: pl.Expr, book: Book) -> str:
+        name = f"__count_{len(counters)}"
+        aggregations.append(
+            expr.filter(keep & hit).alias("value").value_counts().implode().alias(name)
+        )
+        counters.append((name, book))
+        return name
+
+    def join(key: str, books: list[Book]) -> Tuple[pl.Expr, list[Tuple[pl.Expr, pl.Expr]]]:
+        """Join the books of ``key`` at once; return the looked up value, and each new and hit."""
+        old = f"__old_{len(joins)}"
+        if len(books) == 1:
+            new = f"__new_{len(joins)}"
+            joins.append(([current(key)], books[0].frame.lazy().rename({"old": old, "new": new})))
+            helpers.extend((old, new))
+            return pl.col(old), [(pl.col(new), pl.col(old).is_not_null())]
+        # Entries may map to null, so each book marks the values it holds
+        frame = None
+        found = []
+        for i, book in enumerate(books):
+            new, hit = f"__new_{len(joins)}_{i}", f"__hit_{len(joins)}_{i}"
+            part = book.frame.lazy().rename({"old": old, "new": new}).with_columns(
+                pl.lit(True).alias(hit)
+            )
+            frame = part if frame is None else frame.join(part, on=old, how="full", coalesce=True)
+            helpers.extend((new, hit))
+            found.append((pl.col(new), pl.col(hit).is_not_null()))
+        joins.append(([current(key)], frame))
+        helpers.append(old)
+        return pl.col(old), found
+
+    def join_on(on: list[str], book: Book) -> Tuple[pl.Expr, pl.Expr, pl.Expr]:
+        """Join a conditional rule on all of its columns; return its old, new and hit."""
+        n = len(joins)
+        old, new = f"__old_{n}", f"__new_{n}"
+        names = [f"__key_{n}_{i}" for i in range(len(on))]
+        frame = (
+            book.frame.lazy()
+            .rename({"old": old, "new": new})
+            .with_columns(
+                pl.col(old)
+                .str.split_exact(KEY_SEPARATOR, len(on) - 1)
+                .struct.rename_fields(names)
+                .alias("__keys")
+            )
+            .unnest("__keys")
+            .select(*names, old, new)
+        )
+        # The books hold strings, so encoded columns are joined decoded
+        left_on = [
+            pl.col(col).cast(pl.String) if col in dictionaries else pl.col(col) for col in on
+        ]
+        joins.append((left_on, frame))
+        helpers.extend((*names, old, new))
+        return pl.col(old), pl.col(new), pl.col(old).is_not_null()
+
+    dtypes = {col: pl.Enum(values) for col, values in dictionaries.items()}
+
+    def by_code(key: str, values: pl.Series) -> pl.Expr:
+        return pl.lit(values).gather(current(key).to_physical())
+
+    def hits(key: str, book: Book) -> pl.Expr:
+        return by_code(key, dictionaries[key].is_in(book.frame.get_column("old").implode()))
+
+    def lookup(key: str, book: Book, dtype: Union[pl.Enum, None]) -> pl.Series:
+        old, new = book.frame.get_column("old"), book.frame.get_column("new")
+        return dictionaries[key].replace_strict(old, new, default=None, return_dtype=dtype)
+
+    # Filters are hash lookups, of one or several columns, or patterns
+    # tested once per distinct value, so together they make one predicate.
+    # A missing value gives null in the lookup of a <column>.csv filter,
+    # which drops the row without counting it, as these filters always
+    # have. Pattern filters only drop it for a null entry, and filters on
+    # several columns never do. A row several filters match counts for
+    # the first.
+    filter_counters = []
+    for name, filters in filterbook.items():
+        on = filter_columns(name)
+        key = on[0]
+        old = pl.col(key)
+        if isinstance(filters, PatternFilter) and key in dictionaries:
+            null = filters.matches(pl.Series([None], dtype=pl.String))[0]
+            hit = by_code(key, filters.matches(dictionaries[key])).fill_null(null)
+        elif isinstance(filters, PatternFilter):
+            hit = old.map_batches(filters.matches, return_dtype=pl.Boolean, is_elementwise=True)
+        elif len(on) > 1:
+            # The books hold strings, so encoded columns are looked up decoded
+            values = [
+                pl.col(col).cast(pl.String) if col in dictionaries else pl.col(col) for col in on
+            ]
+            entries = filters.frame.get_column("old").str.split_exact(KEY_SEPARATOR, len(on) - 1)
+            hit = pl.struct(values).is_in(entries.struct.rename_fields(on).implode())
+            old = pl.concat_str(values, separator=KEY_SEPARATOR)
+        elif key in dictionaries:
+            hit = hits(key, filters)
+        else:
+            hit = old.is_in(filters.frame.get_column("old").implode())
+        filter_counters.append(count(old, hit, filters))
+        keep = keep & ~hit
+    # Without filters keep is a literal, which would be summed once
+    aggregations.append(pl.repeat(True, pl.len()).filter(keep).len().alias("__kept"))
+
+    # Rules all look up the values of the source. Conditional rules are
+    # more precise than the rule of the column they rewrite, which lists
+    # the exceptions to its pattern rules, and the first rule to match a
+    # row wins.
+    rule_counters = []
+    conditional, plain, patterns = [], [], []
+    for name, book in rulebook.items():
+        if not book:
+            continue
+        target, on = rule_columns(name)
+        if isinstance(book, PatternBook):
+            # Rewritten once per distinct value, of the frame or dictionary
+            if target in dictionaries:
+                rewritten = book.rewrite(dictionaries[target])
+                new = by_code(target, rewritten)
+                hit = by_code(target, rewritten.ne_missing(dictionaries[target]))
+            else:
+                new = pl.col(target).map_batches(
+                    book.rewrite, return_dtype=pl.String, is_elementwise=True
+                )
+                hit = new.ne_missing(pl.col(target))
+            patterns.append((target, pl.col(target), new, hit, book))
+        elif name != target:
+            old, new, hit = join_on(on, book)
+            conditional.append((target, old, new, hit, book))
+        elif target in dictionaries:
+            old, new = book.frame.get_column("old"), book.frame.get_column("new")
+            rewritten = dictionaries[target].replace(old, new)
+            new, hit = by_code(target, rewritten), hits(target, book)
+            plain.append((target, pl.col(target), new, hit, book))
+        else:
+            old, [(new, hit)] = join(target, [book])
+            plain.append((target, old, new, hit, book))
+    matched: Dict[str, pl.Expr] = {}
+    for target, old, new, hit, book in conditional + plain + patterns:
+        if target in matched:
+            hit, matched[target] = hit & ~matched[target], matched[target] | hit
+        else:
+            matched[target] = hit
+        rule_counters.append(count(old, hit, book))
+        if target in dtypes:
+            new = new.cast(dtypes[target])
+        columns[target] = pl.when(hit).then(new).otherwise(current(target))
+
+    # A level reads no column it writes, so its books all look up the
+    # values left by the levels before it, and share a join per key. A
+    # column several enhancements write keeps the first match: the keys
+    # of earlier levels determine the later ones, so they are more precise.
+    matched = {}
+    for level in enhancement_levels(enhancebook):
+        for key in level:
+            targets = enhancebook[key]
+            for target in targets:
+                if (key, target) in lookups:
+                    columns[lookups[key, target]] = current(key)
+            if key in dictionaries:
+                old = current(key)
+                found = [
+                    (by_code(key, lookup(key, book, dtypes.get(target))), hits(key, book))
+                    for target, book in targets.items()
+                ]
+            else:
+                old, found = join(key, list(targets.values()))
+                found = [
+                    (new.cast(dtypes[target]) if target in dtypes else new, hit)
+                    for target, (new, hit) in zip(targets, found)
+                ]
+            for (target, book), (new, hit) in zip(targets.items(), found):
+                if target in matched:
+                    hit, matched[target] = hit & ~matched[target], matched[target] | hit
+                else:
+                    matched[target] = hit
+                count(old, hit, book)
+                columns[target] = pl.when(hit).then(new).otherwise(current(target))
+
+    # Rows left without an enhanced value are logged, so they are gathered
+    # in the same pass as the counters.
+    missing: Dict[str, str] = {}
+    for col in enhanced:
+        missing[col] = f"__missing_{len(missing)}"
+        aggregations.append(
+            pl.struct([current(key).alias(key) for key in keys])
+            .filter(keep & current(col).is_null())
+            .implode()
+            .alias(missing[col])
+        )
+
+    return Plan(
+        keep=keep,
+        joins=joins,
+        columns={col: expr.alias(col) for col, expr in columns.items()},
+        helpers=helpers,
+        aggregations=aggregations,
+        counters=counters,
+        filter_counters=filter_counters,
+        rule_counters=rule_counters,
+        missing=missing,
+    )
+
+
+STATE_FORMAT = 1
+ROW_HASH = "__row_hash"
+
+
+def books_fingerprint(
+    keys: Iterable[str], filterbook: FilterBook, rulebook: Rulebook, enhancebook: EnhanceBook
+) -> str:
+    """
+    Identify the books a source is processed with, together with its keys.
+
+    Rows processed under another fingerprint cannot be reused.
+    """
+    digest = hashlib.sha256(f"{STATE_FORMAT}:{pl.__version__}:{','.join(keys)}".encode())
+    books = [("filters", key, book) for key, book in filterbook.items()]
+    books += [("rules", key, book) for key, book in rulebook.items()]
+    books += [
+        ("enhance", f"{key}/{target}", book)
+        for key, targets in enhancebook.items()
+        for target, book in targets.items()
+    ]
+    for kind, name, book in books:
+        digest.update(f"\n{kind}:{name}\n".encode())
+        digest.update(book.frame.write_csv().encode())
+    return digest.hexdigest()
+
+
+def key_columns(key: Iterable[str]) -> list[str]:
+    """Return the names of the columns holding the unmodified row key."""
+    return [f"__key_{col}" for col in key]
+
+
+@dataclass
+class Snapshot:
+    """
+    The input and output of the previous run of a source, kept for
+    incremental runs.
+
+    ``inputs`` holds the key and hash of every input row, ``outputs`` the
+    rows written for them, both keyed on the unmodified key columns.
+    """
+
+    directory: Path
+    key: list[str]
+    fingerprint: str
+
+    def load(self) -> Union[Tuple[pl.DataFrame, pl.DataFrame], None]:
+        """Return the previous inputs and outputs, if they were written under the same books."""
+        state = self.directory / "state.json"
+        if not state.exists():
+            return None
+        info = json.loads(state.read_text(encoding="utf-8"))
+        if info.get("fingerprint") != self.fingerprint or info.get("key") != self.key:
+            log.info("Books or key of %s changed, processing it in full", self.directory.name)
+            return None
+        return (
+            pl.read_ipc(self.directory / "input.arrow"),
+            pl.read_ipc(self.directory / "output.arrow"),
+        )
+
+    def save(self, inputs: pl.DataFrame, outputs: pl.DataFrame, changes: dict) -> None:
+        """Replace the snapshot; the state file is written last, so a partial save is ignored."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / "state.json").unlink(missing_ok=True)
+        for name, frame in (("input", inputs), ("output", outputs)):
+            partial = self.directory / f"{name}.{os.getpid()}.tmp"
+            frame.write_ipc(partial)
+            partial.replace(self.directory / f"{name}.arrow")
+        (self.directory / "changes.json").write_text(json.dumps(changes), encoding="utf-8")
+        (self.directory / "state.json").write_text(
+            json.dumps({"fingerprint": self.fingerprint, "key": self.key}), encoding="utf-8"
+        )
+
+
+def delta(
+    lf: pl.LazyFrame, key: list[str], previous: Union[Tuple[pl.DataFrame, pl.DataFrame], None]
+) -> Tuple[pl.DataFrame, pl.DataFrame, Dict[str, pl.DataFrame]]:
+    """
+    Hash the rows of ``lf`` and compare them with the previous inputs.
+
+    Returns the hashed inputs, the inserted and updated rows (all rows if
+    there is no previous run), and the keys of the inserted, updated and
+    deleted rows.
+    """
+    columns = lf.collect_schema().names()
+    keys = key_columns(key)
+    rows = lf.with_columns(
+        pl.struct(columns).hash().alias(ROW_HASH),
+        *(pl.col(col).alias(name) for col, name in zip(key, keys)),
+    ).collect(optimizations=OPTIMIZATIONS)
+    inputs = rows.select(*keys, ROW_HASH)
+    if previous is None:
+        return inputs, rows, {"inserted": inputs.select(keys)}
+    before = previous[0]
+    changed = rows.join(before, on=[*keys, ROW_HASH], how="anti")
+    changes = {
+        "inserted": changed.join(before, on=keys, how="anti").select(keys),
+        "updated": changed.join(before, on=keys, how="semi").select(keys),
+        "deleted": before.join(inputs, on=keys, how="anti").select(keys),
+    }
+    return inputs, changed, changes
+
+
+def run(
+    source_name: str,
+    outputs: Iterable[Union[str, Path]],
+    incremental: bool = False,
+    reuse: bool = False,
+    writer: Union[Writer, None] = None,
+    stage_dir: Union[Path, None] = None,
+    categorical: bool = False,
+) -> None:
+    """
+    Rewrite the data of a source into the outputs, and run its output
+    stages into ``stage_dir`` if given.
+
+    Incremental runs of a source declaring a ``KEY`` only process the rows
+    that were inserted or updated since its previous incremental run, and
+    take the other rows from the output of that run. With ``reuse``, the
+    source is handed to ``rerun``. With ``categorical``, the columns a
+    source lists in ``CATEGORICAL`` are dictionary-encoded from the source
+    to the outputs, and the books applied to their distinct values.
+    """
+    writer = writer or Writer()
+    metrics.current_source.set(source_name)
+    if reuse:
+        rerun(source_name, outputs, writer, stage_dir)
+        return
+    stages = load_stages(source_name) if stage_dir is not None else []
+    frames = None
+    with metrics.step("source") as source_step:
+        source = load_module(source_name, "sources")
+        # Dictionaries need all the rows, so encoded runs gather the batches
+        streaming = not (incremental or categorical)
+        if getattr(source, "batches", None) is not None and streaming:
+            frames = read_batches(source.batches())
+            first = next(frames, None)
+            if first is None:
+                raise ValueError(f"{source_name} yielded no batches")
+            keys = first.columns
+        else:
+            lf = scan_source(source, source_name)
+            keys = lf.collect_schema().names()
+    log.debug("Keys are %s", ", ".join(keys))
+
+    try:
+        rulebook, enhancebook, enhanced, filterbook = load_books(source_name, keys)
+
+        if frames is not None:
+            plan = compile_books(keys, filterbook, rulebook, enhancebook, enhanced)
+            with metrics.step("stream") as stream_step:
+                len_data, height, batches = stream(
+                    plan, first, frames, outputs, writer, stages, stage_dir
+                )
+                stream_step.rows_in, stream_step.rows_out = len_data, height
+                stream_step.extra["batches"] = batches
+                stream_step.extra["books"] = book_metrics(filterbook, rulebook, enhancebook)
+            source_step.rows_out = len_data
+            filtered, substitutions = book_totals(plan)
+            log_totals(filtered, len_data, substitutions, height)
+            log_unused(rulebook, enhancebook, filterbook)
+            return
+    finally:
+        if frames is not None:
+            frames.close()
+
+    key = list(getattr(source, "KEY", ())) if incremental else []
+    if incremental and not key:
+        log.warning("%s declares no KEY, processing it in full", source_name)
+    snapshot, previous = None, None
+    if key:
+        snapshot = Snapshot(
+            cache_dir() / "state" / source_name,
+            key,
+            books_fingerprint(keys, filterbook, rulebook, enhancebook),
+        )
+        previous = snapshot.load()
+        with metrics.step("delta") as delta_step:
+            inputs, rows, changes = delta(lf, key, previous)
+            delta_step.rows_in, delta_step.rows_out = len(inputs), len(rows)
+        if inputs.select(key_columns(key)).is_duplicated().any():
+            log.warning("KEY of %s is not unique, processing it in full", source_name)
+            snapshot, previous = None, None
+        else:
+            lf = rows.lazy()
+            log.info(
+                "%s: %s",
+                source_name,
+                ", ".join(f"{len(frame)} {change}" for change, frame in changes.items()),
+            )
+
+    dictionaries: Dict[str, pl.Series] = {}
+    if categorical:
+        schema = lf.collect_schema()
+        declared = getattr(source, "CATEGORICAL", ())
+        encoded = [col for col in declared if schema.get(col) == pl.String]
+        if not encoded:
+            log.warning("%s declares no CATEGORICAL columns, keeping strings", source_name)
+        else:
+            with metrics.step("encode") as encode_step:
+                frame, dictionaries = encode(lf, encoded, rulebook, enhancebook)
+                lf = frame.lazy()
+                encode_step.rows_in = encode_step.rows_out = len(frame)
+                encode_step.extra["distinct"] = {col: len(v) for col, v in dictionaries.items()}
+    plan = compile_books(
+        keys, filterbook, rulebook, enhancebook, enhanced, dictionaries=dictionaries
+    )
+
+    metrics.add_plan("usage", plan.usage(lf), optimizations=OPTIMIZATIONS)
+    with metrics.step("books") as books_step:
+        usage = plan.usage(lf).collect(optimizations=OPTIMIZATIONS)
+        len_data, height = tally(plan, usage)
+        books_step.rows_in, books_step.rows_out = len_data, height
+        books_step.extra["books"] = book_metrics(filterbook, rulebook, enhancebook)
+    source_step.rows_out = len_data
+    filtered, substitutions = book_totals(plan)
+    with metrics.step("missing", rows_in=height) as missing_step:
+        missing_step.rows_out = log_missing(plan, usage)
+
+    lf = plan.apply(lf)
+    metrics.add_plan("apply", lf, optimizations=OPTIMIZATIONS)
+    if snapshot is None:
+        with metrics.step("write", rows_in=height) as write_step:
+            publish(lf, outputs, writer, stages, stage_dir)
+            write_step.rows_out = height
+    else:
+        keyed = key_columns(key)
+        # Outputs of the previous runs are kept as strings
+        frame = decode(lf.drop(ROW_HASH)).collect(optimizations=OPTIMIZATIONS)
+        if previous is not None:
+            # Unchanged rows come from the previous output, in input order
+            kept = previous[1].join(rows.select(keyed), on=keyed, how="anti")
+            frame = inputs.select(keyed).join(
+                pl.concat([kept, frame.select(kept.columns)]),
+                on=keyed,
+                how="inner",
+                maintain_order="left",
+            )
+        written = [col for col in frame.columns if col not in keyed]
+        with metrics.step("write", rows_in=len(frame)) as write_step:
+            publish(frame.select(written), outputs, writer, stages, stage_dir)
+            write_step.rows_out = len(frame)
+        changeset: dict = {"source": source_name, "full": previous is None, "rows": len(inputs)}
+        if previous is not None:
+            for change, keys_frame in changes.items():
+                changeset[change] = keys_frame.rename(dict(zip(keyed, key))).to_dicts()
+        snapshot.save(inputs, frame.select(*keyed, *written), changeset)
+
+    log_totals(filtered, len_data, substitutions, height)
+    if previous is None:
+        # Delta runs only count the changed rows, so unused entries are not reported
+        log_unused(rulebook, enhancebook, filterbook)
+
+
+def tally(plan: Plan, usage: pl.DataFrame) -> Tuple[int, int]:
+    """Add the usage counters of ``plan`` to its books; return the rows read and kept."""
+    for name, book in plan.counters:
+        # Null values are counted too, for the filters dropping them
+        counts = usage.select(pl.col(name).explode().struct.unnest()).drop_nulls("count")
+        # Values of encoded columns are counted as codes
+        book.add_counts(counts.with_columns(pl.col("value").cast(pl.String)))
+    return usage.get_column("__rows").item(), usage.get_column("__kept").item()
+
+
+def book_totals(plan: Plan) -> Tuple[int, int]:
+    """Return how many values the filters dropped and the rules replaced."""
+    filtered = sum(book.total() for name, book in plan.counters if name in plan.filter_counters)
+    substitutions = sum(book.total() for name, book in plan.counters if name in plan.rule_counters)
+    return filtered, substitutions
+
+
+def log_missing(plan: Plan, usage: pl.DataFrame) -> int:
+    """Log the rows left without an enhanced value, and return how many there were."""
+    missing = 0
+    for col, name in plan.missing.items():
+        for row in usage.get_column(name).item():
+            log.error("No enhancement found for %s in row %s", col, row)
+            missing += 1
+    return missing
+
+
+def stream(
+    plan: Plan,
+    first: pl.DataFrame,
+    frames: Iterator[pl.DataFrame],
+    outputs: Iterable[Union[str, Path]],
+    writer: Writer,
+    stages: list[Callable[[pl.LazyFrame, Path], None]],
+    directory: Union[Path, None],
+) -> Tuple[int, int, int]:
+    """
+    Filter, rewrite and enhance ``first`` and then ``frames`` one frame at
+    a time, while the next frames are read and the previous ones written.
+
+    Every output is sunk by a thread of its own from a pipe of the
+    rewritten frames, as Polars reads a Python source anew for each sink.
+    With stages, the rewritten frames are gathered and published together.
+    Returns the number of rows read and kept, and of frames.
+    """
+    outputs = [Path(path) for path in outputs]
+    metrics.add_plan("usage", plan.usage(first.lazy()), optimizations=OPTIMIZATIONS)
+    metrics.add_plan("apply", plan.apply(first.lazy()), optimizations=OPTIMIZATIONS)
+    schema = plan.apply(first.lazy()).collect_schema()
+    pipes = [] if stages else [Pipe() for _ in outputs]
+    rewritten: list[pl.DataFrame] = []
+    len_data = height = batches = 0
+
+    def sink(pipe: Pipe, path: Path) -> None:
+        try:
+            writer.sink(pipe_source(pipe, schema), path).collect(optimizations=OPTIMIZATIONS)
+        finally:
+            # Also when the sink failed before reading anything
+            pipe.close()
+
+    with ThreadPoolExecutor(max_workers=max(len(pipes), 1)) as pool:
+        sinks = [pool.submit(sink, pipe, path) for pipe, path in zip(pipes, outputs)]
+        try:
+            for frame in itertools.chain([first], frames):
+                if frame.schema != first.schema:
+                    raise ValueError(f"batch {batches} does not match the schema of the first")
+                lf = frame.lazy()
+                usage, out = pl.collect_all(
+                    [plan.usage(lf), plan.apply(lf)], optimizations=OPTIMIZATIONS
+                )
+                rows, kept = tally(plan, usage)
+                log_missing(plan, usage)
+                len_data, height, batches = len_data + rows, height + kept, batches + 1
+                for pipe in pipes:
+                    pipe.put(out)
+                if stages:
+                    rewritten.append(out)
+        except Closed:
+            # A writer failed: the others are stopped, and its error raised below
+            for pipe in pipes:
+                pipe.end(Closed())
+        except BaseException as error:
+            for pipe in pipes:
+                pipe.end(error)
+            raise
+        else:
+            for pipe in pipes:
+                pipe.end()
+        errors = [future.exception() for future in sinks]
+        for error in errors:
+            if error is not None and not isinstance(error, Closed):
+                raise error
+    if stages:
+        publish(pl.concat(rewritten), outputs, writer, stages, directory)
+    return len_data, height, batches
+
+
+def log_totals(filtered: int, len_data: int, substitutions: int, height: int) -> None:
+    """Log how many values were dropped and replaced."""
+    if len_data:
+        log.info(
+            "%d values out of %d dropped, %.2f%%", filtered, len_data, 100 * filtered / len_data
+        )
+    if height:
+        log.info(
+            "%d values out of %d replaced, %.2f%%",
+            substitutions,
+            height,
+            100 * substitutions / height,
+        )
+
+
+def log_unused(rulebook: Rulebook, enhancebook: EnhanceBook, filterbook: FilterBook) -> None:
+    """Log the entries of the books that were not used."""
+    for key, book in rulebook.items():
+        for rule, value, _ in book.rows(used=False):
+            log.info('Did not use [%s] rule "%s" -> "%s"', key, rule, value)
+        if log.isEnabledFor(logging.DEBUG):
+            for rule, _, count in book.rows(used=True):
+                log.debug("Used [%s] rule %s %d times", key, rule, count)
+
+    for key, targets in enhancebook.items():
+        for enhancement, book in targets.items():
+            for tkey, value, _ in book.rows(used=False):
+                log.info(
+                    'Did not use enhancement [%s] "%s" -> [%s] "%s"',
+                    key,
+                    tkey,
+                    enhancement,
+                    value,
+                )
+
+    for key, filters in filterbook.items():
+        for value, _, _ in filters.rows(used=False):
+            log.info("Did not use filter [%s] %s", key, value)
+
+
+# Bump when the layout of the cached lineage changes
+LINEAGE_FORMAT = 2
+ROW = "__row"
+COUNTS_SCHEMA = {"path": pl.String, "value": pl.String, "count": pl.UInt64}
+
+
+@dataclass
+class Stage:
+    """
+    A book file, with the column it rewrites and the column it looks up;
+    ``on`` lists the columns of the source a rule looks up.
+    """
+
+    kind: str
+    path: str
+    writes: str
+    reads: str
+    book: Book
+    on: Tuple[str, ...] = ()
+
+
+def book_stages(
+    source: str, filterbook: FilterBook, rulebook: Rulebook, enhancebook: EnhanceBook
+) -> list[Stage]:
+    """Return the books of a source in the order they are applied; filters write no column."""
+    stages: list[Stage] = []
+    for name, book in filterbook.items():
+        on = filter_columns(name)
+        path = str(Path("filters") / source / f"{name}.csv")
+        stages.append(Stage("filters", path, "", on[0], book, tuple(on)))
+    for name, book in rulebook.items():
+        target, on = rule_columns(name)
+        path = str(Path("rules") / source / f"{name}.csv")
+        stages.append(Stage("rules", path, target, target, book, tuple(on)))
+    stages += [
+        Stage("enhance", str(Path("enhance") / source / key / f"{target}.csv"), target, key, book)
+        for level in enhancement_levels(enhancebook)
+        for key in level
+        for target, book in enhancebook[key].items()
+    ]
+    return stages
+
+
+def lookups(stages: list[Stage]) -> Dict[Tuple[str, str], str]:
+    """
+    Name the columns keeping the value looked up by enhancements that read
+    a column rewritten later on, so they can be recomputed on their own.
+    """
+    return {
+        (stage.reads, stage.writes): f"__lookup_{stage.reads}_{stage.writes}"
+        for i, stage in enumerate(stages)
+        if stage.kind == "enhance" and any(later.writes == stage.reads for later in stages[i + 1 :])
+    }
+
+
+def dirty_columns(
+    stages: list[Stage], hashes: Dict[str, str], books: Dict[str, dict], cached: Iterable[str]
+) -> Union[set[str], None]:
+    """
+    Return the columns to recompute after the book files changed from the
+    ``books`` recorded by the previous run, or None if filters changed.
+
+    A column is recomputed when one of its books changed or looks up a
+    recomputed column. The other columns are read from the ``cached``
+    columns; if the value a recomputed book looks up was not kept, the
+    column it is read from is recomputed too, as are the columns of the
+    source a recomputed rule looks up.
+    """
+    filters = {path for path, info in books.items() if not info["writes"]}
+    if filters != {stage.path for stage in stages if stage.kind == "filters"}:
+        return None
+    changed = {
+        path for path, digest in hashes.items() if books.get(path, {}).get("sha256") != digest
+    }
+    if any(stage.kind == "filters" for stage in stages if stage.path in changed):
+        return None
+    paths = {stage.path for stage in stages}
+    dirty = {info["writes"] for path, info in books.items() if path not in paths}
+    kept = lookups(stages)
+    cached = set(cached)
+    while True:
+        before = len(dirty)
+        for stage in stages:
+            if stage.kind == "filters":
+                continue
+            if stage.path in changed or stage.reads in dirty:
+                dirty.add(stage.writes)
+            lookup = kept.get((stage.reads, stage.writes))
+            if stage.writes in dirty and lookup is not None and lookup not in cached:
+                dirty.add(stage.reads)
+            if stage.writes in dirty:
+                dirty.update(stage.on)
+        if len(dirty) == before:
+            return dirty
+
+
+def rerun(
+    source_name: str,
+    outputs: Iterable[Union[str, Path]],
+    writer: Union[Writer, None] = None,
+    stage_dir: Union[Path, None] = None,
+) -> None:
+    """
+    Rewrite the data of a source, reusing what its previous rerun computed.
+
+    The first rerun reads the source and caches its input, output and
+    usage counts together with the lineage of every column: the book files
+    it was computed from and their hashes. Later reruns read the cached
+    input and only recompute the columns fed by a book file that changed,
+    and the enhancements that depend on them; a changed filter recomputes
+    everything.
+    """
+    directory = cache_dir() / "lineage" / source_name
+    state = directory / "lineage.json"
+    lineage = json.loads(state.read_text(encoding="utf-8")) if state.exists() else {}
+    with metrics.step("source") as source_step:
+        if lineage.get("format") != LINEAGE_FORMAT:
+            lineage = {}
+            source = load_module(source_name, "sources")
+            inputs = scan_source(source, source_name).with_row_index(ROW).collect()
+        else:
+            inputs = pl.read_ipc(directory / "input.arrow")
+        source_step.rows_out = len(inputs)
+    keys = [col for col in inputs.columns if col != ROW]
+    columns = list(keys)
+
+    rulebook, enhancebook, enhanced, filterbook = load_books(source_name, keys)
+    stages = book_stages(source_name, filterbook, rulebook, enhancebook)
+    hashes = {
+        stage.path: hashlib.sha256(Path(stage.path).read_bytes()).hexdigest() for stage in stages
+    }
+    kept = lookups(stages)
+
+    dirty = None
+    if lineage and lineage["keys"] == keys:
+        cached = pl.read_ipc_schema(directory / "output.arrow")
+        dirty = dirty_columns(stages, hashes, lineage["books"], cached)
+    enhancements: EnhanceBook = {}
+    if dirty is None:
+        lf = inputs.lazy()
+        recomputed = stages
+        len_data = len(inputs)
+    else:
+        # Kept rows of the previous output, with the raw input of the
+        # recomputed columns
+        previous = pl.read_ipc(directory / "output.arrow")
+        raw = inputs.select(ROW, *(col for col in columns if col in dirty))
+        lf = (
+            previous.lazy()
+            .drop(raw.columns[1:])
+            .join(raw.lazy(), on=ROW, how="left", maintain_order="left")
+            .select(previous.columns)
+        )
+        recomputed = [stage for stage in stages if stage.writes in dirty]
+        len_data = lineage["rows"]
+        log.info("Recomputing %s", ", ".join(sorted(dirty)) or "nothing")
+
+    filters = {Path(stage.path).stem: stage.book for stage in recomputed if stage.kind == "filters"}
+    rules = {Path(stage.path).stem: stage.book for stage in recomputed if stage.kind == "rules"}
+    for stage in recomputed:
+        if stage.kind == "enhance":
+            lookup = stage.reads
+            if dirty is not None and stage.reads not in dirty:
+                # The column is not recomputed: look up the value kept
+                # from the previous run
+                lookup = kept.get((stage.reads, stage.writes), stage.reads)
+            enhancements.setdefault(lookup, {})[stage.writes] = stage.book
+    plan = compile_books(keys, filters, rules, enhancements, [], kept)
+    metrics.add_plan("usage", plan.usage(lf), optimizations=OPTIMIZATIONS)
+    metrics.add_plan("apply", plan.apply(lf), optimizations=OPTIMIZATIONS)
+    with metrics.step("books", rows_in=len_data) as books_step:
+        usage = plan.usage(lf).collect(optimizations=OPTIMIZATIONS)
+        for name, book in plan.counters:
+            book.add_counts(
+                usage.select(pl.col(name).explode().struct.unnest()).drop_nulls("count")
+            )
+        if dirty is not None:
+            counts = pl.read_ipc(directory / "counts.arrow")
+            reused = {stage.path for stage in stages} - {stage.path for stage in recomputed}
+            for stage in stages:
+                if stage.path in reused:
+                    # Unchanged files list the same entries, in the same order
+                    stage.book.counts += counts.filter(pl.col("path") == stage.path).get_column(
+                        "count"
+                    )
+        frame = plan.apply(lf).collect(optimizations=OPTIMIZATIONS)
+        books_step.rows_out = len(frame)
+        books_step.extra["books"] = book_metrics(filterbook, rulebook, enhancebook)
+    with metrics.step("write", rows_in=len(frame)) as write_step:
+        publish(
+            frame.drop(ROW, *kept.values(), strict=False),
+            outputs,
+            writer or Writer(),
+            load_stages(source_name) if stage_dir is not None else [],
+            stage_dir,
+        )
+        write_step.rows_out = len(frame)
+
+    with metrics.step("missing", rows_in=len(frame)) as missing_step:
+        missing_step.rows_out = 0
+        for col in enhanced:
+            for row in frame.filter(pl.col(col).is_null()).select(pl.struct(keys)).to_series():
+                log.error("No enhancement found for %s in row %s", col, row)
+                missing_step.rows_out += 1
+    filtered = sum(stage.book.total() for stage in stages if stage.kind == "filters")
+    substitutions = sum(stage.book.total() for stage in stages if stage.kind == "rules")
+    log_totals(filtered, len_data, substitutions, len(frame))
+    log_unused(rulebook, enhancebook, filterbook)
+
+    feeds: Dict[str, set[str]] = {}
+    for stage in stages:
+        if stage.writes:
+            feeds[stage.writes] = (
+                feeds.get(stage.writes, set()) | feeds.get(stage.reads, set()) | {stage.path}
+            )
+    directory.mkdir(parents=True, exist_ok=True)
+    state.unlink(missing_ok=True)
+    if not lineage:
+        inputs.write_ipc(directory / "input.arrow")
+    frame.write_ipc(directory / "output.arrow")
+    counts = [
+        pl.DataFrame(
+            {
+                "path": stage.path,
+                "value": stage.book.frame.get_column("old"),
+                "count": stage.book.counts,
+            }
+        )
+        for stage in stages
+    ]
+    pl.concat(counts or [pl.DataFrame(schema=COUNTS_SCHEMA)]).write_ipc(directory / "counts.arrow")
+    state.write_text(
+        json.dumps(
+            {
+                "format": LINEAGE_FORMAT,
+                "keys": keys,
+                "rows": len_data,
+                "books": {
+                    stage.path: {
+                        "sha256": hashes[stage.path],
+                        "writes": stage.writes,
+                        "reads": stage.reads,
+                    }
+                    for stage in stages
+                },
+                "columns": {col: sorted(paths) for col, paths in feeds.items()},
+            },
+            indent=1,
+        ),
+        encoding="utf-8",
+    )
+
+
+def run_batch(
+    pairs: list[Tuple[str, list[str]]], jobs: Union[int, None] = None, **options
+) -> bool:
+    """
+    Run several sources in this process, at the same time, passing the
+    options on to ``run``.
+
+    Returns False if any of them failed; the others still run to completion.
+    """
+    ok = True
+    with ThreadPoolExecutor(max_workers=jobs or len(pairs)) as pool:
+        futures = {
+            pool.submit(run, source_name, outputs, **options): source_name
+            for source_name, outputs in pairs
+        }
+        for future, source_name in futures.items():
+            try:
+                future.result()
+            except Exception:
+                log.exception("Processing %s failed", source_name)
+                ok = False
+            else:
+                log.info("Processed %s", source_name)
+    return ok
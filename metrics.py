@@ -0,0 +1,140 @@
+"""
+Wall time, CPU time, peak memory and row counts of the steps of a run.
+
+Steps are only recorded between ``start()`` and ``stop()``; outside of
+that, ``step()`` measures nothing. CPU time and peak RSS are those of
+the whole process, Polars doing its work on its own threads: steps of
+sources running at the same time in batch mode share them.
+"""
+
+import json
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import polars as pl
+
+# Bump when the layout of the report changes
+REPORT_FORMAT = 1
+# Source whose steps the current thread records
+current_source: ContextVar[str] = ContextVar("current_source", default="")
+
+
+@dataclass
+class Step:
+    """Measurements of one step; ``rows_in`` and ``rows_out`` are set by the caller."""
+
+    name: str
+    source: str = ""
+    wall_s: float = 0.0
+    cpu_s: float = 0.0
+    peak_rss_bytes: int = 0
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    extra: Dict[str, Any] = field(default_factory=dict)
+
+
+def peak_rss() -> int:
+    """Return the peak resident set size of the process so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes, except on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Recorder:
+    """Collects the steps of a run, and the query plans with ``profile``."""
+
+    def __init__(self, profile: bool = False):
+        self.profile = profile
+        self.steps: List[Step] = []
+        self.plans: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, step: Step) -> None:
+        with self._lock:
+            self.steps.append(step)
+
+    def add_plan(self, name: str, lf: pl.LazyFrame, **collect_options) -> None:
+        """Keep the optimized plan of ``lf``; the query is not run again to time it."""
+        plan: Dict[str, Any] = {"plan": lf.explain(**collect_options)}
+        with self._lock:
+            self.plans[name] = plan
+
+    def report(self) -> Dict[str, Any]:
+        """Return the report written by ``--metrics-json``."""
+        with self._lock:
+            return {
+                "format": REPORT_FORMAT,
+                "polars": pl.__version__,
+                "peak_rss_bytes": peak_rss(),
+                "steps": [asdict(step) for step in self.steps],
+                "plans": dict(self.plans),
+            }
+
+    def write(self, path: Union[str, Path]) -> None:
+        Path(path).write_text(json.dumps(self.report(), indent=1), encoding="utf-8")
+
+    def summary(self) -> Iterator[str]:
+        """Yield one line per step, for the log."""
+        for step in list(self.steps):
+            rows = ""
+            if step.rows_in is not None or step.rows_out is not None:
+                rows = f", rows {step.rows_in if step.rows_in is not None else '-'}"
+                rows += f" -> {step.rows_out if step.rows_out is not None else '-'}"
+            yield (
+                f"{step.source or '-'} {step.name}: {step.wall_s:.3f}s wall, "
+                f"{step.cpu_s:.3f}s CPU, peak RSS {step.peak_rss_bytes / (1 << 20):.0f} MiB{rows}"
+            )
+
+
+_recorder: Optional[Recorder] = None
+
+
+def start(profile: bool = False) -> Recorder:
+    """Start recording steps, and return the recorder."""
+    global _recorder
+    _recorder = Recorder(profile)
+    return _recorder
+
+
+def stop() -> Optional[Recorder]:
+    """Stop recording, and return the recorder that was active, if any."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def add_plan(name: str, lf: pl.LazyFrame, **collect_options) -> None:
+    """Keep the plan of ``lf`` under the current source, when profiling."""
+    if _recorder is not None and _recorder.profile:
+        source = current_source.get()
+        _recorder.add_plan(f"{source}/{name}" if source else name, lf, **collect_options)
+
+
+@contextmanager
+def step(name: str, rows_in: Optional[int] = None) -> Iterator[Step]:
+    """
+    Measure the enclosed block as a step of the current source.
+
+    The step is recorded even when the block raises, so failed runs show
+    how far they got.
+    """
+    current = Step(name, current_source.get(), rows_in=rows_in)
+    recorder = _recorder
+    if recorder is None:
+        yield current
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        current.wall_s = time.perf_counter() - wall
+        current.cpu_s = time.process_time() - cpu
+        current.peak_rss_bytes = peak_rss()
+        recorder.add(current)
@@ -0,0 +1,92 @@
+"""
+Find and import the modules of the ``sources`` and ``stages`` packages.
+
+A module is imported by name without listing its package. The names of
+the modules a package offers are kept in the cache directory, and only
+listed again when the directory of the package changes; modules starting
+with an underscore are helpers, and are left out.
+"""
+
+import hashlib
+import importlib
+import json
+import logging
+import os
+from pathlib import Path
+from types import ModuleType
+from typing import List
+
+from sources import cache_dir
+
+log = logging.getLogger("csventrifuge")
+
+ROOT = Path(__file__).parent
+# Bump when the layout of the cached registry changes
+REGISTRY_FORMAT = 1
+
+
+def form_module(fp: str) -> str:
+    """
+    Form a module name from a filepath.
+
+    Args:
+        fp (str): The filepath from which to form a module name.
+    Returns:
+        The formed module name.
+    """
+    return "." + os.path.splitext(fp)[0]
+
+
+def module_path(wanted_module: str, origin: str) -> Path:
+    """Return the file the module ``wanted_module`` of ``origin`` would be loaded from."""
+    return ROOT / origin / f"{wanted_module}.py"
+
+
+def load_module(wanted_module: str, origin: str) -> ModuleType:
+    """
+    Load the specified module from the given origin directory.
+
+    Args:
+        wanted_module (str): The desired module to load.
+        origin (str): The directory in which to search for the module.
+    Returns:
+        The loaded module.
+    Raises:
+        ImportError: If the desired module is not found in the origin directory.
+    """
+    path = module_path(wanted_module, origin)
+    if not path.is_file():
+        raise ImportError(f'module not found "{wanted_module}" ({origin})')
+    log.debug("Loading module %s", form_module(path.name))
+    return importlib.import_module(form_module(path.name), package=origin)
+
+
+def module_names(origin: str) -> List[str]:
+    """Return the names of the modules of ``origin``, helpers left out."""
+    directory = ROOT / origin
+    mtime_ns = directory.stat().st_mtime_ns
+    key = hashlib.sha256(str(directory.resolve()).encode()).hexdigest()[:16]
+    cached = cache_dir() / "registry" / f"{origin}-{key}.json"
+    try:
+        registry = json.loads(cached.read_text(encoding="utf-8"))
+        if registry["format"] == REGISTRY_FORMAT and registry["mtime_ns"] == mtime_ns:
+            return registry["modules"]
+    except (OSError, ValueError, KeyError):
+        pass
+    modules = sorted(
+        os.path.splitext(name)[0]
+        for name in os.listdir(directory)
+        if name.endswith(".py") and not name.startswith("_")
+    )
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        partial = cached.with_suffix(f".{os.getpid()}.tmp")
+        partial.write_text(
+            json.dumps({"format": REGISTRY_FORMAT, "mtime_ns": mtime_ns, "modules": modules}),
+            encoding="utf-8",
+        )
+        partial.replace(cached)
+    except OSError:
+        # A read-only cache only costs the listing
+        pass
+    return modules
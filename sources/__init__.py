@@ -0,0 +1,7 @@
+import os
+from pathlib import Path
+
+
+def cache_dir() -> Path:
+    """Return the directory holding csventrifuge caches."""
+    return Path(os.environ.get("CSVENTRIFUGE_CACHE", "~/.cache/csventrifuge")).expanduser()
@@ -0,0 +1,52 @@
+"""Cut a stream of bytes into blocks of whole lines, and parse them.
+
+Sources offering ``batches()`` use these to hand out their rows while the
+data is still being downloaded or decompressed.
+"""
+
+import io
+from typing import Iterable, Iterator
+
+import polars as pl
+
+# Bytes of data parsed at once
+BLOCK_SIZE = 8 << 20
+BOM = b"\xef\xbb\xbf"
+
+
+def line_blocks(chunks: Iterable[bytes], size: int = BLOCK_SIZE) -> Iterator[bytes]:
+    """
+    Regroup ``chunks`` into blocks of at least ``size`` bytes that end
+    with a newline, but for the last one.
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) < size:
+            continue
+        end = pending.rfind(b"\n") + 1
+        if end:
+            yield bytes(pending[:end])
+            del pending[:end]
+    if pending:
+        yield bytes(pending)
+
+
+def csv_batches(
+    chunks: Iterable[bytes], size: int = BLOCK_SIZE, **options
+) -> Iterator[pl.DataFrame]:
+    """
+    Parse a CSV file with a header from ``chunks``, one block of lines at
+    a time; ``options`` are passed on to ``polars.read_csv``.
+
+    Quoted values cannot span several lines, as blocks are cut at any
+    newline.
+    """
+    header = None
+    for block in line_blocks(chunks, size):
+        if header is None:
+            block = block.removeprefix(BOM)
+            header = block[: block.find(b"\n") + 1]
+            yield pl.read_csv(io.BytesIO(block), **options)
+            continue
+        yield pl.read_csv(io.BytesIO(header + block), **options)
@@ -0,0 +1,255 @@
+"""Fixed-width readers for the files of the CACLR extract.
+
+The layouts mirror the offsets used by ``extra/caclr/import_caclr.sql``,
+shifted to zero-based character offsets.
+
+Parsing a whole extract is done once: ``build_snapshot`` converts every
+known file to Arrow IPC in parallel, and ``table`` reads from that
+snapshot until the extract changes. Run this module with the extract
+directory as argument to build the snapshot ahead of time.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+
+import polars as pl
+
+from sources import cache_dir
+from sources._batches import line_blocks
+
+log = logging.getLogger(f"csventrifuge.{__name__}")
+
+ENCODING = "ISO-8859-15"
+EXTRACT = "~/caclr"
+
+
+class Field(NamedTuple):
+    """A column of a fixed-width file, at a zero-based character offset."""
+
+    name: str
+    offset: int
+    length: int
+
+
+Layout = Tuple[Field, ...]
+
+LAYOUTS: Dict[str, Layout] = {
+    "ALIAS.LOCALITE": (
+        Field("numero_sequentiel", 0, 3),
+        Field("nom", 3, 40),
+        Field("nom_majuscule", 43, 40),
+        Field("langue", 83, 1),
+        Field("ds_timestamp_modif", 84, 10),
+        Field("fk_local_numero", 94, 5),
+    ),
+    "ALIAS.RUE": (
+        Field("numero_sequentiel", 0, 3),
+        Field("nom", 3, 40),
+        Field("nom_majuscule", 43, 40),
+        Field("langue", 83, 1),
+        Field("ds_timestamp_modif", 84, 10),
+        Field("fk_rue_numero", 94, 5),
+        Field("description", 99, 80),
+    ),
+    "CANTON": (
+        Field("code", 0, 2),
+        Field("nom", 2, 40),
+        Field("ds_timestamp_modif", 42, 10),
+        Field("fk_distr_code", 52, 4),
+    ),
+    "CODEPT": (
+        Field("numero_postal", 0, 4),
+        Field("lib_post_majuscule", 4, 40),
+        Field("type_cp", 44, 1),
+        Field("limite_inf_bp", 45, 4),
+        Field("limite_sup_bp", 49, 4),
+        Field("ds_timestamp_modif", 53, 10),
+    ),
+    "COMMUALL": (
+        Field("code", 0, 2),
+        Field("nom", 2, 40),
+        Field("ds_timestamp_modif", 82, 10),
+        Field("fk_canto_code", 92, 2),
+        Field("indic_fusionnee", 94, 1),
+    ),
+    "CPTCH": (
+        Field("type_rue", 0, 2),
+        Field("numero_rue", 2, 4),
+        Field("ds_timestamp_modif", 6, 10),
+    ),
+    "DISTRICT": (
+        Field("code", 0, 4),
+        Field("nom", 4, 40),
+        Field("ds_timestamp_modif", 44, 10),
+    ),
+    "IMMDESIG": (
+        Field("numero_interne", 0, 8),
+        Field("designation", 56, 40),
+    ),
+    "IMMEUBLE": (
+        Field("numero_interne", 0, 8),
+        Field("numero", 8, 3),
+        Field("code_multiple", 11, 6),
+        Field("date_fin_valid", 17, 10),
+        Field("ds_timestamp_modif", 28, 10),
+        Field("fk_codpt_numero", 38, 4),
+        Field("fk_quart_numero", 43, 5),
+        Field("fk_rue_numero", 49, 5),
+        Field("indic_no_indef", 55, 1),
+        Field("indic_provisoire", 56, 1),
+    ),
+    "LOCALITE": (
+        Field("numero", 0, 5),
+        Field("nom", 5, 40),
+        Field("code", 85, 2),
+        Field("indic_ville", 87, 1),
+        Field("date_fin_valid", 88, 10),
+        Field("ds_timestamp_modif", 99, 10),
+        Field("fk_canto_code", 109, 2),
+        Field("fk_commu_code", 112, 2),
+    ),
+    "QUARTIER": (
+        Field("numero", 0, 5),
+        Field("nom", 5, 40),
+        Field("ds_timestamp_modif", 45, 10),
+        Field("fk_local_numero", 55, 5),
+    ),
+    "RUE": (
+        Field("numero", 0, 5),
+        Field("nom", 5, 40),
+        Field("mot_tri", 85, 10),
+        Field("code_nomenclature", 95, 5),
+        Field("indic_lieu_dit", 101, 1),
+        Field("date_fin_valid", 102, 10),
+        Field("ds_timestamp_modif", 113, 10),
+        Field("fk_cptch_typerue", 123, 2),
+        Field("fk_cptch_numerorue", 126, 4),
+        Field("fk_local_numero", 131, 5),
+        Field("indic_provisoire", 137, 1),
+    ),
+    "TR.DICACOLO.RUCP": (
+        Field("district", 0, 40),
+        Field("canton", 40, 40),
+        Field("commune", 80, 40),
+        Field("localite", 120, 40),
+        Field("rue", 160, 40),
+        Field("code_postal", 200, 4),
+    ),
+}
+
+
+def read_fixed_width(data: bytes, layout: Layout) -> pl.DataFrame:
+    """
+    Split the raw bytes of a fixed-width file into String columns.
+
+    The buffer is decoded in one go; as the encoding uses one byte per
+    character, the byte offsets of the layout are character offsets too.
+    Values have their trailing spaces removed.
+    """
+    text = data.decode(ENCODING)
+    if not text:
+        return pl.DataFrame(schema={field.name: pl.String for field in layout})
+    lines = pl.Series("line", [text]).str.split("\n").explode()
+    if text.endswith("\n"):
+        lines = lines.head(-1)
+    line = pl.col("line").str.strip_suffix("\r")
+    return lines.to_frame().select(
+        line.str.slice(field.offset, field.length).str.strip_chars_end(" ").alias(field.name)
+        for field in layout
+    )
+
+
+def fixed_width_batches(chunks: Iterable[bytes], layout: Layout) -> Iterator[pl.DataFrame]:
+    """Split a fixed-width file arriving in ``chunks`` one block of lines at a time."""
+    for block in line_blocks(chunks):
+        yield read_fixed_width(block, layout)
+
+
+def read(path: Union[str, Path], name: str = "") -> pl.DataFrame:
+    """Read a CACLR file, using the layout of its file name unless given."""
+    path = Path(path).expanduser()
+    return read_fixed_width(path.read_bytes(), LAYOUTS[name or path.name])
+
+
+def extract_files(directory: Union[str, Path]) -> Dict[str, Path]:
+    """Return the files of an extract that have a known layout."""
+    directory = Path(directory).expanduser()
+    return {
+        name: directory / name for name in sorted(LAYOUTS) if (directory / name).is_file()
+    }
+
+
+def fingerprint(directory: Union[str, Path]) -> str:
+    """Identify an extract by the names, sizes and modification times of its files."""
+    digest = hashlib.sha256()
+    for name, path in extract_files(directory).items():
+        stat = path.stat()
+        digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def _convert(name: str, path: Path, target: Path) -> str:
+    read(path, name).write_ipc(target)
+    return name
+
+
+def build_snapshot(directory: Union[str, Path] = EXTRACT, workers: Optional[int] = None) -> Path:
+    """
+    Parse every file of an extract concurrently, one worker per file, and
+    store the tables as Arrow IPC files.
+
+    Returns the snapshot directory. The snapshots of each extract directory
+    are kept apart, and the older ones of the same directory are removed.
+    """
+    files = extract_files(directory)
+    location = str(Path(directory).expanduser().resolve())
+    root = cache_dir() / "caclr" / hashlib.sha256(location.encode()).hexdigest()[:16]
+    snapshot = root / fingerprint(directory)
+    if snapshot.is_dir():
+        return snapshot
+    partial = root / f"{snapshot.name}.{os.getpid()}.tmp"
+    partial.mkdir(parents=True, exist_ok=True)
+    workers = workers or min(len(files), os.cpu_count() or 1)
+    if workers <= 1:
+        for name, path in files.items():
+            _convert(name, path, partial / f"{name}.arrow")
+    else:
+        # Workers are spawned: forking a process that already runs the
+        # Polars thread pool can deadlock.
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            futures = [
+                pool.submit(_convert, name, path, partial / f"{name}.arrow")
+                for name, path in files.items()
+            ]
+            for future in futures:
+                log.debug("Converted CACLR file %s", future.result())
+    try:
+        partial.rename(snapshot)
+    except OSError:
+        # Another process built the same snapshot in the meantime.
+        shutil.rmtree(partial)
+    for old in root.iterdir():
+        if old.is_dir() and old != snapshot and not old.name.endswith(".tmp"):
+            shutil.rmtree(old, ignore_errors=True)
+    return snapshot
+
+
+def table(name: str, directory: Union[str, Path] = EXTRACT) -> pl.DataFrame:
+    """Return a CACLR table from the snapshot of the extract, building it if needed."""
+    path = build_snapshot(directory) / f"{name}.arrow"
+    if not path.exists():
+        raise FileNotFoundError(f"{name} is not part of the CACLR extract in {directory}")
+    return pl.read_ipc(path)
+
+
+if __name__ == "__main__":
+    print(build_snapshot(sys.argv[1] if len(sys.argv) > 1 else EXTRACT))
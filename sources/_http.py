@@ -0,0 +1,209 @@
+"""Cached downloads shared by the network sources.
+
+Every URL is kept on disk together with its ETag and Last-Modified headers,
+and revalidated with a conditional request, so an unchanged dataset is not
+transferred again. With ``CSVENTRIFUGE_OFFLINE`` set, the cached copy is
+used without any request, and httpx is not even imported.
+
+Bodies are streamed to a ``.part`` file in chunks, so a download never
+holds the dataset in memory. An interrupted transfer is resumed with a
+Range request, on the next attempt or the next run.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterator, Optional
+
+import metrics
+from sources import cache_dir
+
+if TYPE_CHECKING:
+    import httpx
+
+log = logging.getLogger(f"csventrifuge.{__name__}")
+
+OFFLINE = "CSVENTRIFUGE_OFFLINE"
+CHUNK_SIZE = 1 << 20
+ATTEMPTS = 3
+
+_client: Optional["httpx.Client"] = None
+
+
+def client() -> "httpx.Client":
+    """Return the HTTP client shared by all sources, so connections are pooled."""
+    global _client
+    if _client is None:
+        import httpx
+
+        _client = httpx.Client(follow_redirects=True, timeout=httpx.Timeout(60.0, connect=10.0))
+    return _client
+
+
+def offline() -> bool:
+    """Tell whether downloads are disabled."""
+    return os.environ.get(OFFLINE, "") not in ("", "0")
+
+
+def cache_paths(url: str) -> tuple[Path, Path]:
+    """Return the paths of the cached body and metadata of an URL."""
+    base = cache_dir() / "http" / hashlib.sha256(url.encode()).hexdigest()[:32]
+    return base.with_suffix(".body"), base.with_suffix(".json")
+
+
+def read_meta(path: Path) -> Optional[Dict[str, str]]:
+    """Return the validators stored next to a body, if any."""
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def write_meta(path: Path, url: str, response: "httpx.Response") -> Dict[str, str]:
+    """Store the validators of a response."""
+    meta = {
+        "url": url,
+        "etag": response.headers.get("etag"),
+        "last_modified": response.headers.get("last-modified"),
+    }
+    path.write_text(json.dumps(meta), encoding="utf-8")
+    return meta
+
+
+def conditional_headers(cached: Optional[Dict[str, str]]) -> Dict[str, str]:
+    """Return the headers revalidating a cached copy, if any."""
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+
+def download(url: str, body: Path, headers: Dict[str, str]) -> Optional["httpx.Response"]:
+    """
+    Stream an URL into ``body``, resuming the ``.part`` file of an earlier
+    attempt when the server still serves the same version.
+
+    Returns the response, or None if the server answered 304 Not Modified.
+    """
+    import httpx
+
+    partial = body.with_suffix(".part")
+    partial_meta = read_meta(partial.with_suffix(".part.json"))
+    headers = dict(headers)
+    if partial.exists() and partial_meta is not None:
+        validator = partial_meta.get("etag") or partial_meta.get("last_modified")
+        if validator:
+            headers["Range"] = f"bytes={partial.stat().st_size}-"
+            headers["If-Range"] = validator
+    with client().stream("GET", url, headers=headers) as r:
+        if r.status_code == httpx.codes.NOT_MODIFIED:
+            return None
+        if r.status_code == httpx.codes.REQUESTED_RANGE_NOT_SATISFIABLE:
+            # The part is complete, or belongs to a bigger version
+            partial.unlink()
+            return download(url, body, {})
+        r.raise_for_status()
+        resumed = r.status_code == httpx.codes.PARTIAL_CONTENT
+        if resumed:
+            log.debug("Resuming %s at byte %d", url, partial.stat().st_size)
+        else:
+            write_meta(partial.with_suffix(".part.json"), url, r)
+        with open(partial, "ab" if resumed else "wb") as f:
+            for chunk in r.iter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+    partial.replace(body)
+    partial.with_suffix(".part.json").unlink(missing_ok=True)
+    return r
+
+
+def fetch(url: str) -> Path:
+    """
+    Return the path of an up to date local copy of an URL.
+
+    Raises:
+        FileNotFoundError: If offline and the URL was never downloaded.
+        httpx.HTTPError: If the download fails.
+    """
+    body, meta = cache_paths(url)
+    cached = read_meta(meta) if body.exists() else None
+    if offline():
+        if cached is None:
+            raise FileNotFoundError(f"{url} is not cached and downloads are disabled")
+        log.debug("Offline, using cached %s", url)
+        return body
+    # Only imported once a request is to be made
+    import httpx
+
+    headers = conditional_headers(cached)
+    body.parent.mkdir(parents=True, exist_ok=True)
+    with metrics.step("download") as step:
+        step.extra["url"] = url
+        for attempt in range(1, ATTEMPTS + 1):
+            try:
+                r = download(url, body, headers)
+                break
+            except httpx.TransportError as e:
+                if attempt == ATTEMPTS:
+                    raise
+                log.warning("Download of %s interrupted (%s), resuming", url, e)
+        step.extra["modified"] = r is not None
+        step.extra["bytes"] = body.stat().st_size
+    if r is None:
+        log.debug("%s not modified, using cached copy", url)
+        return body
+    write_meta(meta, url, r)
+    log.debug("Downloaded %s (%d bytes)", url, body.stat().st_size)
+    return body
+
+
+def stream(url: str) -> Iterator[bytes]:
+    """
+    Yield the body of an URL in chunks as it downloads, keeping the cached
+    copy up to date as ``fetch`` does.
+
+    A cached copy that is still current, or any cached copy when offline,
+    is read from disk. A transfer interrupted half way cannot be retried,
+    as its first chunks were handed out already; it is resumed by the next
+    ``fetch``.
+    """
+    body, meta = cache_paths(url)
+    cached = read_meta(meta) if body.exists() else None
+    if offline():
+        yield from read_chunks(fetch(url))
+        return
+    import httpx
+
+    body.parent.mkdir(parents=True, exist_ok=True)
+    partial = body.with_suffix(".part")
+    # The step also spans the processing of the chunks handed out
+    with metrics.step("download") as step, client().stream(
+        "GET", url, headers=conditional_headers(cached)
+    ) as r:
+        step.extra["url"] = url
+        step.extra["modified"] = r.status_code != httpx.codes.NOT_MODIFIED
+        if step.extra["modified"]:
+            r.raise_for_status()
+            write_meta(partial.with_suffix(".part.json"), url, r)
+            with open(partial, "wb") as f:
+                for chunk in r.iter_bytes(CHUNK_SIZE):
+                    f.write(chunk)
+                    yield chunk
+            partial.replace(body)
+            partial.with_suffix(".part.json").unlink(missing_ok=True)
+            write_meta(meta, url, r)
+            step.extra["bytes"] = body.stat().st_size
+            log.debug("Downloaded %s (%d bytes)", url, body.stat().st_size)
+            return
+    log.debug("%s not modified, using cached copy", url)
+    yield from read_chunks(body)
+
+
+def read_chunks(path: Path) -> Iterator[bytes]:
+    """Yield the content of a file in chunks."""
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
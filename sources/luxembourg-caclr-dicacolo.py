@@ -1,13 +1,16 @@
 from dataclasses import dataclass
-from io import BytesIO, TextIOWrapper
+from typing import Iterator
 from zipfile import ZipFile
 
-import httpx
 import polars as pl
 
+import metrics
+from sources import _caclr, _http
 
-def trimget(data: str, startpos: int, length: int) -> str:
-    return data[int(startpos) : int(startpos) + int(length)].rstrip(" ")
+# Identifies a row across releases, for incremental runs
+KEY = ("localite", "rue", "code_postal")
+# Columns with few distinct values, dictionary-encoded by --categorical
+CATEGORICAL = ("district", "canton", "commune", "localite", "rue", "code_postal")
 
 
 @dataclass
@@ -16,35 +19,32 @@ class CaclrDicacolo:
     delimiter: str = ","
 
     def get(self) -> pl.DataFrame:
-        r = httpx.get(self.url)
-        zipfile = ZipFile(BytesIO(r.content))
-        extracted_file = zipfile.open("TR.DICACOLO.RUCP")
-        rows = []
-        fieldnames = [
-            "district",
-            "canton",
-            "commune",
-            "localite",
-            "rue",
-            "code_postal",
-        ]
-        for data in TextIOWrapper(extracted_file, "iso-8859-15"):
-            rows.append([
-                trimget(data, 0, 40),
-                trimget(data, 40, 40),
-                trimget(data, 80, 40),
-                trimget(data, 120, 40),
-                trimget(data, 160, 40),
-                trimget(data, 200, 4),
-            ])
-        df = pl.DataFrame(rows, schema=fieldnames, orient="row")
-        df = df.with_columns(pl.all().cast(pl.String))
-        return df
+        archive = _http.fetch(self.url)
+        with metrics.step("decompress") as step, ZipFile(archive) as zipfile:
+            data = zipfile.read("TR.DICACOLO.RUCP")
+            step.extra["bytes"] = len(data)
+        return _caclr.read_fixed_width(data, _caclr.LAYOUTS["TR.DICACOLO.RUCP"])
+
+    def batches(self) -> Iterator[pl.DataFrame]:
+        # A zip can only be opened once complete, so decompression and
+        # parsing overlap the processing, but not the download
+        archive = _http.fetch(self.url)
+        # The step also spans the processing of the batches handed out
+        with metrics.step("decompress") as step, ZipFile(archive) as zipfile, zipfile.open(
+            "TR.DICACOLO.RUCP"
+        ) as f:
+            step.extra["bytes"] = zipfile.getinfo("TR.DICACOLO.RUCP").file_size
+            chunks = iter(lambda: f.read(_http.CHUNK_SIZE), b"")
+            yield from _caclr.fixed_width_batches(chunks, _caclr.LAYOUTS["TR.DICACOLO.RUCP"])
 
 
 def get():
     return CaclrDicacolo().get()
 
 
+def batches():
+    return CaclrDicacolo().batches()
+
+
 if __name__ == "__main__":
     print(get())
@@ -1,12 +1,28 @@
 from dataclasses import dataclass
 import logging
-from io import BytesIO
+from typing import Iterator
 
-import httpx
 import polars as pl
 
+from sources import _http
+from sources._batches import csv_batches
+
 logging.basicConfig(level=logging.DEBUG)
-log = logging.getLogger(__name__)
+log = logging.getLogger(f"csventrifuge.{__name__}")
+
+# Identifies a row across releases, for incremental runs
+KEY = ("id_geoportail",)
+# Columns with few distinct values, dictionary-encoded by --categorical
+CATEGORICAL = (
+    "rue_orig",
+    "code_commune",
+    "rue",
+    "numero",
+    "localite",
+    "code_postal",
+    "id_caclr_rue",
+    "commune",
+)
 
 
 @dataclass
@@ -14,23 +30,44 @@ class LuxembourgAddresses:
     url: str = "https://data.public.lu/fr/datasets/r/5cadc5b8-6a7d-4283-87bc-f9e58dd771f7"
     delimiter: str = ";"
 
-    def get(self) -> pl.DataFrame:
-        r = httpx.get(self.url, follow_redirects=True)
-        r.raise_for_status()
-        r.encoding = "utf-8-sig"
-        text = r.text
-        df = pl.read_csv(
-            BytesIO(text.encode("utf-8")),
+    def scan(self) -> pl.LazyFrame:
+        # The download is spooled to disk; Polars skips its byte order mark
+        lf = pl.scan_csv(
+            _http.fetch(self.url),
             separator=self.delimiter,
             encoding="utf8",
             infer_schema_length=0,
-        ).with_columns(pl.all().cast(pl.String))
-        df = df.with_columns(
-            pl.col("rue").alias("rue_orig"),
-            pl.col("id_geoportail").str.slice(0, 3).alias("code_commune"),
         )
-        df = df.select(["rue_orig", "code_commune", *[c for c in df.columns if c not in {"rue_orig", "code_commune"}]])
-        return df
+        return derive(lf)
+
+    def batches(self) -> Iterator[pl.DataFrame]:
+        # Parsed as it downloads; the values hold no quoted newlines
+        for frame in csv_batches(
+            _http.stream(self.url),
+            separator=self.delimiter,
+            infer_schema_length=0,
+        ):
+            yield derive(frame.lazy()).collect()
+
+    def get(self) -> pl.DataFrame:
+        return self.scan().collect()
+
+
+def derive(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Keep the original street name and add the commune code, in front."""
+    lf = lf.with_columns(
+        pl.col("rue").alias("rue_orig"),
+        pl.col("id_geoportail").str.slice(0, 3).alias("code_commune"),
+    )
+    return lf.select(["rue_orig", "code_commune", pl.exclude("rue_orig", "code_commune")])
+
+
+def scan():
+    return LuxembourgAddresses().scan()
+
+
+def batches():
+    return LuxembourgAddresses().batches()
 
 
 def get():
@@ -1,17 +1,32 @@
-# Call with get(), you get a collection containing dicts, and the field names list. That's the deal.
+# Call with scan() for a lazy frame, or get() for the collected DataFrame.
 
-import csv
 import polars as pl
 
+# Identifies a row across releases, for incremental runs
+KEY = ("id_geoportail",)
+# Columns with few distinct values, dictionary-encoded by --categorical
+CATEGORICAL = (
+    "code_commune",
+    "rue",
+    "numero",
+    "localite",
+    "code_postal",
+    "id_caclr_rue",
+    "commune",
+)
+
+
+def scan() -> pl.LazyFrame:
+    """Return a LazyFrame with a ``code_commune`` column."""
+    # Empty fields stay empty strings, as the csv module read them
+    lf = pl.scan_csv(
+        "stuff/addresses.csv", separator=";", infer_schema_length=0, empty_string_is_null=False
+    )
+    lf = lf.with_columns(pl.col("id_geoportail").str.slice(0, 3).alias("code_commune"))
+    # put ``code_commune`` first for consistency with other sources
+    return lf.select(["code_commune", pl.exclude("code_commune")])
+
 
 def get() -> pl.DataFrame:
     """Return a DataFrame with a ``code_commune`` column."""
-    with open("stuff/addresses.csv", "r") as csvfile:
-        csvreader = csv.DictReader(csvfile, delimiter=";")
-        addresses = [{k: v for k, v in row.items()} for row in csvreader]
-    for row in addresses:
-        row["code_commune"] = row["id_geoportail"][:3]
-    df = pl.DataFrame(addresses).with_columns(pl.all().cast(pl.String))
-    # put ``code_commune`` first for consistency with other sources
-    df = df.select(["code_commune", *[c for c in df.columns if c != "code_commune"]])
-    return df
+    return scan().collect()
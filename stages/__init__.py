@@ -0,0 +1,7 @@
+"""Output stages: artifacts derived from the result of a source.
+
+``stages/<source>.py`` defines ``STAGES``, a list of functions called with
+the rewritten data of the source as a ``polars.LazyFrame`` and the
+directory to write to. They run in the same process as the source, in
+parallel, when csventrifuge is given ``--stage-dir``.
+"""
@@ -0,0 +1,112 @@
+"""Writers for the text and binary formats of PostgreSQL's COPY.
+
+Rows are encoded with column expressions and written in batches; only
+floats are packed one value at a time, by ``struct``. See the File Formats section of
+https://www.postgresql.org/docs/current/sql-copy.html for both formats.
+"""
+
+import struct
+from pathlib import Path
+from typing import Dict, Union
+
+import polars as pl
+
+# Supported column types, and the PostgreSQL types they are loaded as
+PG_TYPES: Dict[pl.DataType, str] = {
+    pl.String: "text",
+    pl.Int32: "integer",
+    pl.Float64: "double precision",
+}
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+TEXT_ESCAPES = {"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"}
+# Rows encoded at once
+BATCH_SIZE = 1 << 16
+HEX_BYTES = {i: f"{i:02x}" for i in range(256)}
+NULL_LENGTH = "ffffffff"
+
+
+def quote(name: str) -> str:
+    """Quote an SQL identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def create_table(table: str, schema: pl.Schema) -> str:
+    """Return the CREATE TABLE statement matching the columns of ``schema``."""
+    columns = ",\n".join(
+        f"    {quote(name)} {PG_TYPES[dtype]}" for name, dtype in schema.items()
+    )
+    return f"CREATE TABLE {quote(table)} (\n{columns}\n);\n"
+
+
+def text_rows(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Return the rows of ``lf`` in the COPY text format, in a ``row`` column."""
+    fields = [
+        pl.col(name)
+        .cast(pl.String)
+        .str.replace_many(list(TEXT_ESCAPES), list(TEXT_ESCAPES.values()))
+        .fill_null(pl.lit("\\N"))
+        for name in lf.collect_schema().names()
+    ]
+    return lf.select(pl.concat_str(fields, separator="\t").alias("row"))
+
+
+def write_text(lf: pl.LazyFrame, path: Union[str, Path]) -> None:
+    """Write ``lf`` as a file for ``COPY ... FROM`` in the text format."""
+    text_rows(lf).sink_csv(
+        path, include_header=False, quote_style="never", batch_size=BATCH_SIZE
+    )
+
+
+def _hex(expr: pl.Expr, size: int) -> pl.Expr:
+    """Return the big-endian hex digits of a non-negative integer of ``size`` bytes."""
+    expr = expr.cast(pl.UInt64)
+    return pl.concat_str(
+        [
+            (expr // (1 << (8 * i)) % 256).replace_strict(HEX_BYTES, return_dtype=pl.String)
+            for i in reversed(range(size))
+        ]
+    )
+
+
+def _float8_hex(value: float) -> str:
+    """Return the hex digits of the big-endian IEEE 754 bytes of ``value``."""
+    return struct.pack(">d", value).hex()
+
+
+def _binary_field(name: str, dtype: pl.DataType) -> pl.Expr:
+    """Return the hex digits of the length and value of one field."""
+    column = pl.col(name)
+    if dtype == pl.String:
+        field = pl.concat_str(_hex(column.str.len_bytes(), 4), column.str.encode("hex"))
+    elif dtype == pl.Int32:
+        field = pl.concat_str(pl.lit("00000004"), _hex(column.cast(pl.Int64) % (1 << 32), 4))
+    elif dtype == pl.Float64:
+        field = pl.concat_str(
+            pl.lit("00000008"), column.map_elements(_float8_hex, return_dtype=pl.String)
+        )
+    else:
+        raise TypeError(f"{name}: {dtype} cannot be written in the COPY binary format")
+    return field.fill_null(pl.lit(NULL_LENGTH))
+
+
+def binary_rows(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Return the hex digits of the rows of ``lf`` in the COPY binary format, in a ``row`` column."""
+    schema = lf.collect_schema()
+    return lf.select(
+        pl.concat_str(
+            pl.lit(f"{len(schema):04x}"),
+            *(_binary_field(name, dtype) for name, dtype in schema.items()),
+        ).alias("row")
+    )
+
+
+def write_binary(lf: pl.LazyFrame, path: Union[str, Path]) -> None:
+    """Write ``lf`` as a file for ``COPY ... FROM`` in the binary format."""
+    rows = binary_rows(lf)
+    with open(path, "wb") as f:
+        # Signature, flags and header extension length
+        f.write(SIGNATURE + bytes(8))
+        for batch in rows.collect_batches(chunk_size=BATCH_SIZE):
+            f.write(bytes.fromhex(batch.get_column("row").str.join("").item()))
+        # File trailer: a field count of -1
+        f.write(b"\xff\xff")
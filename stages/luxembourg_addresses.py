@@ -0,0 +1,251 @@
+# Call the functions of STAGES with the rewritten addresses and a directory.
+
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, List, Mapping, Union
+
+import polars as pl
+
+from stages import _pgcopy
+
+log = logging.getLogger(f"csventrifuge.{__name__}")
+
+PROPERTIES: List[str] = [
+    "addr:housenumber", "addr:street", "addr:place", "addr:postcode", "addr:city", "ref:caclr"
+]
+# Written one feature per line instead of as a FeatureCollection;
+# .geojsons is RFC 8142 GeoJSON text sequences, .geojsonl newline-delimited
+SEQUENCE_SUFFIXES = {".geojsons": "\x1e", ".geojsonl": ""}
+# Columns of addr_columns written as tags to the .osm file, with their key
+OSM_TAGS: Mapping[str, str] = {column: column for column in PROPERTIES}
+# Rows written at once by the streaming writers
+BATCH_SIZE = 1 << 16
+# Columns the addresses are grouped by in the Postgres table
+ADDRESS_GROUP: List[str] = [
+    "rue", "localite", "code_postal", "id_caclr_rue", "lat_wgs84", "lon_wgs84",
+    "coord_est_luref", "coord_nord_luref", "id_geoportail", "commune",
+]
+XML_ESCAPES = {
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", "'": "&apos;", '"': "&quot;",
+    "\t": "&#9;", "\n": "&#10;", "\r": "&#13;",
+}
+
+
+def addr_columns(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """Return the addresses with OSM tags as column names, and numeric coordinates."""
+    lf = lf.with_columns(pl.col("lat_wgs84", "lon_wgs84").cast(pl.Float64, strict=False))
+
+    # Transformations
+    lf = lf.with_columns([
+        pl.when(pl.col("rue") == "Maison").then(pl.lit("")).otherwise(pl.col("rue")).alias("addr:street"),
+        pl.when(pl.col("rue") == "Maison").then(pl.col("localite")).otherwise(pl.lit("")).alias("addr:place"),
+        pl.col("numero").alias("addr:housenumber"),
+        pl.col("localite").alias("addr:city"),
+        pl.col("code_postal").alias("addr:postcode"),
+        pl.col("lat_wgs84"),
+        pl.col("lon_wgs84"),
+        pl.col("id_caclr_bat").alias("ref:caclr")
+    ])
+
+    # Select and reorder the columns
+    return lf.select([
+        "addr:housenumber", "addr:street", "addr:place", "addr:postcode", "addr:city",
+        "lat_wgs84", "lon_wgs84", "ref:caclr"
+    ])
+
+
+def valid_coordinates() -> pl.Expr:
+    """Rows whose coordinates are numbers within the WGS84 range."""
+    lat, lon = pl.col("lat_wgs84"), pl.col("lon_wgs84")
+    return (
+        lat.is_not_null() & lon.is_not_null() & lat.is_finite() & lon.is_finite()
+        & lat.is_between(-90, 90) & lon.is_between(-180, 180)
+    )
+
+
+def features(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Return the GeoJSON text of one Point feature per row, in a ``feature``
+    column, built with column expressions instead of Python objects.
+    """
+    return lf.select(
+        pl.concat_str(
+            pl.lit('{"type": "Feature", "geometry": {"type": "Point", "coordinates": ['),
+            pl.col("lon_wgs84").cast(pl.String),
+            pl.lit(", "),
+            pl.col("lat_wgs84").cast(pl.String),
+            pl.lit(']}, "properties": '),
+            pl.struct(PROPERTIES).struct.json_encode(),
+            pl.lit("}"),
+        ).alias("feature")
+    )
+
+
+def _sink_lines(lf: pl.LazyFrame, f: BinaryIO) -> None:
+    # The text written needs no quoting: JSON and XML escape what they must
+    lf.sink_csv(f, include_header=False, quote_style="never", batch_size=BATCH_SIZE)
+
+
+def write_geojson(lf: pl.LazyFrame, path: Union[str, Path]) -> int:
+    """
+    Stream the rows of ``lf`` as GeoJSON features to ``path``.
+
+    Rows with missing or out of range coordinates are left out; their
+    number is returned. The features are written as a FeatureCollection,
+    or as a sequence of features for the suffixes of
+    ``SEQUENCE_SUFFIXES``.
+    """
+    path = Path(path)
+    skipped = lf.select((~valid_coordinates()).sum()).collect().item()
+    text = features(lf.filter(valid_coordinates()))
+    with open(path, "wb") as f:
+        if path.suffix in SEQUENCE_SUFFIXES:
+            separator = SEQUENCE_SUFFIXES[path.suffix]
+            _sink_lines(text.select(pl.lit(separator) + pl.col("feature")), f)
+            return skipped
+        f.write(b'{"type": "FeatureCollection", "features": [\n')
+        # Every feature but the first is preceded by a comma
+        _sink_lines(
+            text.with_row_index().select(
+                pl.when(pl.col("index") > 0).then(pl.lit(",")).otherwise(pl.lit(""))
+                + pl.col("feature")
+            ),
+            f,
+        )
+        f.write(b"]}\n")
+    return skipped
+
+
+def xml_escape(expr: pl.Expr) -> pl.Expr:
+    """Escape a String column for an XML attribute value."""
+    return expr.str.replace_many(list(XML_ESCAPES), list(XML_ESCAPES.values()))
+
+
+def nodes(lf: pl.LazyFrame, tags: Mapping[str, str]) -> pl.LazyFrame:
+    """
+    Return the OSM XML of one node per row, in a ``node`` column, with
+    negative ids as for new objects and a tag per non-empty value.
+    """
+    tag_lines = [
+        pl.when(pl.col(column) != "").then(
+            pl.concat_str(
+                pl.lit(f"    <tag k='{''.join(XML_ESCAPES.get(c, c) for c in key)}' v='"),
+                xml_escape(pl.col(column).cast(pl.String)),
+                pl.lit("' />\n"),
+            )
+        )
+        for column, key in tags.items()
+    ]
+    return lf.with_row_index().select(
+        pl.concat_str(
+            pl.lit("  <node id='-"),
+            (pl.col("index") + 1).cast(pl.String),
+            pl.lit("' visible='true' lat='"),
+            pl.col("lat_wgs84").cast(pl.String),
+            pl.lit("' lon='"),
+            pl.col("lon_wgs84").cast(pl.String),
+            pl.lit("'>\n"),
+            *tag_lines,
+            pl.lit("  </node>"),
+            ignore_nulls=True,
+        ).alias("node")
+    )
+
+
+def write_osm(lf: pl.LazyFrame, path: Union[str, Path], tags: Mapping[str, str] = OSM_TAGS) -> int:
+    """
+    Stream the rows of ``lf`` as OSM XML nodes to ``path``, without
+    building a document tree.
+
+    ``tags`` maps columns to the tag keys they are written as. Rows with
+    missing or out of range coordinates are left out; their number is
+    returned.
+    """
+    skipped = lf.select((~valid_coordinates()).sum()).collect().item()
+    with open(path, "wb") as f:
+        f.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        f.write(b"<osm version='0.6' upload='false' generator='csventrifuge'>\n")
+        _sink_lines(nodes(lf.filter(valid_coordinates()), tags), f)
+        f.write(b"</osm>\n")
+    return skipped
+
+
+def josm(lf: pl.LazyFrame, directory: Path) -> None:
+    """Write the dated JOSM CSV, and point ``latest-addresses.csv`` at it."""
+    date_str = datetime.now().strftime("%Y-%m-%d")
+    output_csv_file = Path(directory) / f"{date_str}-addresses-josm.csv"
+    latest_csv_symlink = Path(directory) / "latest-addresses.csv"
+
+    addr_columns(lf).sink_csv(output_csv_file)
+
+    # Manage symlink
+    if latest_csv_symlink.exists() or latest_csv_symlink.is_symlink():
+        latest_csv_symlink.unlink()
+    latest_csv_symlink.symlink_to(output_csv_file.name)
+
+
+def geojson(lf: pl.LazyFrame, directory: Path) -> None:
+    """Write ``luxembourg-addresses.geojson``."""
+    skipped = write_geojson(addr_columns(lf), Path(directory) / "luxembourg-addresses.geojson")
+    if skipped:
+        log.warning("Left %d addresses without valid coordinates out of the GeoJSON.", skipped)
+
+
+def osm(lf: pl.LazyFrame, directory: Path) -> None:
+    """Write ``luxembourg-addresses.osm``, ready to be opened in JOSM."""
+    write_osm(addr_columns(lf), Path(directory) / "luxembourg-addresses.osm")
+
+
+def string_agg(column: str, separator: str) -> pl.Expr:
+    """
+    Join the sorted values of a group as SQL ``string_agg`` does: nulls are
+    left out, and a group of nulls gives null.
+    """
+    values = pl.col(column)
+    return pl.when(values.count() > 0).then(values.sort().str.join(separator))
+
+
+def address_table(lf: pl.LazyFrame) -> pl.LazyFrame:
+    """
+    Return one row per address point, with the house numbers and building
+    ids sharing it joined, typed for the ``addresses`` Postgres table.
+    """
+    return (
+        lf.filter(pl.col("numero").is_not_null())
+        .with_columns(
+            # Malformed values become null, as in addr_columns
+            pl.col("code_postal", "id_caclr_rue").cast(pl.Int32, strict=False),
+            pl.col("lat_wgs84", "lon_wgs84", "coord_est_luref", "coord_nord_luref").cast(
+                pl.Float64, strict=False
+            ),
+        )
+        .group_by(ADDRESS_GROUP, maintain_order=True)
+        .agg(string_agg("numero", ","), string_agg("id_caclr_bat", ";"))
+        .select(
+            "rue", "numero", "localite", "code_postal", "id_caclr_rue", "id_caclr_bat",
+            "lat_wgs84", "lon_wgs84", "coord_est_luref", "coord_nord_luref",
+            "id_geoportail", "commune",
+        )
+    )
+
+
+def postgres(lf: pl.LazyFrame, directory: Path) -> None:
+    """
+    Write the ``addresses`` table in the binary and text formats of COPY,
+    and ``luxembourg-addresses.sql`` which creates and loads it.
+    """
+    directory = Path(directory).resolve()
+    table = address_table(lf).collect()
+    binary = directory / "luxembourg-addresses.pgcopy"
+    _pgcopy.write_binary(table.lazy(), binary)
+    _pgcopy.write_text(table.lazy(), directory / "luxembourg-addresses.copy")
+    literal = str(binary).replace("'", "''")
+    (directory / "luxembourg-addresses.sql").write_text(
+        "DROP TABLE IF EXISTS addresses;\n"
+        + _pgcopy.create_table("addresses", table.schema)
+        + f"\\copy addresses FROM '{literal}' WITH (FORMAT binary)\n"
+    )
+
+
+STAGES = [josm, geojson, osm, postgres]
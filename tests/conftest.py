@@ -7,27 +7,33 @@ import tempfile
 import httpx
 import pytest
 
+from sources import _http
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache(monkeypatch, tmp_path):
+    """Keep downloads and snapshots of the tests out of the user's cache."""
+    monkeypatch.setenv("CSVENTRIFUGE_CACHE", str(tmp_path / "cache"))
+    monkeypatch.delenv(_http.OFFLINE, raising=False)
+
+
+@pytest.fixture()
+def serve(monkeypatch):
+    """Answer every request of the shared HTTP client with the given body."""
+    def _serve(response):
+        if isinstance(response, str):
+            response = response.encode("utf-8")
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=response))
+        monkeypatch.setattr(_http, "_client", httpx.Client(transport=transport))
+    return _serve
+
+
 @pytest.fixture()
-def run_source(monkeypatch):
+def run_source(monkeypatch, serve):
     def _run(module: str, response):
-        if isinstance(response, bytes):
-            class Resp:
-                def __init__(self, content):
-                    self.content = content
-                def raise_for_status(self):
-                    pass
-            monkeypatch.setattr(httpx, "get", lambda url, **kwargs: Resp(response))
-        else:
-            class Resp:
-                def __init__(self, text):
-                    self.text = text
-                    self.encoding = "utf-8-sig"
-                def raise_for_status(self):
-                    pass
-            monkeypatch.setattr(httpx, "get", lambda url, **kwargs: Resp(response))
+        serve(response)
         tmp = tempfile.NamedTemporaryFile(delete=False)
         tmp.close()
         argv = ["csventrifuge.py", module, tmp.name]
@@ -0,0 +1,92 @@
+import sys
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+import csventrifuge
+import engine
+
+
+def test_read_batch_pairs_and_manifest(tmp_path):
+    manifest = tmp_path / "batch.txt"
+    manifest.write_text("# source outputs\nfoo foo.csv\n\nbar bar.csv bar.arrow  # trailing\n")
+    pairs = csventrifuge.read_batch(["baz=baz.csv,baz.parquet", str(manifest)])
+    assert pairs == [
+        ("baz", ["baz.csv", "baz.parquet"]),
+        ("foo", ["foo.csv"]),
+        ("bar", ["bar.csv", "bar.arrow"]),
+    ]
+
+
+def test_load_book_shares_frame_between_links(tmp_path):
+    path = tmp_path / "rue.csv"
+    path.write_text("Rue A\tRue Alpha\n")
+    (tmp_path / "other").mkdir()
+    link = tmp_path / "other" / "rue.csv"
+    link.symlink_to(path)
+    book = engine.load_book(path, "rules")
+    shared = engine.load_book(link, "rules")
+    assert shared.frame is book.frame
+    # usage is still counted per source
+    shared.add_counts(pl.DataFrame({"value": ["Rue A"], "count": [3]}))
+    assert shared["Rue A"].count == 3
+    assert book["Rue A"].count == 0
+
+
+def test_load_book_shares_frame_between_copies(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "rue.csv").write_text("Rue A\tRue Alpha\n")
+    book = engine.load_book(tmp_path / "a" / "rue.csv", "rules")
+    assert engine.load_book(tmp_path / "b" / "rue.csv", "rules").frame is book.frame
+
+
+def test_run_batch_keeps_going_after_failure(tmp_path):
+    source_name = "temp_batch"
+    src_path = Path("sources") / f"{source_name}.py"
+    src_path.write_text(
+        "import polars as pl\n\n" "def get():\n" "    return pl.DataFrame({'foo': ['val']})\n"
+    )
+    try:
+        out_file = tmp_path / "out.csv"
+        pairs = [("does_not_exist", [tmp_path / "missing.csv"]), (source_name, [out_file])]
+        assert not engine.run_batch(pairs, jobs=2)
+        assert out_file.read_text() == "foo\nval\n"
+        assert not (tmp_path / "missing.csv").exists()
+    finally:
+        src_path.unlink()
+
+
+def test_load_book_reads_unchanged_files_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "_loaded_books", {})
+    monkeypatch.setattr(engine, "_book_digests", {})
+    path = tmp_path / "rue.csv"
+    path.write_text("Rue A\tRue Alpha\n")
+    book = engine.load_book(path, "rules")
+
+    def read_bytes(self):
+        raise AssertionError(f"{self} read again")
+
+    monkeypatch.setattr(Path, "read_bytes", read_bytes)
+    assert engine.load_book(path, "rules").frame is book.frame
+    # A new process finds the hash in the metadata of the compiled book
+    monkeypatch.setattr(engine, "_loaded_books", {})
+    monkeypatch.setattr(engine, "_book_digests", {})
+    assert engine.load_book(path, "rules").frame.equals(book.frame)
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        (["--batch", "empty.txt"], "--batch lists no source"),
+        (["--batch", "foo=foo.csv", "--jobs", "0"], "--jobs must be at least 1"),
+    ],
+)
+def test_main_rejects_empty_batch_and_jobs(args, message, tmp_path, monkeypatch, capsys):
+    (tmp_path / "empty.txt").write_text("# nothing yet\n")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, "argv", ["csventrifuge.py", *args])
+    with pytest.raises(SystemExit):
+        csventrifuge.main()
+    assert message in capsys.readouterr().err
@@ -0,0 +1,113 @@
+import shutil
+import sys
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+import engine
+from sources import _batches
+
+ROWS = "".join(f"{i},Rue {'A' if i % 3 else 'B'}\n" for i in range(100))
+
+
+def test_line_blocks_end_on_newlines():
+    chunks = [b"ab", b"c\nd", b"e\nf\ng", b"h"]
+    blocks = list(_batches.line_blocks(chunks, size=3))
+    assert blocks == [b"abc\n", b"de\nf\n", b"gh"]
+    assert b"".join(blocks) == b"".join(chunks)
+
+
+def test_csv_batches_repeat_the_header():
+    data = _batches.BOM + ("id,rue\n" + ROWS).encode()
+    chunks = [data[i : i + 7] for i in range(0, len(data), 7)]
+    frames = list(_batches.csv_batches(chunks, size=64, infer_schema_length=0))
+    assert len(frames) > 1
+    assert all(frame.columns == ["id", "rue"] for frame in frames)
+    assert pl.concat(frames).equals(pl.read_csv(data, infer_schema_length=0))
+
+
+BATCHES = """
+import polars as pl
+
+def frames():
+    data = pl.read_csv({data!r}, infer_schema_length=0)
+    for start in range(0, len(data), 7):
+        yield data.slice(start, 7)
+"""
+
+
+@pytest.fixture
+def batch_source(tmp_path):
+    """Write a source handing out its rows in frames of 7, with its books."""
+    source_name = "temp_batches"
+    data = tmp_path / "data.csv"
+    data.write_text("id,rue\n" + ROWS)
+    src_path = Path("sources") / f"{source_name}.py"
+    rules_dir = Path("rules") / source_name
+    rules_dir.mkdir(parents=True)
+    (rules_dir / "rue.csv").write_text("Rue A\tRue Alpha\n")
+    filters_dir = Path("filters") / source_name
+    filters_dir.mkdir(parents=True)
+    (filters_dir / "id.csv").write_text("3\tnot an address\n")
+
+    def write(body):
+        src_path.write_text(BATCHES.format(data=str(data)) + body)
+        sys.modules.pop(f"sources.{source_name}", None)
+        return source_name
+
+    yield write
+    src_path.unlink()
+    sys.modules.pop(f"sources.{source_name}", None)
+    shutil.rmtree(rules_dir)
+    shutil.rmtree(filters_dir)
+
+
+def test_batches_match_get(batch_source, tmp_path):
+    source_name = batch_source("\ndef get():\n    return pl.concat(list(frames()))\n")
+    engine.run(source_name, [tmp_path / "get.csv"])
+    source_name = batch_source("\ndef batches():\n    return frames()\n")
+    engine.run(source_name, [tmp_path / "batches.csv", tmp_path / "batches.parquet"])
+    expected = (tmp_path / "get.csv").read_text()
+    assert (tmp_path / "batches.csv").read_text() == expected
+    assert "Rue Alpha" in expected and "\n3," not in expected
+    assert pl.read_parquet(tmp_path / "batches.parquet").equals(
+        pl.read_csv(tmp_path / "get.csv", infer_schema_length=0)
+    )
+
+
+def test_async_batches(batch_source, tmp_path):
+    source_name = batch_source("\ndef get():\n    return pl.concat(list(frames()))\n")
+    engine.run(source_name, [tmp_path / "get.csv"])
+    source_name = batch_source(
+        "\nasync def batches():\n"
+        "    for frame in frames():\n"
+        "        yield frame\n"
+    )
+    engine.run(source_name, [tmp_path / "batches.csv"])
+    assert (tmp_path / "batches.csv").read_text() == (tmp_path / "get.csv").read_text()
+
+
+def test_batches_error_is_raised(batch_source, tmp_path):
+    source_name = batch_source(
+        "\ndef batches():\n"
+        "    yield from list(frames())[:3]\n"
+        "    raise ConnectionError('dropped')\n"
+    )
+    with pytest.raises(ConnectionError, match="dropped"):
+        engine.run(source_name, [tmp_path / "out.csv"])
+
+
+def test_batches_are_gathered_for_incremental_runs(batch_source, tmp_path):
+    source_name = batch_source("\nKEY = ('id',)\n\ndef batches():\n    return frames()\n")
+    engine.run(source_name, [tmp_path / "full.csv"])
+    engine.run(source_name, [tmp_path / "incremental.csv"], incremental=True)
+    assert (tmp_path / "incremental.csv").read_text() == (tmp_path / "full.csv").read_text()
+
+
+def test_batches_writer_error_is_raised(batch_source, tmp_path):
+    source_name = batch_source("\ndef batches():\n    return frames()\n")
+    (tmp_path / "taken").mkdir()
+    with pytest.raises(Exception) as error:
+        engine.run(source_name, [tmp_path / "out.csv", tmp_path / "taken"])
+    assert not isinstance(error.value, engine.Closed)
@@ -0,0 +1,43 @@
+import zipfile
+
+import polars as pl
+
+from benchmarks import bench_pipeline, synthetic
+from sources import _caclr
+
+
+def test_synthetic_addresses_are_reproducible():
+    addresses = synthetic.addresses(1000, seed=3)
+    assert addresses.equals(synthetic.addresses(1000, seed=3))
+    assert addresses.columns[0] == "rue" and addresses.columns[-1] == "commune"
+    assert addresses.get_column("id_geoportail").is_unique().all()
+    assert addresses.get_column("rue").is_in(synthetic.streets().get_column("rue").implode()).all()
+
+
+def test_synthetic_dicacolo_parses(tmp_path):
+    path = tmp_path / "caclr.zip"
+    synthetic.write_dicacolo(path, 500)
+    with zipfile.ZipFile(path) as archive:
+        data = archive.read(synthetic.DICACOLO)
+    frame = _caclr.read_fixed_width(data, _caclr.LAYOUTS[synthetic.DICACOLO])
+    assert len(frame) == 500
+    assert frame.join(synthetic.dicacolo_seed().unique(), on=frame.columns, how="anti").is_empty()
+
+
+def test_synthetic_books(tmp_path):
+    synthetic.address_books(tmp_path, 100)
+    rules = pl.read_csv(
+        tmp_path / "rules" / "luxembourg_addresses" / "rue.csv", separator="\t", has_header=False
+    )
+    assert len(rules) == 100
+
+
+def test_compare_reports_regressions():
+    base = {"wall_s": 1.0, "peak_rss_bytes": 100, "steps": {"books": 0.5, "missing": 0.001}}
+    result = {"wall_s": 1.1, "peak_rss_bytes": 150, "steps": {"books": 0.7, "missing": 0.01}}
+    regressions = bench_pipeline.compare({"case": result}, {"case": base}, 0.2)
+    assert [line.split(":")[0] for line in regressions] == [
+        "case peak_rss_bytes",
+        "case steps.books",
+    ]
+    assert bench_pipeline.compare({"new": result}, {"case": base}, 0.2) == []
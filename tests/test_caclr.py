@@ -0,0 +1,90 @@
+import os
+import re
+from zipfile import ZipFile
+
+import pytest
+
+from sources import _caclr
+from .conftest import DATA_DIR
+
+SQL = os.path.join(os.path.dirname(__file__), os.pardir, "extra", "caclr", "import_caclr.sql")
+# CACLR files whose layout is described under another name in the SQL import
+SQL_FILES = {"COMMUALL": "COMMUNE"}
+
+
+def sql_offsets():
+    """Return the zero-based offset of every column, per file, from the SQL import."""
+    with open(SQL, "r", encoding="utf-8") as f:
+        sql = f.read()
+    offsets = {}
+    for block in re.split(r"\\COPY caclr_staging FROM ", sql)[1:]:
+        name = re.match(r"'caclr-export/([^']+)'", block).group(1)
+        offsets[name] = {
+            column.lower(): int(start) - 1
+            for start, column in re.findall(
+                r"substring\(data,\s*(\d+),\s*\d+\)[^,\n]*AS (\w+)", block
+            )
+        }
+    return offsets
+
+
+@pytest.mark.parametrize("name", sorted(_caclr.LAYOUTS))
+def test_layout_matches_sql_import(name):
+    expected = sql_offsets().get(SQL_FILES.get(name, name))
+    if expected is None:
+        pytest.skip(f"{name} is not imported by import_caclr.sql")
+    for field in _caclr.LAYOUTS[name]:
+        if field.name in expected:
+            assert field.offset == expected[field.name], field.name
+
+
+def test_read_fixed_width_lines():
+    layout = (_caclr.Field("code", 0, 2), _caclr.Field("nom", 2, 6))
+    data = "01Esch  \r\n02Bréi\r\n03".encode(_caclr.ENCODING)
+    df = _caclr.read_fixed_width(data, layout)
+    assert df.rows() == [("01", "Esch"), ("02", "Bréi"), ("03", "")]
+
+
+def test_read_fixed_width_empty():
+    df = _caclr.read_fixed_width(b"", _caclr.LAYOUTS["COMMUALL"])
+    assert df.height == 0
+    assert df.columns == [field.name for field in _caclr.LAYOUTS["COMMUALL"]]
+
+
+def test_read_commuall_from_extract():
+    with ZipFile(os.path.join(DATA_DIR, "caclr.zip")) as zipfile:
+        df = _caclr.read_fixed_width(zipfile.read("COMMUALL"), _caclr.LAYOUTS["COMMUALL"])
+    assert df.row(0) == ("01", "Luxembourg", "27.01.2009", "00", "O")
+
+
+def test_snapshot_is_built_once_per_extract(tmp_path, monkeypatch):
+    monkeypatch.setenv("CSVENTRIFUGE_CACHE", str(tmp_path / "cache"))
+    extract = tmp_path / "extract"
+    extract.mkdir()
+    with ZipFile(os.path.join(DATA_DIR, "caclr.zip")) as zipfile:
+        for name in ("COMMUALL", "LOCALITE", "DISTRICT"):
+            (extract / name).write_bytes(zipfile.read(name))
+
+    snapshot = _caclr.build_snapshot(extract, workers=2)
+    assert sorted(p.name for p in snapshot.iterdir()) == [
+        "COMMUALL.arrow",
+        "DISTRICT.arrow",
+        "LOCALITE.arrow",
+    ]
+    assert _caclr.table("LOCALITE", extract).equals(_caclr.read(extract / "LOCALITE"))
+    assert _caclr.build_snapshot(extract) == snapshot
+
+    # A new extract gets a new snapshot, and the old one is dropped
+    os.utime(extract / "DISTRICT", ns=(0, 0))
+    renewed = _caclr.build_snapshot(extract, workers=1)
+    assert renewed != snapshot
+    assert not snapshot.exists()
+    with pytest.raises(FileNotFoundError):
+        _caclr.table("RUE", extract)
+
+    # Snapshots of another extract directory are left alone
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "DISTRICT").write_bytes((extract / "DISTRICT").read_bytes())
+    assert _caclr.build_snapshot(other, workers=1).exists()
+    assert renewed.exists()
@@ -0,0 +1,69 @@
+import logging
+import shutil
+import sys
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+import engine
+
+
+@pytest.fixture
+def categorical_source(tmp_path):
+    source_name = "temp_categorical"
+    data = tmp_path / "data.csv"
+    data.write_text("id,rue,localite\n1,Rue A,X\n2,Rue B,\n3,Drop,Y\n4,Rue A,\n")
+    src_path = Path("sources") / f"{source_name}.py"
+    rules_dir = Path("rules") / source_name
+    rules_dir.mkdir(parents=True)
+    (rules_dir / "rue.csv").write_text("Rue A\tRue Alpha\n")
+    filters_dir = Path("filters") / source_name
+    filters_dir.mkdir(parents=True)
+    (filters_dir / "rue.csv").write_text("Drop\tnot an address\n")
+    enhance_dir = Path("enhance") / source_name / "rue"
+    enhance_dir.mkdir(parents=True)
+    (enhance_dir / "localite.csv").write_text("Rue Alpha\tAlphaville\n")
+
+    def write(categorical):
+        src_path.write_text(
+            "import polars as pl\n\n"
+            f"CATEGORICAL = {categorical!r}\n\n"
+            "def scan():\n"
+            f"    return pl.scan_csv({str(data)!r}, infer_schema_length=0)\n"
+        )
+        sys.modules.pop(f"sources.{source_name}", None)
+        return source_name
+
+    yield write
+    src_path.unlink()
+    sys.modules.pop(f"sources.{source_name}", None)
+    shutil.rmtree(rules_dir)
+    shutil.rmtree(filters_dir)
+    shutil.rmtree(enhance_dir.parent)
+
+
+def test_categorical_matches_strings(categorical_source, tmp_path, caplog):
+    source_name = categorical_source(("rue", "localite"))
+    engine.run(source_name, [tmp_path / "strings.csv"])
+    strings = caplog.text
+    caplog.clear()
+    out = [tmp_path / "encoded.csv", tmp_path / "encoded.parquet"]
+    engine.run(source_name, out, categorical=True)
+
+    assert (tmp_path / "encoded.csv").read_text() == (tmp_path / "strings.csv").read_text()
+    assert (tmp_path / "strings.csv").read_text() == (
+        "id,rue,localite\n1,Rue Alpha,Alphaville\n2,Rue B,\n4,Rue Alpha,Alphaville\n"
+    )
+    assert "No enhancement found for localite" in strings
+    assert caplog.text == strings
+    schema = pl.read_parquet_schema(tmp_path / "encoded.parquet")
+    assert schema["rue"] == pl.Enum(["Drop", "Rue A", "Rue Alpha", "Rue B"])
+
+
+def test_categorical_without_declared_columns(categorical_source, tmp_path, caplog):
+    source_name = categorical_source(())
+    with caplog.at_level(logging.WARNING, logger="csventrifuge"):
+        engine.run(source_name, [tmp_path / "out.csv"], categorical=True)
+    assert "declares no CATEGORICAL columns" in caplog.text
+    assert "Rue Alpha" in (tmp_path / "out.csv").read_text()
@@ -0,0 +1,333 @@
+import polars as pl
+import pytest
+
+import engine
+from engine import Book
+
+
+def test_compile_books_fuses_all_stages():
+    lf = pl.LazyFrame(
+        {
+            "id": ["1", "2", "3", "4"],
+            "rue": ["Rue A", "Rue B", "Rue A", "Rue C"],
+            "localite": ["X", "Y", "Z", "W"],
+        }
+    )
+    filterbook = {"id": Book.from_pairs([("4", "4")])}
+    rulebook = {"rue": Book.from_pairs([("Rue A", "Rue Alpha"), ("Rue Q", "Rue Quebec")])}
+    # The enhancement is keyed on the column rewritten by the rule above.
+    enhancebook = {"rue": {"localite": Book.from_pairs([("Rue Alpha", "Alphaville")])}}
+    plan = engine.compile_books(
+        ["id", "rue", "localite"], filterbook, rulebook, enhancebook, {"localite"}
+    )
+
+    usage = plan.usage(lf).collect()
+    assert usage["__rows"].item() == 4
+    assert usage["__kept"].item() == 3
+    for name, book in plan.counters:
+        book.add_counts(usage.select(pl.col(name).explode().struct.unnest()).drop_nulls())
+    assert filterbook["id"]["4"].count == 1
+    assert rulebook["rue"]["Rue A"].count == 2
+    assert rulebook["rue"]["Rue Q"].count == 0
+    assert enhancebook["rue"]["localite"]["Rue Alpha"].count == 2
+
+    out = plan.apply(lf).collect()
+    assert out.rows() == [
+        ("1", "Rue Alpha", "Alphaville"),
+        ("2", "Rue B", "Y"),
+        ("3", "Rue Alpha", "Alphaville"),
+    ]
+
+
+def test_book_rows_by_usage():
+    book = Book.from_pairs([("a", "A"), ("b", "B"), ("c", "C")])
+    book.add_counts(pl.DataFrame({"value": ["c", "a"], "count": [2, 1]}))
+    book.add_counts(pl.DataFrame({"value": ["a"], "count": [4]}))
+    assert list(book.rows(used=True)) == [("a", "A", 5), ("c", "C", 2)]
+    assert list(book.rows(used=False)) == [("b", "B", 0)]
+    assert book.total() == 7
+    assert book["a"].count == 5
+    assert "z" not in book
+
+
+def test_compile_books_on_dictionaries():
+    lf = pl.LazyFrame(
+        {
+            "id": ["1", "2", "3", "4", "5"],
+            "rue": ["Rue A", "Rue B", "Rue A", "Rue C", None],
+            "localite": ["X", "Y", "Z", "W", "V"],
+        }
+    )
+
+    def books():
+        filterbook = {"rue": Book.from_pairs([("Rue C", "not an address")])}
+        rulebook = {"rue": Book.from_pairs([("Rue A", "Rue Alpha")])}
+        # Keyed on an encoded column, and on one that is not
+        enhancebook = {
+            "rue": {"localite": Book.from_pairs([("Rue Alpha", "Alphaville")])},
+            "id": {"rue": Book.from_pairs([("2", "Rue Bravo")])},
+        }
+        return filterbook, rulebook, enhancebook
+
+    expected = engine.compile_books(
+        ["id", "rue", "localite"], *books(), {"localite"}
+    ).apply(lf).collect()
+
+    filterbook, rulebook, enhancebook = books()
+    frame, dictionaries = engine.encode(lf, ["rue", "localite"], rulebook, enhancebook)
+    assert frame.schema["rue"] == pl.Enum(
+        ["Rue A", "Rue Alpha", "Rue B", "Rue Bravo", "Rue C"]
+    )
+    plan = engine.compile_books(
+        ["id", "rue", "localite"],
+        filterbook,
+        rulebook,
+        enhancebook,
+        {"localite"},
+        dictionaries=dictionaries,
+    )
+    engine.tally(plan, plan.usage(frame.lazy()).collect())
+    assert filterbook["rue"]["Rue C"].count == 1
+    assert rulebook["rue"]["Rue A"].count == 2
+    assert enhancebook["rue"]["localite"]["Rue Alpha"].count == 2
+    assert enhancebook["id"]["rue"]["2"].count == 1
+
+    out = plan.apply(frame.lazy()).collect()
+    assert out.schema["localite"] == frame.schema["localite"]
+    assert engine.decode(out.lazy()).collect().equals(expected)
+
+
+def test_enhancement_levels():
+    enhancebook = {
+        "localite": {"commune": Book.from_pairs([])},
+        "id_rue": {"localite": Book.from_pairs([]), "rue": Book.from_pairs([])},
+        "id_bat": {"id_rue": Book.from_pairs([]), "rue": Book.from_pairs([])},
+        "code": {"code": Book.from_pairs([])},
+    }
+    assert engine.enhancement_levels(enhancebook) == [
+        ["code", "id_bat"],
+        ["id_rue"],
+        ["localite"],
+    ]
+
+    enhancebook["commune"] = {"id_bat": Book.from_pairs([])}
+    with pytest.raises(ValueError, match="cycle"):
+        engine.enhancement_levels(enhancebook)
+
+
+def test_compile_books_follows_enhancement_chains():
+    lf = pl.LazyFrame(
+        {
+            "id_bat": ["1", "2", "3"],
+            "id_rue": ["10", "20", "30"],
+            "rue": ["Rue A", "Rue B", "Rue C"],
+            "localite": ["X", "Y", "Z"],
+            "commune": ["-", "-", "-"],
+        }
+    )
+    # Listed downstream first: the levels decide the order
+    enhancebook = {
+        "localite": {"commune": Book.from_pairs([("Seltz", "Tandel"), ("Y", "Why")])},
+        "id_rue": {
+            "localite": Book.from_pairs([("11", "Seltz")]),
+            "rue": Book.from_pairs([("11", "Rue Eleven"), ("30", "Rue Thirty")]),
+        },
+        "id_bat": {
+            "id_rue": Book.from_pairs([("1", "11")]),
+            "rue": Book.from_pairs([("3", "Rue du Bâtiment")]),
+        },
+    }
+    plan = engine.compile_books(lf.collect_schema().names(), {}, {}, enhancebook, set())
+    engine.tally(plan, plan.usage(lf).collect())
+    assert plan.apply(lf).collect().rows() == [
+        ("1", "11", "Rue Eleven", "Seltz", "Tandel"),
+        ("2", "20", "Rue B", "Y", "Why"),
+        # The building is matched first, so the street book does not apply
+        ("3", "30", "Rue du Bâtiment", "Z", "-"),
+    ]
+    assert enhancebook["id_rue"]["rue"]["11"].count == 1
+    assert enhancebook["id_rue"]["rue"]["30"].count == 0
+
+
+def test_compile_books_conditional_rules():
+    lf = pl.LazyFrame(
+        {
+            "rue": ["Rue Churchill", "Rue Churchill", "Rue Churchill", "Rue A", None],
+            "localite": ["Esch", "Luxembourg", "Esch", "Esch", "Esch"],
+        }
+    )
+
+    def books():
+        return {
+            "rue": Book.from_pairs([("Rue Churchill", "Rue W. Churchill"), ("Rue A", "Rue Alpha")]),
+            "rue@localite+rue": Book.from_pairs(
+                [("Esch\tRue Churchill", "Bd Churchill"), ("Esch\tRue Q", "Rue Quebec")]
+            ),
+            "localite@rue": Book.from_pairs([("Rue A", "Esch-sur-Alzette")]),
+        }
+
+    rulebook = books()
+    plan = engine.compile_books(["rue", "localite"], {}, rulebook, {}, set())
+    engine.tally(plan, plan.usage(lf).collect())
+    out = plan.apply(lf).collect()
+    # The conditional rule wins, and looks up the values of the source
+    assert out.rows() == [
+        ("Bd Churchill", "Esch"),
+        ("Rue W. Churchill", "Luxembourg"),
+        ("Bd Churchill", "Esch"),
+        ("Rue Alpha", "Esch-sur-Alzette"),
+        (None, "Esch"),
+    ]
+    assert rulebook["rue@localite+rue"]["Esch\tRue Churchill"].count == 2
+    assert rulebook["rue@localite+rue"]["Esch\tRue Q"].count == 0
+    assert rulebook["rue"]["Rue Churchill"].count == 1
+    assert rulebook["localite@rue"]["Rue A"].count == 1
+
+    rulebook = books()
+    frame, dictionaries = engine.encode(lf, ["rue", "localite"], rulebook, {})
+    plan = engine.compile_books(
+        ["rue", "localite"], {}, rulebook, {}, set(), dictionaries=dictionaries
+    )
+    engine.tally(plan, plan.usage(frame.lazy()).collect())
+    assert engine.decode(plan.apply(frame.lazy())).collect().equals(out)
+    assert rulebook["rue@localite+rue"]["Esch\tRue Churchill"].count == 2
+    assert rulebook["rue"]["Rue Churchill"].count == 1
+
+
+def pattern_book():
+    return engine.PatternBook(
+        pl.DataFrame(
+            [
+                ("literal", "A la ", "À la "),
+                ("literal", "Saint ", "Saint-"),
+                ("literal", "Emile", "Émile"),
+                ("prefix", "Bd ", "Boulevard "),
+                ("suffix", " (Esch)", ""),
+                ("regex", r"^(\d+)e ", "${1}ème "),
+                ("fold", "rue emile mayrisch", "Rue Émile Mayrisch"),
+                ("prefix", "Av. ", "Avenue "),
+            ],
+            schema=["kind", "old", "new"],
+            orient="row",
+        ).select("old", "new", "kind")
+    )
+
+
+def test_pattern_book_rewrites_and_counts():
+    book = pattern_book()
+    values = pl.Series(
+        [
+            "A la Croix Saint Pierre",
+            "Bd Emile Krieps (Esch)",
+            "RUE EMILE MAYRISCH",
+            "2e Rue",
+            None,
+            "A la Croix Saint Pierre",
+        ]
+    )
+    assert book.rewrite(values).to_list() == [
+        "À la Croix Saint-Pierre",
+        "Boulevard Émile Krieps",
+        "Rue Émile Mayrisch",
+        "2ème Rue",
+        None,
+        "À la Croix Saint-Pierre",
+    ]
+    book.add_counts(values.drop_nulls().alias("value").value_counts())
+    assert book["A la "].count == 2
+    assert book["Saint "].count == 2
+    # Literal entries are case-sensitive
+    assert book["Emile"].count == 1
+    assert book["rue emile mayrisch"].count == 1
+    assert [old for old, _, _ in book.rows(used=False)] == ["Av. "]
+
+
+def test_compile_books_pattern_rules():
+    lf = pl.LazyFrame(
+        {
+            "rue": ["A la Siole", "A la Croix", "Rue Emile", None, "Rue B"],
+            "localite": ["X", "Y", "Z", "X", "X"],
+        }
+    )
+
+    def books():
+        # Plain rules list the exceptions to the patterns
+        return {
+            "rue": Book.from_pairs([("A la Siole", "À la Siole (X)")]),
+            "rue.pattern": pattern_book(),
+        }
+
+    rulebook = books()
+    plan = engine.compile_books(["rue", "localite"], {}, rulebook, {}, set())
+    assert engine.tally(plan, plan.usage(lf).collect()) == (5, 5)
+    out = plan.apply(lf).collect()
+    assert out.get_column("rue").to_list() == [
+        "À la Siole (X)",
+        "À la Croix",
+        "Rue Émile",
+        None,
+        "Rue B",
+    ]
+    assert rulebook["rue.pattern"]["A la "].count == 1
+    assert rulebook["rue.pattern"]["Emile"].count == 1
+    assert rulebook["rue"]["A la Siole"].count == 1
+
+    rulebook = books()
+    frame, dictionaries = engine.encode(lf, ["rue"], rulebook, {})
+    assert "Rue Émile" in dictionaries["rue"]
+    plan = engine.compile_books(
+        ["rue", "localite"], {}, rulebook, {}, set(), dictionaries=dictionaries
+    )
+    engine.tally(plan, plan.usage(frame.lazy()).collect())
+    assert engine.decode(plan.apply(frame.lazy())).collect().equals(out)
+    assert rulebook["rue.pattern"]["A la "].count == 1
+    assert rulebook["rue"]["A la Siole"].count == 1
+
+
+def test_compile_books_filters_in_one_predicate():
+    lf = pl.LazyFrame(
+        {
+            "rue": ["Rue A", "Rue A", "Lieu-dit Hei", None, "Rue B", "Rue C"],
+            "localite": ["Esch", "Luxembourg", "Esch", "Esch", "X", "Esch"],
+            "numero": ["2", "4", "1200", "7", None, "9999"],
+        }
+    )
+
+    def books():
+        return {
+            "numero": Book.from_pairs([("9999", "9999")]),
+            "rue.pattern": engine.PatternFilter(
+                pl.DataFrame(
+                    {
+                        "old": ["Lieu-dit ", None, "rue c"],
+                        "new": ["Lieu-dit ", None, "rue c"],
+                        "kind": ["prefix", "null", "fold"],
+                    }
+                )
+            ),
+            "numero.pattern": engine.PatternFilter(
+                pl.DataFrame({"old": ["1000.."], "new": ["1000.."], "kind": ["range"]})
+            ),
+            "localite+rue": Book.from_pairs([("Esch\tRue A", "Esch\tRue A")]),
+        }
+
+    filterbook = books()
+    plan = engine.compile_books(["rue", "localite", "numero"], filterbook, {}, {}, set())
+    assert engine.tally(plan, plan.usage(lf).collect()) == (6, 1)
+    out = plan.apply(lf).collect()
+    # As before, the plain filter of a column also drops its missing values
+    assert out.rows() == [("Rue A", "Luxembourg", "4")]
+    assert filterbook["numero"]["9999"].count == 1
+    assert [count for _, _, count in filterbook["rue.pattern"].rows(used=True)] == [1, 1]
+    assert filterbook["numero.pattern"].total() == 0
+    assert filterbook["localite+rue"]["Esch\tRue A"].count == 1
+
+    filterbook = books()
+    frame, dictionaries = engine.encode(lf, ["rue", "localite"], {}, {})
+    plan = engine.compile_books(
+        ["rue", "localite", "numero"], filterbook, {}, {}, set(), dictionaries=dictionaries
+    )
+    assert engine.tally(plan, plan.usage(frame.lazy()).collect()) == (6, 1)
+    assert engine.decode(plan.apply(frame.lazy())).collect().equals(out)
+    assert filterbook["rue.pattern"].total() == 2
+    assert filterbook["localite+rue"]["Esch\tRue A"].count == 1
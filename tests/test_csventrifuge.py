@@ -48,23 +48,32 @@ def test_is_valid_source_with_tempfile():
         os.unlink(tf.name)
 
 
-def test_is_valid_output_opens_file():
+def test_is_valid_output_returns_path():
     parser = argparse.ArgumentParser()
     tmp = tempfile.NamedTemporaryFile(delete=False)
+    tmp.write(b"kept")
     tmp.close()
     try:
-        handle = csventrifuge.is_valid_output(parser, tmp.name)
-        try:
-            assert not handle.closed
-            assert handle.name == tmp.name
-        finally:
-            handle.close()
+        path = csventrifuge.is_valid_output(parser, tmp.name)
+        assert str(path) == tmp.name
+        # The file is only written once the source is processed
+        with open(tmp.name, "rb") as f:
+            assert f.read() == b"kept"
     finally:
         os.unlink(tmp.name)
 
 
 def test_is_valid_output_error(monkeypatch):
     parser = argparse.ArgumentParser()
-    monkeypatch.setattr("builtins.open", lambda *a, **kw: (_ for _ in ()).throw(OSError()))
+    monkeypatch.setattr(os, "access", lambda *a, **kw: False)
     with pytest.raises(SystemExit):
         csventrifuge.is_valid_output(parser, "foo.csv")
+
+
+def test_is_valid_output_does_not_create_file(tmp_path):
+    parser = argparse.ArgumentParser()
+    path = csventrifuge.is_valid_output(parser, str(tmp_path / "new.csv"))
+    assert path == tmp_path / "new.csv"
+    assert not path.exists()
+    with pytest.raises(SystemExit):
+        csventrifuge.is_valid_output(parser, str(tmp_path / "missing" / "new.csv"))
@@ -0,0 +1,134 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from sources import _http
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve ``body`` with an ETag, honouring If-None-Match and If-Range."""
+
+    body = b"id;rue\n1;Grand-Rue\n"
+    etag = '"v1"'
+    requests = []
+    # Drop the connection half way through the next response
+    truncate = False
+
+    def do_GET(self):
+        type(self).requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if "Range" in self.headers and self.headers.get("If-Range") == self.etag:
+            start = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(self.body) - 1}/{len(self.body)}")
+        self.send_header("ETag", self.etag)
+        self.send_header("Last-Modified", "Wed, 05 Jun 2025 12:20:00 GMT")
+        self.send_header("Content-Length", str(len(self.body) - start))
+        self.end_headers()
+        if type(self).truncate:
+            type(self).truncate = False
+            self.wfile.write(self.body[start : start + 5])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(self.body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server(monkeypatch):
+    Handler.requests = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    monkeypatch.setattr(_http, "_client", None)
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/addresses.csv"
+    httpd.shutdown()
+    if _http._client is not None:
+        _http._client.close()
+
+
+def test_fetch_revalidates_cached_copy(server):
+    first = _http.fetch(server)
+    assert first.read_bytes() == Handler.body
+    assert "If-None-Match" not in Handler.requests[0]
+
+    second = _http.fetch(server)
+    assert second == first
+    assert Handler.requests[1]["If-None-Match"] == '"v1"'
+    assert Handler.requests[1]["If-Modified-Since"] == "Wed, 05 Jun 2025 12:20:00 GMT"
+    assert second.read_bytes() == Handler.body
+
+
+def test_fetch_replaces_changed_copy(server, monkeypatch):
+    _http.fetch(server)
+    monkeypatch.setattr(Handler, "body", b"id;rue\n2;Rue Neuve\n")
+    monkeypatch.setattr(Handler, "etag", '"v2"')
+    assert _http.fetch(server).read_bytes() == b"id;rue\n2;Rue Neuve\n"
+
+
+def test_fetch_offline(server, monkeypatch):
+    monkeypatch.setenv(_http.OFFLINE, "1")
+    with pytest.raises(FileNotFoundError):
+        _http.fetch(server)
+    monkeypatch.delenv(_http.OFFLINE)
+    _http.fetch(server)
+    monkeypatch.setenv(_http.OFFLINE, "1")
+    assert _http.fetch(server).read_bytes() == Handler.body
+    assert len(Handler.requests) == 1
+
+
+def interrupted(url, received, etag):
+    """Leave the state of a transfer that stopped after ``received``."""
+    body, _ = _http.cache_paths(url)
+    body.parent.mkdir(parents=True, exist_ok=True)
+    body.with_suffix(".part").write_bytes(received)
+    body.with_suffix(".part.json").write_text(json.dumps({"url": url, "etag": etag}))
+
+
+def test_fetch_resumes_interrupted_transfer(server):
+    interrupted(server, Handler.body[:7], '"v1"')
+    assert _http.fetch(server).read_bytes() == Handler.body
+    assert Handler.requests[0]["Range"] == "bytes=7-"
+    body, _ = _http.cache_paths(server)
+    assert not body.with_suffix(".part").exists()
+
+
+def test_fetch_retries_dropped_connection(server, monkeypatch):
+    monkeypatch.setattr(Handler, "truncate", True)
+    monkeypatch.setattr(_http, "CHUNK_SIZE", 4)
+    assert _http.fetch(server).read_bytes() == Handler.body
+    # The last incomplete chunk was not written, so it is requested again
+    assert Handler.requests[1]["Range"] == "bytes=4-"
+
+
+def test_fetch_restarts_transfer_of_old_version(server):
+    interrupted(server, b"stale", '"v0"')
+    assert _http.fetch(server).read_bytes() == Handler.body
+
+
+def test_fetch_streams_in_chunks(server, monkeypatch):
+    monkeypatch.setattr(_http, "CHUNK_SIZE", 4)
+    assert _http.fetch(server).read_bytes() == Handler.body
+
+
+def test_stream_yields_and_caches_body(server, monkeypatch):
+    monkeypatch.setattr(_http, "CHUNK_SIZE", 4)
+    chunks = list(_http.stream(server))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == Handler.body
+    body, _ = _http.cache_paths(server)
+    assert body.read_bytes() == Handler.body
+
+    assert b"".join(_http.stream(server)) == Handler.body
+    assert Handler.requests[1]["If-None-Match"] == '"v1"'
+    assert _http.fetch(server) == body
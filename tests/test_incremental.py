@@ -0,0 +1,70 @@
+import json
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+import engine
+from sources import cache_dir
+
+
+@pytest.fixture
+def keyed_source(tmp_path):
+    source_name = "temp_incremental"
+    data = tmp_path / "data.csv"
+    src_path = Path("sources") / f"{source_name}.py"
+    src_path.write_text(
+        "import polars as pl\n\n"
+        "KEY = ('id',)\n\n"
+        "def scan():\n"
+        f"    return pl.scan_csv({str(data)!r}, infer_schema_length=0)\n"
+    )
+    rules_dir = Path("rules") / source_name
+    rules_dir.mkdir(parents=True)
+    (rules_dir / "rue.csv").write_text("Rue A\tRue Alpha\n")
+    filters_dir = Path("filters") / source_name
+    filters_dir.mkdir(parents=True)
+    (filters_dir / "rue.csv").write_text("Drop\tnot an address\n")
+    yield source_name, data
+    src_path.unlink()
+    sys.modules.pop(f"sources.{source_name}", None)
+    shutil.rmtree(rules_dir)
+    shutil.rmtree(filters_dir)
+
+
+def test_incremental_matches_full_run(keyed_source, tmp_path):
+    source_name, data = keyed_source
+    out = tmp_path / "out.csv"
+    full = tmp_path / "full.csv"
+
+    data.write_text("id,rue\n1,Rue A\n2,Rue B\n3,Drop\n4,Rue C\n")
+    engine.run(source_name, [out], incremental=True)
+    changes = cache_dir() / "state" / source_name / "changes.json"
+    assert json.loads(changes.read_text())["full"]
+
+    data.write_text("id,rue\n5,Rue A\n1,Rue A\n2,Rue D\n3,Drop\n")
+    engine.run(source_name, [out], incremental=True)
+    engine.run(source_name, [full])
+    assert out.read_text() == full.read_text() == "id,rue\n5,Rue Alpha\n1,Rue Alpha\n2,Rue D\n"
+    assert json.loads(changes.read_text()) == {
+        "source": source_name,
+        "full": False,
+        "rows": 4,
+        "inserted": [{"id": "5"}],
+        "updated": [{"id": "2"}],
+        "deleted": [{"id": "4"}],
+    }
+
+
+def test_incremental_redoes_everything_when_books_change(keyed_source, tmp_path):
+    source_name, data = keyed_source
+    out = tmp_path / "out.csv"
+    data.write_text("id,rue\n1,Rue A\n2,Rue B\n")
+    engine.run(source_name, [out], incremental=True)
+
+    (Path("rules") / source_name / "rue.csv").write_text("Rue B\tRue Bravo\n")
+    engine.run(source_name, [out], incremental=True)
+    assert out.read_text() == "id,rue\n1,Rue A\n2,Rue Bravo\n"
+    changes = cache_dir() / "state" / source_name / "changes.json"
+    assert json.loads(changes.read_text())["full"]
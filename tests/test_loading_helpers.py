@@ -1,4 +1,10 @@
+import os
+
+import polars as pl
+import pytest
+
 import csventrifuge
+import engine
 
 
 def test_load_rules_single_file():
@@ -24,3 +30,69 @@ def test_load_filters_simple():
     value = "005C00508003461_5126_15-17"
     assert filters["id_geoportail"][value].value == value
     assert filters["id_geoportail"][value].count == 0
+
+
+def test_load_book_reuses_compiled_form(tmp_path, monkeypatch):
+    path = tmp_path / "rue.csv"
+    path.write_text("# comment\nRue A\tRue Alpha\nRue B\tRue Bravo\nRue A\tRue Aleph\n")
+    book = engine.load_book(path, "rules")
+    assert list(book) == ["Rue B", "Rue A"]
+    assert book["Rue A"].value == "Rue Aleph"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("book was parsed again")
+
+    # Unchanged, or only touched: the compiled form is used as is
+    with monkeypatch.context() as m:
+        m.setattr(engine, "read_book", fail)
+        assert engine.load_book(path, "rules").frame.equals(book.frame)
+        os.utime(path, ns=(0, 0))
+        assert engine.load_book(path, "rules").frame.equals(book.frame)
+
+    path.write_text("Rue C\tRue Charlie\n")
+    assert list(engine.load_book(path, "rules")) == ["Rue C"]
+
+
+def test_load_book_conditional_rule(tmp_path):
+    path = tmp_path / "rue@localite+rue.csv"
+    path.write_text("# Only in Esch\nEsch\tRue Churchill\tBd Churchill\n")
+    book = engine.load_book(path, "rules")
+    assert list(book) == ["Esch\tRue Churchill"]
+    assert book["Esch\tRue Churchill"].value == "Bd Churchill"
+    assert engine.rule_columns(path.stem) == ("rue", ["localite", "rue"])
+    assert engine.rule_columns("rue") == ("rue", ["rue"])
+
+
+def test_load_book_pattern_rules(tmp_path):
+    path = tmp_path / "rue.pattern.csv"
+    path.write_text(
+        "# Accents\nliteral\tEmile\tÉmile\nprefix\tBd \tBoulevard \nsuffix\t (Esch)\t\n"
+    )
+    book = engine.PatternBook(engine.load_book(path, "rules").frame)
+    assert book.frame.get_column("kind").to_list() == ["literal", "prefix", "suffix"]
+    assert book.rewrite(pl.Series(["Bd Emile (Esch)"])).to_list() == ["Boulevard Émile"]
+
+    path.write_text("glob\tBd*\tBoulevard\n")
+    with pytest.raises(ValueError, match='unknown pattern kind "glob"'):
+        engine.load_book(path, "rules")
+
+
+def test_load_pattern_and_multi_column_filters(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    filters = tmp_path / "filters" / "s"
+    filters.mkdir(parents=True)
+    (filters / "rue.pattern.csv").write_text("null\nprefix\tLieu-dit \tnot a street\nrange\t..10\n")
+    (filters / "localite+rue.csv").write_text("Esch\tRue A\twrong\nEsch\tRue B\n")
+    (filters / "localite+nope.csv").write_text("Esch\tx\n")
+    filterbook = engine.load_filters("s", ["rue", "localite"])
+    assert list(filterbook) == ["rue.pattern", "localite+rue"]
+    assert filterbook["rue.pattern"].frame.rows() == [
+        (None, None, "null"),
+        ("Lieu-dit ", "Lieu-dit ", "prefix"),
+        ("..10", "..10", "range"),
+    ]
+    assert list(filterbook["localite+rue"]) == ["Esch\tRue A", "Esch\tRue B"]
+
+    (filters / "rue.pattern.csv").write_text("range\t1-10\n")
+    with pytest.raises(ValueError, match='range "1-10"'):
+        engine.load_filters("s", ["rue"])
@@ -0,0 +1,118 @@
+import json
+import logging
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+import csventrifuge
+import engine
+import metrics
+from .conftest import DATA_DIR
+
+
+@pytest.fixture
+def metered_source():
+    source_name = "temp_metrics"
+    src_path = Path("sources") / f"{source_name}.py"
+    src_path.write_text(
+        "import polars as pl\n\n"
+        "def get():\n"
+        "    return pl.DataFrame({'rue': ['Rue A', 'Rue B', 'Drop', 'Rue A']})\n"
+    )
+    rules_dir = Path("rules") / source_name
+    rules_dir.mkdir(parents=True)
+    (rules_dir / "rue.csv").write_text("Rue A\tRue Alpha\nRue Z\tRue Zulu\n")
+    filters_dir = Path("filters") / source_name
+    filters_dir.mkdir(parents=True)
+    (filters_dir / "rue.csv").write_text("Drop\tnot an address\n")
+    yield source_name
+    src_path.unlink()
+    sys.modules.pop(f"sources.{source_name}", None)
+    shutil.rmtree(rules_dir)
+    shutil.rmtree(filters_dir)
+
+
+def test_run_records_steps(metered_source, tmp_path, caplog):
+    recorder = metrics.start()
+    try:
+        with caplog.at_level(logging.INFO):
+            engine.run(metered_source, [tmp_path / "out.csv"])
+    finally:
+        assert metrics.stop() is recorder
+    steps = {step.name: step for step in recorder.steps}
+    assert list(steps) == [
+        "source", "load_rules", "load_enhancements", "load_filters", "books", "missing", "write"
+    ]
+    assert all(step.source == metered_source for step in recorder.steps)
+    assert steps["source"].rows_out == 4
+    assert steps["load_rules"].rows_out == 2
+    assert (steps["books"].rows_in, steps["books"].rows_out) == (4, 3)
+    assert steps["books"].extra["books"] == [
+        {"kind": "filters", "key": "rue", "target": "", "entries": 1, "hits": 1},
+        {"kind": "rules", "key": "rue", "target": "", "entries": 2, "hits": 2},
+    ]
+    assert steps["write"].rows_out == 3
+    assert all(step.wall_s >= 0 and step.peak_rss_bytes > 0 for step in recorder.steps)
+    # Ratios are logged as percentages
+    assert "1 values out of 4 dropped, 25.00%" in caplog.messages
+    assert "2 values out of 3 replaced, 66.67%" in caplog.messages
+
+
+def test_metrics_json(metered_source, tmp_path, monkeypatch, capsys):
+    report = tmp_path / "metrics.json"
+    argv = ["csventrifuge.py", metered_source, str(tmp_path / "out.csv")]
+    monkeypatch.setattr(sys, "argv", argv + ["--metrics-json", str(report), "--profile"])
+    csventrifuge.main()
+    data = json.loads(report.read_text())
+    assert data["format"] == metrics.REPORT_FORMAT
+    assert [step["name"] for step in data["steps"]][-1] == "write"
+    assert set(data["plans"]) == {f"{metered_source}/usage", f"{metered_source}/apply"}
+    assert f"{metered_source} write:" in capsys.readouterr().err
+
+
+@pytest.fixture
+def streamed_source():
+    source_name = "temp_streamed"
+    src_path = Path("sources") / f"{source_name}.py"
+    src_path.write_text(
+        "from sources import _http\n"
+        "from sources._batches import csv_batches\n\n"
+        "def batches():\n"
+        "    yield from csv_batches(_http.stream('https://example.invalid/rue.csv'))\n"
+    )
+    yield source_name
+    src_path.unlink()
+    sys.modules.pop(f"sources.{source_name}", None)
+
+
+def test_streamed_download_is_recorded(streamed_source, serve, tmp_path):
+    serve("rue\nRue A\nRue B\n")
+    recorder = metrics.start()
+    try:
+        engine.run(streamed_source, [tmp_path / "out.csv"])
+    finally:
+        metrics.stop()
+    (download,) = [step for step in recorder.steps if step.name == "download"]
+    assert download.source == streamed_source
+    assert download.extra["modified"] and download.extra["bytes"] == 16
+
+
+def test_dicacolo_batches_record_download_and_decompress(serve, tmp_path):
+    with open(Path(DATA_DIR) / "caclr.zip", "rb") as f:
+        serve(f.read())
+    recorder = metrics.start()
+    try:
+        engine.run("luxembourg-caclr-dicacolo", [tmp_path / "out.csv"])
+    finally:
+        metrics.stop()
+    steps = {step.name: step for step in recorder.steps}
+    assert steps["download"].source == steps["decompress"].source == "luxembourg-caclr-dicacolo"
+    assert steps["decompress"].extra["bytes"] > 0
+
+
+def test_step_without_recorder():
+    with metrics.step("nothing", rows_in=1) as step:
+        step.rows_out = 1
+    assert step.wall_s == 0
@@ -16,7 +16,7 @@ class TestNoRuleForNone(unittest.TestCase):
         argv = ["csventrifuge.py", "test_source", tmp.name]
         with mock.patch.object(sys, "argv", argv):
             logging.basicConfig(level=logging.DEBUG)
-            with self.assertLogs("__main__", level="DEBUG") as cm:
+            with self.assertLogs("csventrifuge", level="DEBUG") as cm:
                 runpy.run_module("csventrifuge", run_name="__main__")
         os.unlink(tmp.name)
         self.assertNotIn("No rule for [foo] None", "\n".join(cm.output))
@@ -0,0 +1,72 @@
+import math
+import struct
+
+import polars as pl
+
+from stages import _pgcopy
+
+
+def read_binary(data: bytes) -> list:
+    """Decode a COPY binary file, following the spec rather than the writer."""
+    assert data[:11] == b"PGCOPY\n\xff\r\n\x00"
+    flags, extension = struct.unpack(">ii", data[11:19])
+    assert flags == 0
+    pos = 19 + extension
+    rows = []
+    while True:
+        (count,) = struct.unpack(">h", data[pos : pos + 2])
+        pos += 2
+        if count == -1:
+            break
+        row = []
+        for _ in range(count):
+            (length,) = struct.unpack(">i", data[pos : pos + 4])
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(data[pos : pos + length])
+            pos += length
+        rows.append(row)
+    assert pos == len(data)
+    return rows
+
+
+def frame() -> pl.DataFrame:
+    return pl.DataFrame(
+        {
+            "name": ["Rue A", "Éch\ttab", None, ""],
+            "number": [1, -2, None, 2147483647],
+            "value": [49.6, -0.0, math.inf, None],
+        },
+        schema={"name": pl.String, "number": pl.Int32, "value": pl.Float64},
+    )
+
+
+def test_write_binary(tmp_path):
+    path = tmp_path / "out.pgcopy"
+    _pgcopy.write_binary(frame().lazy(), path)
+    assert read_binary(path.read_bytes()) == [
+        [b"Rue A", struct.pack(">i", 1), struct.pack(">d", 49.6)],
+        ["Éch\ttab".encode(), struct.pack(">i", -2), struct.pack(">d", -0.0)],
+        [None, None, struct.pack(">d", math.inf)],
+        [b"", struct.pack(">i", 2147483647), None],
+    ]
+
+
+def test_write_text(tmp_path):
+    path = tmp_path / "out.copy"
+    _pgcopy.write_text(frame().lazy(), path)
+    assert path.read_text(encoding="utf-8") == (
+        "Rue A\t1\t49.6\n" "Éch\\ttab\t-2\t-0.0\n" "\\N\t\\N\tinf\n" "\t2147483647\t\\N\n"
+    )
+
+
+def test_create_table():
+    assert _pgcopy.create_table("t", frame().schema) == (
+        'CREATE TABLE "t" (\n'
+        '    "name" text,\n'
+        '    "number" integer,\n'
+        '    "value" double precision\n'
+        ");\n"
+    )
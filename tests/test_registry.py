@@ -0,0 +1,49 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import registry
+
+
+def test_module_names_leaves_helpers_out():
+    names = registry.module_names("sources")
+    assert "luxembourg_addresses" in names
+    assert not [name for name in names if name.startswith("_")]
+    # The second call is answered from the cache
+    assert registry.module_names("sources") == names
+
+
+def test_module_names_sees_new_sources():
+    path = Path("sources") / "temp_registry.py"
+    registry.module_names("sources")
+    path.write_text("def get():\n    pass\n")
+    try:
+        assert "temp_registry" in registry.module_names("sources")
+    finally:
+        path.unlink()
+    assert "temp_registry" not in registry.module_names("sources")
+
+
+def test_load_module_missing():
+    with pytest.raises(ImportError):
+        registry.load_module("does_not_exist", "sources")
+
+
+@pytest.mark.parametrize("argv", [["--help"], ["--list-sources"], ["does_not_exist"]])
+def test_cli_starts_without_polars(argv):
+    # Runs the CLI and reports the modules it imported
+    code = (
+        "import runpy, sys\n"
+        f"sys.argv = ['csventrifuge.py'] + {argv!r}\n"
+        "try:\n"
+        "    runpy.run_module('csventrifuge', run_name='__main__')\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(sorted(m for m in sys.modules if m.split('.')[0] in ('polars', 'httpx', 'sources')))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.splitlines()[-1] == "['sources']"
@@ -0,0 +1,99 @@
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+import engine
+
+
+@pytest.fixture
+def rerun_source(tmp_path):
+    source_name = "temp_rerun"
+    data = tmp_path / "data.csv"
+    data.write_text("id,rue,localite\n1,Rue A,Ville\n2,Rue B,\n3,Drop,Ville\n")
+    src_path = Path("sources") / f"{source_name}.py"
+    src_path.write_text(
+        "import polars as pl\n\n"
+        "def scan():\n"
+        f"    return pl.scan_csv({str(data)!r}, infer_schema_length=0)\n"
+    )
+    rules_dir = Path("rules") / source_name
+    rules_dir.mkdir(parents=True)
+    (rules_dir / "rue.csv").write_text("Rue A\tRue Alpha\n")
+    (rules_dir / "localite.csv").write_text("Ville\tStad\n")
+    filters_dir = Path("filters") / source_name
+    filters_dir.mkdir(parents=True)
+    (filters_dir / "rue.csv").write_text("Drop\tnot an address\n")
+    enhance_dir = Path("enhance") / source_name / "rue"
+    enhance_dir.mkdir(parents=True)
+    (enhance_dir / "localite.csv").write_text("Rue B\tDuerf\n")
+    yield source_name, data
+    src_path.unlink()
+    sys.modules.pop(f"sources.{source_name}", None)
+    shutil.rmtree(rules_dir)
+    shutil.rmtree(filters_dir)
+    shutil.rmtree(Path("enhance") / source_name)
+
+
+def test_rerun_recomputes_changed_columns(rerun_source, tmp_path, caplog):
+    source_name, data = rerun_source
+    out = tmp_path / "out.csv"
+    engine.rerun(source_name, [out])
+    assert out.read_text() == "id,rue,localite\n1,Rue Alpha,Stad\n2,Rue B,Duerf\n"
+
+    # The cached input is used: changes to the data are not picked up
+    data.write_text("id,rue,localite\n9,Rue Z,Z\n")
+    (Path("rules") / source_name / "localite.csv").write_text("Ville\tStadt\n")
+    with caplog.at_level("INFO"):
+        engine.rerun(source_name, [out])
+    assert "Recomputing localite" in caplog.messages
+    assert out.read_text() == "id,rue,localite\n1,Rue Alpha,Stadt\n2,Rue B,Duerf\n"
+    # Usage of the books that were not recomputed is kept
+    assert 'Did not use [rue] rule "Rue A" -> "Rue Alpha"' not in caplog.messages
+
+    (Path("rules") / source_name / "rue.csv").write_text("Rue B\tRue Bravo\n")
+    with caplog.at_level("INFO"):
+        engine.rerun(source_name, [out])
+    assert "Recomputing localite, rue" in caplog.messages
+    assert out.read_text() == "id,rue,localite\n1,Rue A,Stadt\n2,Rue Bravo,\n"
+
+
+def test_dirty_columns_follow_enhancements():
+    book = engine.Book.from_pairs([])
+    stages = [
+        engine.Stage("rules", "rules/s/a.csv", "a", "a", book),
+        engine.Stage("enhance", "enhance/s/a/b.csv", "b", "a", book),
+        engine.Stage("enhance", "enhance/s/c/a.csv", "a", "c", book),
+    ]
+    books = {
+        stage.path: {"sha256": "old", "writes": stage.writes, "reads": stage.reads}
+        for stage in stages
+    }
+    hashes = {stage.path: "old" for stage in stages}
+    assert engine.dirty_columns(stages, hashes, books, []) == set()
+    hashes["enhance/s/a/b.csv"] = "new"
+    # b looks up a before it is enhanced, which was not kept
+    assert engine.dirty_columns(stages, hashes, books, []) == {"a", "b"}
+    assert engine.dirty_columns(stages, hashes, books, ["__lookup_a_b"]) == {"b"}
+    books["filters/s/a.csv"] = {"sha256": "old", "writes": "", "reads": "a"}
+    assert engine.dirty_columns(stages, hashes, books, []) is None
+
+
+def test_dirty_columns_read_conditional_rules_from_the_source():
+    book = engine.Book.from_pairs([])
+    stages = [
+        engine.Stage("rules", "rules/s/a.csv", "a", "a", book, ("a",)),
+        engine.Stage("rules", "rules/s/b.csv", "b", "b", book, ("b",)),
+        engine.Stage("rules", "rules/s/b@a+b.csv", "b", "b", book, ("a", "b")),
+    ]
+    books = {
+        stage.path: {"sha256": "old", "writes": stage.writes, "reads": stage.reads}
+        for stage in stages
+    }
+    hashes = {stage.path: "old" for stage in stages}
+    hashes["rules/s/b.csv"] = "new"
+    # The cached a was rewritten, so it is recomputed for b@a+b to look up
+    assert engine.dirty_columns(stages, hashes, books, []) == {"a", "b"}
+    hashes["rules/s/b.csv"], hashes["rules/s/a.csv"] = "old", "new"
+    assert engine.dirty_columns(stages, hashes, books, []) == {"a"}
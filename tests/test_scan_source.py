@@ -0,0 +1,37 @@
+import types
+
+import polars as pl
+import pytest
+
+import engine
+from sources import luxembourg_addresses_debug
+
+
+def test_scan_source_prefers_scan():
+    module = types.ModuleType("lazy_source")
+    module.scan = lambda: pl.LazyFrame({"foo": ["scanned"]})
+    module.get = lambda: pl.DataFrame({"foo": ["got"]})
+    lf = engine.scan_source(module, "lazy_source")
+    assert isinstance(lf, pl.LazyFrame)
+    assert lf.collect()["foo"].to_list() == ["scanned"]
+
+
+def test_scan_source_falls_back_to_get():
+    module = types.ModuleType("eager_source")
+    module.get = lambda: pl.DataFrame({"foo": ["got"]})
+    lf = engine.scan_source(module, "eager_source")
+    assert lf.collect()["foo"].to_list() == ["got"]
+
+
+def test_scan_source_without_entry_point():
+    with pytest.raises(ImportError):
+        engine.scan_source(types.ModuleType("empty"), "empty")
+
+
+def test_debug_source_keeps_empty_fields(tmp_path, monkeypatch):
+    (tmp_path / "stuff").mkdir()
+    (tmp_path / "stuff" / "addresses.csv").write_text("id_geoportail;rue;numero\n0011;;1\n")
+    monkeypatch.chdir(tmp_path)
+    df = luxembourg_addresses_debug.get()
+    assert df.columns == ["code_commune", "id_geoportail", "rue", "numero"]
+    assert df.row(0) == ("001", "0011", "", "1")
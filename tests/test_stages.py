@@ -0,0 +1,138 @@
+import json
+import math
+from xml.etree import ElementTree
+from pathlib import Path
+
+import polars as pl
+
+import engine
+from stages import luxembourg_addresses
+
+
+def addresses() -> pl.LazyFrame:
+    return pl.LazyFrame(
+        {
+            "addr:housenumber": ["1", "2A", "3", "4"],
+            "addr:street": ['Rue "A"', "Rue B", "Rue C", None],
+            "addr:place": ["", "", "", "Lieu-dit"],
+            "addr:postcode": ["1234", "1234", "1234", "5678"],
+            "addr:city": ["Éch", "Éch", "Éch", "Ville"],
+            "lat_wgs84": [49.6, math.nan, 95.0, 49.5],
+            "lon_wgs84": [6.1, 6.1, 6.1, None],
+            "ref:caclr": ["1", "2", "3", "4"],
+        }
+    )
+
+
+def test_write_geojson_feature_collection(tmp_path):
+    path = tmp_path / "out.geojson"
+    lf = addresses().with_columns(pl.col("lon_wgs84").fill_null(5.9))
+    assert luxembourg_addresses.write_geojson(lf, path) == 2
+    collection = json.loads(path.read_text(encoding="utf-8"))
+    assert collection["type"] == "FeatureCollection"
+    assert [feature["geometry"]["coordinates"] for feature in collection["features"]] == [
+        [6.1, 49.6],
+        [5.9, 49.5],
+    ]
+    assert collection["features"][0]["properties"] == {
+        "addr:housenumber": "1",
+        "addr:street": 'Rue "A"',
+        "addr:place": "",
+        "addr:postcode": "1234",
+        "addr:city": "Éch",
+        "ref:caclr": "1",
+    }
+    assert collection["features"][1]["properties"]["addr:street"] is None
+
+
+def test_write_geojson_sequence(tmp_path):
+    path = tmp_path / "out.geojsons"
+    assert luxembourg_addresses.write_geojson(addresses(), path) == 3
+    records = path.read_text(encoding="utf-8").split("\x1e")
+    assert records[0] == ""
+    assert [json.loads(record)["properties"]["ref:caclr"] for record in records[1:]] == ["1"]
+
+
+def test_write_geojson_empty(tmp_path):
+    path = tmp_path / "out.geojson"
+    luxembourg_addresses.write_geojson(addresses().head(0), path)
+    assert json.loads(path.read_text()) == {"type": "FeatureCollection", "features": []}
+
+
+def test_run_calls_stages_of_source(tmp_path):
+    source_name = "temp_stages"
+    src_path = Path("sources") / f"{source_name}.py"
+    src_path.write_text(
+        "import polars as pl\n\n" "def get():\n" "    return pl.DataFrame({'foo': ['val']})\n"
+    )
+    stage_path = Path("stages") / f"{source_name}.py"
+    stage_path.write_text(
+        "def upper(lf, directory):\n"
+        "    lf.select(lf.collect_schema().names()[0]).collect()"
+        ".to_series().str.to_uppercase().to_frame().write_csv(directory / 'upper.csv')\n\n"
+        "STAGES = [upper]\n"
+    )
+    try:
+        out = tmp_path / "out.csv"
+        engine.run(source_name, [out])
+        assert not (tmp_path / "stages" / "upper.csv").exists()
+        engine.run(source_name, [out], stage_dir=tmp_path / "stages")
+        assert out.read_text() == "foo\nval\n"
+        assert (tmp_path / "stages" / "upper.csv").read_text() == "foo\nVAL\n"
+    finally:
+        src_path.unlink()
+        stage_path.unlink()
+
+
+def test_write_osm(tmp_path):
+    path = tmp_path / "out.osm"
+    lf = addresses().with_columns(pl.col("lon_wgs84").fill_null(5.9))
+    tags = {key: key for key in ("addr:housenumber", "addr:street", "addr:place")}
+    assert luxembourg_addresses.write_osm(lf, path, tags) == 2
+    root = ElementTree.parse(path).getroot()
+    assert root.tag == "osm"
+    nodes = root.findall("node")
+    assert [(node.get("id"), node.get("lat"), node.get("lon")) for node in nodes] == [
+        ("-1", "49.6", "6.1"),
+        ("-2", "49.5", "5.9"),
+    ]
+    assert {tag.get("k"): tag.get("v") for tag in nodes[0]} == {
+        "addr:housenumber": "1",
+        "addr:street": 'Rue "A"',
+    }
+    assert {tag.get("k"): tag.get("v") for tag in nodes[1]} == {
+        "addr:housenumber": "4",
+        "addr:place": "Lieu-dit",
+    }
+
+
+def test_xml_escape():
+    escaped = pl.select(luxembourg_addresses.xml_escape(pl.lit("<a & 'b'>\n"))).item()
+    assert escaped == "&lt;a &amp; &apos;b&apos;&gt;&#10;"
+
+
+def test_address_table():
+    lf = pl.LazyFrame(
+        {
+            "rue": ["Rue A", "Rue A", "Rue A", "Rue B", "Rue C"],
+            "numero": ["3", "1", None, "1", "2"],
+            "localite": ["Éch"] * 5,
+            "code_postal": ["1234"] * 4 + ["L-1234"],
+            "id_caclr_rue": ["7", "7", "7", "8", "9"],
+            "id_caclr_bat": ["20", "10", "30", "40", None],
+            "lat_wgs84": ["49.6", "49.6", "49.6", "49.5", "49.4"],
+            "lon_wgs84": ["6.1"] * 5,
+            "coord_est_luref": ["1.5"] * 5,
+            "coord_nord_luref": ["2.5"] * 5,
+            "id_geoportail": ["g1", "g1", "g1", "g2", "g3"],
+            "commune": ["Esch"] * 5,
+        }
+    )
+    table = luxembourg_addresses.address_table(lf).collect()
+    # Like string_agg, no building id gives null; malformed numbers become null
+    assert table.select("rue", "numero", "code_postal", "id_caclr_bat").rows() == [
+        ("Rue A", "1,3", 1234, "10;20"),
+        ("Rue B", "1", 1234, "40"),
+        ("Rue C", "2", None, None),
+    ]
+    assert table.schema["lat_wgs84"] == pl.Float64
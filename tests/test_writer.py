@@ -0,0 +1,14 @@
+import polars as pl
+
+import engine
+
+
+def test_writer_picks_format_from_extension(tmp_path):
+    lf = pl.LazyFrame({"rue": ["Rue A", None], "numero": ["1", "2"]})
+    paths = [tmp_path / name for name in ("out.csv", "out.parquet", "out.arrow", "out.ndjson")]
+    engine.Writer(row_group_size=1).write(lf, paths)
+    expected = lf.collect()
+    assert (tmp_path / "out.csv").read_text() == "rue,numero\nRue A,1\n,2\n"
+    assert pl.read_parquet(tmp_path / "out.parquet").equals(expected)
+    assert pl.read_ipc(tmp_path / "out.arrow").equals(expected)
+    assert pl.read_ndjson(tmp_path / "out.ndjson").equals(expected)